@@ -0,0 +1,95 @@
+import argparse
+import json
+import time
+
+from attrdict import AttrDict
+import torch
+
+from model import MODEL_LIST, compile_model
+from src import resolve_model_link
+from src.tuner import synthetic_inputs
+
+from transformers import AutoConfig
+
+
+def timed(fn, cli_args):
+    # seconds of the first call (compilation happens there) and samples/s over the timed steps
+    start = time.time()
+    fn()
+    first = time.time() - start
+    for _ in range(cli_args.warmup):
+        fn()
+    start = time.time()
+    for _ in range(cli_args.steps):
+        fn()
+    return first, cli_args.batch_size * cli_args.steps / (time.time() - start)
+
+
+def measure(model, inputs, cli_args):
+    optimizer = torch.optim.AdamW(model.parameters(), lr=1e-5)
+
+    def train_step():
+        model.train()
+        loss = model(**inputs)[0]
+        sum(loss if type(loss) == tuple else (loss,)).backward()
+        optimizer.step()
+        optimizer.zero_grad()
+
+    def predict_step():
+        model.eval()
+        with torch.no_grad():
+            model.predict(inputs["input_ids"], inputs["attention_mask"], inputs["token_type_ids"])
+
+    return timed(train_step, cli_args), timed(predict_step, cli_args)
+
+
+if __name__ == '__main__':
+    cli_parser = argparse.ArgumentParser()
+
+    cli_parser.add_argument("--model_mode", type=str, default="Star_Label_AM", choices=MODEL_LIST.keys())
+    cli_parser.add_argument("--transformer_mode", type=str, default="electra")
+    cli_parser.add_argument("--model_registry", type=str, default="config/model_registry.json")
+    cli_parser.add_argument("--labels", type=int, default=2)
+    cli_parser.add_argument("--batch_size", type=int, default=32)
+    cli_parser.add_argument("--seq_len", type=int, default=50)
+    cli_parser.add_argument("--steps", type=int, default=10)
+    cli_parser.add_argument("--warmup", type=int, default=2)
+    cli_parser.add_argument("--threads", type=int, default=0)
+    cli_parser.add_argument("--ckpt_dir", type=str, default="ckpt")
+    # the before/after table as json, e.g. ckpt/bench_compile.json
+    cli_parser.add_argument("--output", type=str, default=None)
+
+    cli_args = cli_parser.parse_args()
+
+    if cli_args.threads > 0:
+        torch.set_num_threads(cli_args.threads)
+    torch.manual_seed(0)
+    model_link = resolve_model_link(cli_args.transformer_mode, cli_args.model_registry)
+    config = AutoConfig.from_pretrained(model_link)
+    # random weights are enough for throughput
+    config.skip_pretrained = True
+    config.device = "cpu"
+    model = MODEL_LIST[cli_args.model_mode](model_link, None, None, config, cli_args.labels)
+    inputs = synthetic_inputs(cli_args.batch_size, cli_args.seq_len, config.vocab_size, cli_args.labels, "cpu",
+                              config.type_vocab_size > 1)
+
+    print("torch {}, {} threads, batch {} x {}".format(torch.__version__, torch.get_num_threads(),
+                                                        cli_args.batch_size, cli_args.seq_len))
+    print("mode\tpath\tfirst_call_s\tsamples_per_s")
+    rows = [("eager", measure(model, inputs, cli_args))]
+    # torch.compile where it exists, else compile_model's TorchScript head and losses
+    model = compile_model(model, AttrDict({"ckpt_dir": cli_args.ckpt_dir}), inputs)
+    rows.append(("compiled" if hasattr(torch, "compile") else "scripted", measure(model, inputs, cli_args)))
+    for mode, (train, predict) in rows:
+        print("{}\ttrain\t{:.2f}\t{:.1f}".format(mode, *train))
+        print("{}\tpredict\t{:.2f}\t{:.1f}".format(mode, *predict))
+    speedup = [rows[1][1][0][1] / rows[0][1][0][1], rows[1][1][1][1] / rows[0][1][1][1]]
+    print("speedup\ttrain {:.2f}x, predict {:.2f}x".format(*speedup))
+    if cli_args.output:
+        with open(cli_args.output, "w") as fp:
+            json.dump({"torch": torch.__version__, "threads": torch.get_num_threads(),
+                       "model_mode": cli_args.model_mode, "batch_size": cli_args.batch_size, "seq_len": cli_args.seq_len,
+                       "rows": [{"mode": mode, "train_first_call_s": train[0], "train_samples_per_s": train[1],
+                                 "predict_first_call_s": predict[0], "predict_samples_per_s": predict[1]}
+                                for mode, (train, predict) in rows],
+                       "train_speedup": speedup[0], "predict_speedup": speedup[1]}, fp, indent=2)
@@ -0,0 +1,75 @@
+import argparse
+import time
+
+import torch
+from torch import nn
+
+from model import head_loss, prototype_loss
+
+
+class LabelHead(nn.Module):
+    # only the label side of the Star_Label models (dense -> out_proj, star_emb), fed with random CLS vectors
+    def __init__(self, labelNumber, num_sampled, sparse, device, margin=-0.5):
+        super(LabelHead, self).__init__()
+        self.dense = nn.Linear(768, 768)
+        self.out_proj = nn.Linear(768, labelNumber)
+        self.star_emb = nn.Embedding(labelNumber, 768, sparse=sparse)
+        self.labelNumber = labelNumber
+        self.num_sampled = num_sampled
+        self.margin = margin
+        self.config = argparse.Namespace(device=device)
+
+    def forward(self, embs, labels):
+        loss_fn = torch.nn.CosineEmbeddingLoss(reduction='mean', margin=self.margin)
+        loss1, _, label_set = head_loss(self, self.dense(embs), labels)
+        loss3 = prototype_loss(self, embs, labels, label_set, loss_fn)
+        return loss1 + loss3
+
+
+def run(labelNumber, num_sampled, sparse, cli_args):
+    torch.manual_seed(0)
+    model = LabelHead(labelNumber, num_sampled, sparse, cli_args.device).to(cli_args.device)
+    model.train()
+    dense = [p for n, p in model.named_parameters() if not (sparse and n == "star_emb.weight")]
+    optimizer = torch.optim.AdamW(dense, lr=1e-3)
+    sparse_optimizer = torch.optim.SparseAdam([model.star_emb.weight], lr=1e-3) if sparse else None
+    embs = torch.randn(cli_args.batch_size, 768, device=cli_args.device)
+    labels = torch.randint(labelNumber, (cli_args.batch_size,), device=cli_args.device)
+
+    if cli_args.device.startswith("cuda"):
+        torch.cuda.reset_peak_memory_stats()
+    for i in range(cli_args.warmup + cli_args.steps):
+        if i == cli_args.warmup:
+            if cli_args.device.startswith("cuda"):
+                torch.cuda.synchronize()
+            start = time.time()
+        loss = model(embs, labels)
+        loss.backward()
+        optimizer.step()
+        if sparse_optimizer is not None:
+            sparse_optimizer.step()
+        model.zero_grad()
+    if cli_args.device.startswith("cuda"):
+        torch.cuda.synchronize()
+    step_ms = (time.time() - start) / cli_args.steps * 1000
+    peak = torch.cuda.max_memory_allocated() / 2 ** 20 if cli_args.device.startswith("cuda") else float("nan")
+    print("{}\t{}\t{}\t{:.2f}\t{:.1f}".format(labelNumber, num_sampled, sparse, step_ms, peak))
+
+
+if __name__ == '__main__':
+    cli_parser = argparse.ArgumentParser()
+
+    cli_parser.add_argument("--labels", type=int, nargs="+", default=[100, 1000, 10000, 50000])
+    cli_parser.add_argument("--num_sampled", type=int, default=1024)
+    cli_parser.add_argument("--batch_size", type=int, default=256)
+    cli_parser.add_argument("--steps", type=int, default=20)
+    cli_parser.add_argument("--warmup", type=int, default=3)
+    cli_parser.add_argument("--device", type=str, default="cuda:0" if torch.cuda.is_available() else "cpu")
+
+    cli_args = cli_parser.parse_args()
+
+    print("labels\tnum_sampled\tsparse\tstep_ms\tpeak_MB")
+    for labelNumber in cli_args.labels:
+        run(labelNumber, 0, False, cli_args)
+        run(labelNumber, cli_args.num_sampled, False, cli_args)
+        run(labelNumber, cli_args.num_sampled, True, cli_args)
@@ -0,0 +1,68 @@
+import argparse
+import time
+
+import torch
+from torch import nn
+
+from model import Star_Label_AM_att
+
+
+class LstmPooler(nn.Module):
+    # only the lstm + attention pooling of Star_Label_AM_att, fed with random encoder outputs
+    attention_net = Star_Label_AM_att.attention_net
+    lstm_pool = Star_Label_AM_att.lstm_pool
+
+    def __init__(self, bidirectional):
+        super(LstmPooler, self).__init__()
+        self.lstm = nn.LSTM(768, 768 // 2 if bidirectional else 768, batch_first=True, bidirectional=bidirectional)
+        self.att_w = nn.Parameter(torch.randn(1, 768, 1))
+
+    def padded_pool(self, hidden_states, attention_mask):
+        # the old path: the recurrence runs over every position up to max_seq_len
+        outputs, _ = self.lstm(hidden_states)
+        return self.attention_net(outputs, attention_mask)
+
+
+def run(packed, bidirectional, cli_args):
+    torch.manual_seed(0)
+    model = LstmPooler(bidirectional).to(cli_args.device)
+    model.train()
+    hidden_states = torch.randn(cli_args.batch_size, cli_args.seq_len, 768, device=cli_args.device)
+    lengths = torch.randint(cli_args.min_len, cli_args.seq_len + 1, (cli_args.batch_size,))
+    attention_mask = (torch.arange(cli_args.seq_len).unsqueeze(0) < lengths.unsqueeze(1)).long().to(cli_args.device)
+    pool = model.lstm_pool if packed else model.padded_pool
+
+    for i in range(cli_args.warmup + cli_args.steps):
+        if i == cli_args.warmup:
+            if cli_args.device.startswith("cuda"):
+                torch.cuda.synchronize()
+            start = time.time()
+        pool(hidden_states, attention_mask).sum().backward()
+        model.zero_grad()
+    if cli_args.device.startswith("cuda"):
+        torch.cuda.synchronize()
+    elapsed = time.time() - start
+    # real (non padding) tokens, the padded path spends time on the rest too
+    tokens = int(lengths.sum()) * cli_args.steps
+    print("{}\t{}\t{:.2f}\t{:.0f}".format("packed" if packed else "padded", bidirectional,
+                                          elapsed / cli_args.steps * 1000, tokens / elapsed))
+    return tokens / elapsed
+
+
+if __name__ == '__main__':
+    cli_parser = argparse.ArgumentParser()
+
+    cli_parser.add_argument("--batch_size", type=int, default=64)
+    cli_parser.add_argument("--seq_len", type=int, default=50)
+    cli_parser.add_argument("--min_len", type=int, default=5)
+    cli_parser.add_argument("--steps", type=int, default=20)
+    cli_parser.add_argument("--warmup", type=int, default=3)
+    cli_parser.add_argument("--device", type=str, default="cuda:0" if torch.cuda.is_available() else "cpu")
+
+    cli_args = cli_parser.parse_args()
+
+    print("path\tbidirectional\tstep_ms\ttokens_per_s")
+    for bidirectional in (False, True):
+        padded = run(False, bidirectional, cli_args)
+        packed = run(True, bidirectional, cli_args)
+        print("speedup\t{}\t{:.2f}x".format(bidirectional, packed / padded))
@@ -0,0 +1,64 @@
+import argparse
+import time
+
+import torch
+
+from model import pair_loss
+
+
+def loop_pair_loss(embs, labels, margin, positive):
+    # the per-anchor loop AM/ANN used before pair_loss, kept as the reference
+    batch_size, w2v_dim = embs.shape
+    loss_fn = torch.nn.CosineEmbeddingLoss(reduction='mean', margin=margin)
+    loss2s = []
+    for i in range(batch_size):
+        diff_indexs = labels == labels[i] if positive else labels != labels[i]
+        if not diff_indexs.any():
+            continue
+        diff_label_datas = embs[diff_indexs, :]
+        stretch_ori_datas = embs[i, :].repeat(int(diff_indexs.sum()), 1)
+        target = torch.ones(int(diff_indexs.sum()), device=embs.device)
+        loss2s.append(loss_fn(diff_label_datas.view(-1, w2v_dim), stretch_ori_datas.view(-1, w2v_dim),
+                              target if positive else -target))
+    return sum(loss2s) / len(loss2s)
+
+
+def timed(fn, cli_args):
+    for i in range(cli_args.warmup + cli_args.steps):
+        if i == cli_args.warmup:
+            if cli_args.device.startswith("cuda"):
+                torch.cuda.synchronize()
+            start = time.time()
+        loss = fn()
+        loss.backward()
+    if cli_args.device.startswith("cuda"):
+        torch.cuda.synchronize()
+    return float(loss), (time.time() - start) / cli_args.steps * 1000
+
+
+if __name__ == '__main__':
+    cli_parser = argparse.ArgumentParser()
+
+    cli_parser.add_argument("--batch_sizes", type=int, nargs="+", default=[64, 256, 450])
+    cli_parser.add_argument("--labels", type=int, default=2)
+    cli_parser.add_argument("--margin", type=float, default=-0.5)
+    cli_parser.add_argument("--k", type=int, default=8)
+    cli_parser.add_argument("--steps", type=int, default=10)
+    cli_parser.add_argument("--warmup", type=int, default=2)
+    cli_parser.add_argument("--device", type=str, default="cuda:0" if torch.cuda.is_available() else "cpu")
+
+    cli_args = cli_parser.parse_args()
+
+    print("batch\tterm\tmode\tloss\tstep_ms")
+    for batch_size in cli_args.batch_sizes:
+        torch.manual_seed(0)
+        embs = torch.randn(batch_size, 768, device=cli_args.device, requires_grad=True)
+        labels = torch.randint(cli_args.labels, (batch_size,), device=cli_args.device)
+        for positive in (True, False):
+            term = "AM" if positive else "ANN"
+            runs = [("loop", lambda: loop_pair_loss(embs, labels, cli_args.margin, positive))]
+            runs += [(mode, lambda mode=mode: pair_loss(embs, labels, cli_args.margin, positive, mode, cli_args.k))
+                     for mode in ("all", "hard", "semi_hard")]
+            for mode, fn in runs:
+                loss, step_ms = timed(fn, cli_args)
+                print("{}\t{}\t{}\t{:.6f}\t{:.2f}".format(batch_size, term, mode, loss, step_ms))
@@ -0,0 +1,60 @@
+import argparse
+import time
+
+import torch
+
+from model import pairwise_cosine_loss
+from src import MemoryProfiler
+
+
+def repeat_loss(embs, labels, margin):
+    # the all-pairs loss Star_Label_AM_att had before pairwise_cosine_loss: both sides of every pair are
+    # materialized as batch x batch x dim copies. the old python loop filling y is vectorized here, it
+    # cost time but no memory
+    batch_size, w2v_dim = embs.shape
+    x1 = embs.repeat(1, batch_size).view(batch_size, batch_size, w2v_dim)
+    x2 = embs.unsqueeze(0).repeat(batch_size, 1, 1)
+    y = (labels.unsqueeze(0) == labels.unsqueeze(1)).to(embs.dtype) * 2 - 1
+    loss_fn = torch.nn.CosineEmbeddingLoss(reduction='mean', margin=margin)
+    return loss_fn(x1.view(-1, w2v_dim), x2.view(-1, w2v_dim), y.view(-1))
+
+
+def run(name, loss_fn, batch_size, labelNumber, cli_args):
+    torch.manual_seed(0)
+    embs = torch.randn(batch_size, 768, device=cli_args.device, requires_grad=True)
+    labels = torch.randint(labelNumber, (batch_size,), device=cli_args.device)
+    profiler = MemoryProfiler(None, True, cli_args.device)
+    with profiler.stage("loss"):
+        start = time.time()
+        for _ in range(cli_args.steps):
+            loss = loss_fn(embs, labels, cli_args.margin)
+            loss.backward()
+        if cli_args.device.startswith("cuda"):
+            torch.cuda.synchronize()
+        step_ms = (time.time() - start) / cli_args.steps * 1000
+    profiler.enabled = False
+    stats = profiler.stages["loss"]
+    growth = stats["cuda_growth"] if "cuda_growth" in stats else stats["rss_growth"]
+    print("{}\t{}\t{}\t{:.4f}\t{:.2f}\t{:.1f}".format(name, batch_size, labelNumber, float(loss), step_ms,
+                                                    growth / 2 ** 20))
+
+
+if __name__ == '__main__':
+    cli_parser = argparse.ArgumentParser()
+
+    cli_parser.add_argument("--batch_sizes", type=int, nargs="+", default=[64, 128, 256, 512])
+    cli_parser.add_argument("--labels", type=int, nargs="+", default=[2, 100])
+    cli_parser.add_argument("--margin", type=float, default=-0.5)
+    cli_parser.add_argument("--steps", type=int, default=3)
+    cli_parser.add_argument("--device", type=str, default="cuda:0" if torch.cuda.is_available() else "cpu")
+
+    cli_args = cli_parser.parse_args()
+
+    # peak growth is the allocator peak on GPUs and the sampled RSS peak on CPU, over forward + backward.
+    # the blockwise loss runs first for every size, so its number is not flattered by pages the repeat
+    # loss already freed. both losses average over all batch x batch pairs, the value columns must agree
+    print("loss\tbatch_size\tlabels\tvalue\tstep_ms\tpeak_growth_MB")
+    for labelNumber in cli_args.labels:
+        for batch_size in cli_args.batch_sizes:
+            run("blockwise", pairwise_cosine_loss, batch_size, labelNumber, cli_args)
+            run("repeat", repeat_loss, batch_size, labelNumber, cli_args)
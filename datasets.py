@@ -1,25 +1,120 @@
  #-*- coding:utf-8 -*-
 
 import torch
-from torch.utils.data import Dataset
+from torch.utils.data import Dataset, IterableDataset, Sampler
 import pandas as pd
+import bisect
+import collections
+import glob
+import json
+import logging
 import os
 import re
 import random
 
+logger = logging.getLogger(__name__)
+
+# label vocabs of this process, also the only copy when the vocab cache file cannot be written
+VOCAB_CACHE = {}
+
+
+def get_data_path(args, mode):
+    if "train" in mode:
+        data_path = os.path.join(args.data_dir, args.train_file)
+    elif "dev" in mode:
+        data_path = os.path.join(args.data_dir,  args.dev_file)
+        if not os.path.exists(data_path) and not glob.glob(data_path):
+            data_path = os.path.join(args.data_dir, args.test_file)
+    elif "test" in mode:
+        data_path = os.path.join(args.data_dir, args.test_file)
+    return data_path
+
+
+def encode_example(tokenizer, maxlen, txt, label):
+    data = tokenizer(txt, padding="max_length", max_length=maxlen, truncation=True)
+    input_ids = torch.LongTensor(data["input_ids"])
+    try:
+        token_type_ids = torch.LongTensor(data["token_type_ids"])
+    except :
+        token_type_ids = None
+    attention_mask = torch.LongTensor(data["attention_mask"])
+    # same order train()/evaluate() unpack the batch in
+    if token_type_ids == None:
+        return (input_ids, attention_mask, label),txt
+    else:
+        return (input_ids, attention_mask, token_type_ids, label),txt
+
+
+def list_shards(data_path):
+    # a split is either one file, a directory of shards or a glob pattern
+    if os.path.isdir(data_path):
+        files = [os.path.join(data_path, f) for f in os.listdir(data_path)
+                 if f.endswith((".tsv", ".parquet"))]
+    else:
+        files = glob.glob(data_path)
+    return sorted(files)
+
+
+def iter_shard(path, columns=("data", "label"), chunksize=10000):
+    if path.endswith(".parquet"):
+        import pyarrow.parquet as pq
+        for batch in pq.ParquetFile(path).iter_batches(batch_size=chunksize, columns=list(columns)):
+            yield from zip(*(batch.column(c).to_pylist() for c in columns))
+    else:
+        for chunk in pd.read_csv(path, encoding="utf8", sep="\t", usecols=list(columns), chunksize=chunksize):
+            yield from zip(*(chunk[c].tolist() for c in columns))
+
+
+def vocab_cache_dir(args):
+    # "vocab_cache_dir" in the config json, else the run's output dir, else next to the data
+    return args.get("vocab_cache_dir") or args.get("output_dir")
+
+
+def load_label_vocab(data_path, cache_dir=None):
+    # label set and row count of a split, computed in one pass over the label column and cached on disk.
+    # the cache is only used while the shard list and every shard's size and mtime are unchanged. it lives
+    # in cache_dir (next to the data when None), and is kept in memory only when it cannot be written
+    name = re.sub(r"[*?\[\]]", "_", data_path)
+    if cache_dir is not None:
+        vocab_file = os.path.join(cache_dir, re.sub(r"[^\w.-]", "_", os.path.abspath(name)) + ".label_vocab.json")
+    else:
+        vocab_file = os.path.join(data_path, "label_vocab.json") if os.path.isdir(data_path) \
+            else name + ".label_vocab.json"
+    shards = list_shards(data_path)
+    key = [[os.path.basename(f), os.path.getsize(f), os.path.getmtime(f)] for f in shards]
+    if vocab_file in VOCAB_CACHE and VOCAB_CACHE[vocab_file]["shards"] == key:
+        return VOCAB_CACHE[vocab_file]
+    if os.path.isfile(vocab_file):
+        with open(vocab_file) as fp:
+            vocab = json.load(fp)
+        if vocab.get("shards") == key:
+            VOCAB_CACHE[vocab_file] = vocab
+            return vocab
+
+    labels = set()
+    num_rows = 0
+    for shard in shards:
+        for (label,) in iter_shard(shard, columns=("label",)):
+            labels.add(label)
+            num_rows += 1
+    vocab = {"labels": sorted(labels), "num_rows": num_rows, "shards": key}
+    VOCAB_CACHE[vocab_file] = vocab
+    try:
+        if not os.path.exists(os.path.dirname(vocab_file) or "."):
+            os.makedirs(os.path.dirname(vocab_file))
+        with open(vocab_file, "w") as fp:
+            json.dump(vocab, fp)
+    except OSError as e:
+        logger.warning("Keeping the label vocab of {} in memory only, {}".format(data_path, e))
+    return vocab
+
+
 class BaseDataset(Dataset):
     def __init__(self, args, tokenizer, mode):
         super(BaseDataset,self).__init__()
         self.tokenizer = tokenizer
         self.maxlen = args.max_seq_len
-        if "train" in mode:
-            data_path = os.path.join(args.data_dir, args.train_file)
-        elif "dev" in mode:
-            data_path = os.path.join(args.data_dir,  args.dev_file)
-            if not os.path.isfile(data_path):
-                data_path = os.path.join(args.data_dir, args.test_file)
-        elif "test" in mode:
-            data_path = os.path.join(args.data_dir, args.test_file)
+        data_path = get_data_path(args, mode)
         self.dataset = pd.read_csv(data_path, encoding="utf8", sep="\t")
 
     def __len__(self):
@@ -27,24 +122,217 @@ class BaseDataset(Dataset):
 
     def __getitem__(self, idx):
         txt = str(self.dataset.at[idx,"data"])
-        data = self.tokenizer(txt, padding="max_length", max_length=self.maxlen, truncation=True)
-        input_ids = torch.LongTensor(data["input_ids"])
-        try:
-            token_type_ids = torch.LongTensor(data["token_type_ids"])
-        except :
-            token_type_ids = None
-        attention_mask = torch.LongTensor(data["attention_mask"])
         label = self.dataset.at[idx,"label"]
-        if token_type_ids == None:
-            return (input_ids, attention_mask, label),txt
-        else:
-            return (input_ids, token_type_ids, attention_mask, label),txt
+        return encode_example(self.tokenizer, self.maxlen, txt, label)
 
     def getLabelNumber(self):
         return len(set(self.dataset["label"]))
 
+    def nbytes(self):
+        # the DataFrame of python strings, deep so the string objects are counted too
+        return int(self.dataset.memory_usage(deep=True).sum())
+
+
+class ParquetDataset(Dataset):
+    # lazy: only the row group footers are read up front. a row is decoded with its whole row group (the
+    # data/label columns only), and the last "parquet_cache_groups" decoded groups are kept, so sequential
+    # reads, and training through ResumableSampler's group-wise shuffle, decode each group once. files are
+    # opened per process, the dataset pickles without handles
+    def __init__(self, args, tokenizer, mode):
+        super(ParquetDataset,self).__init__()
+        import pyarrow.parquet as pq
+        self.tokenizer = tokenizer
+        self.maxlen = args.max_seq_len
+        self.data_path = get_data_path(args, mode)
+        self.cache_groups = args.get("parquet_cache_groups", 8)
+        self.vocab_cache_dir = vocab_cache_dir(args)
+        self.groups = []
+        self.offsets = [0]
+        for path in list_shards(self.data_path):
+            metadata = pq.ParquetFile(path).metadata
+            for group in range(metadata.num_row_groups):
+                self.groups.append((path, group))
+                self.offsets.append(self.offsets[-1] + metadata.row_group(group).num_rows)
+        self.files = {}
+        self.cache = collections.OrderedDict()
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        state["files"] = {}
+        state["cache"] = collections.OrderedDict()
+        return state
+
+    def row_group(self, i):
+        if i in self.cache:
+            self.cache.move_to_end(i)
+            return self.cache[i]
+        import pyarrow.parquet as pq
+        path, group = self.groups[i]
+        if path not in self.files:
+            self.files[path] = pq.ParquetFile(path)
+        table = self.files[path].read_row_group(group, columns=["data", "label"])
+        self.cache[i] = (table.column("data"), table.column("label"))
+        if len(self.cache) > self.cache_groups:
+            self.cache.popitem(last=False)
+        return self.cache[i]
+
+    def __len__(self):
+        return self.offsets[-1]
+
+    def __getitem__(self, idx):
+        i = bisect.bisect_right(self.offsets, idx) - 1
+        data, label = self.row_group(i)
+        row = idx - self.offsets[i]
+        return encode_example(self.tokenizer, self.maxlen, str(data[row].as_py()), label[row].as_py())
+
+    def getLabelNumber(self):
+        return len(load_label_vocab(self.data_path, self.vocab_cache_dir)["labels"])
+
+    def nbytes(self):
+        # decoded row groups currently held, at most parquet_cache_groups of them
+        return sum(data.nbytes + label.nbytes for data, label in self.cache.values())
+
+
+class StreamingDataset(IterableDataset):
+    def __init__(self, args, tokenizer, mode):
+        super(StreamingDataset,self).__init__()
+        self.tokenizer = tokenizer
+        self.maxlen = args.max_seq_len
+        self.data_path = get_data_path(args, mode)
+        self.files = list_shards(self.data_path)
+        self.shuffle = "train" in mode
+        self.shuffle_buffer = args.get("shuffle_buffer", 10000)
+        self.seed = args.seed
+        self.epoch = 0
+        self.vocab = load_label_vocab(self.data_path, vocab_cache_dir(args))
+
+    def set_epoch(self, epoch):
+        # called by the training loop before each epoch, DataLoader workers get a copy with this value
+        self.epoch = epoch
+
+    def __len__(self):
+        return self.vocab["num_rows"]
+
+    def rows(self, files):
+        for shard in files:
+            yield from iter_shard(shard)
+
+    def __iter__(self):
+        worker_info = torch.utils.data.get_worker_info()
+        files = self.files
+        if worker_info is not None:
+            files = files[worker_info.id::worker_info.num_workers]
+        rng = random.Random(self.seed + self.epoch)
+        if self.shuffle:
+            files = list(files)
+            rng.shuffle(files)
+
+        buffer = []
+        for txt, label in self.rows(files):
+            example = encode_example(self.tokenizer, self.maxlen, str(txt), label)
+            if not self.shuffle:
+                yield example
+            elif len(buffer) < self.shuffle_buffer:
+                buffer.append(example)
+            else:
+                idx = rng.randrange(len(buffer))
+                yield buffer[idx]
+                buffer[idx] = example
+        rng.shuffle(buffer)
+        yield from buffer
+
+    def getLabelNumber(self):
+        return len(self.vocab["labels"])
+
+    def nbytes(self):
+        # upper bound of the shuffle buffer: input_ids, attention_mask and token_type_ids per example
+        return self.shuffle_buffer * self.maxlen * 3 * 8 if self.shuffle else 0
+
+
+class ResumableSampler(Sampler):
+    # random order fixed by (seed, epoch), so a resumed run can replay an epoch and skip what it already saw.
+    # a dataset with row group offsets (ParquetDataset) is shuffled group by group: the groups in random
+    # order and the rows within each group, so every group is decoded once per epoch instead of per row
+    def __init__(self, data_source, seed):
+        self.data_source = data_source
+        self.seed = seed
+        self.epoch = 0
+        self.start = 0
+
+    def set_epoch(self, epoch, start=0):
+        self.epoch = epoch
+        self.start = start
+
+    def __iter__(self):
+        generator = torch.Generator()
+        generator.manual_seed(self.seed + self.epoch)
+        offsets = getattr(self.data_source, "offsets", None)
+        if offsets is None:
+            return iter(torch.randperm(len(self.data_source), generator=generator).tolist()[self.start:])
+        order = []
+        for i in torch.randperm(len(offsets) - 1, generator=generator).tolist():
+            rows = torch.randperm(offsets[i + 1] - offsets[i], generator=generator) + offsets[i]
+            order.extend(rows.tolist())
+        return iter(order[self.start:])
+
+    def __len__(self):
+        return len(self.data_source) - self.start
+
+
+class PackedCollator(object):
+    # packs several short examples into each max_seq_len row. attention is block diagonal so packed
+    # examples never attend to each other, and position ids restart at every example's CLS token
+    def __init__(self, maxlen, pad_token_id=0, position_offset=0):
+        self.maxlen = maxlen
+        self.pad_token_id = pad_token_id
+        self.position_offset = position_offset
+
+    def __call__(self, examples):
+        rows = [[]]
+        used = 0
+        for tensors, txt in examples:
+            input_ids, attention_mask, label = tensors[0], tensors[1], tensors[-1]
+            length = int(attention_mask.sum())
+            if used + length > self.maxlen and rows[-1]:
+                rows.append([])
+                used = 0
+            rows[-1].append((input_ids[:length], label, txt))
+            used += length
+
+        input_ids = torch.full((len(rows), self.maxlen), self.pad_token_id, dtype=torch.long)
+        attention_mask = torch.zeros((len(rows), self.maxlen, self.maxlen), dtype=torch.long)
+        position_ids = torch.full((len(rows), self.maxlen), self.position_offset, dtype=torch.long)
+        cls_index = []
+        labels = []
+        txts = []
+        for r, row in enumerate(rows):
+            start = 0
+            for ids, label, txt in row:
+                end = start + len(ids)
+                input_ids[r, start:end] = ids
+                attention_mask[r, start:end, start:end] = 1
+                position_ids[r, start:end] = torch.arange(len(ids)) + self.position_offset
+                cls_index.append(r * self.maxlen + start)
+                labels.append(int(label))
+                txts.append(txt)
+                start = end
+        return (input_ids, attention_mask, position_ids, torch.LongTensor(cls_index), torch.LongTensor(labels)), txts
+
+
+BACKEND_LIST = {
+    "tsv": BaseDataset,
+    "parquet": ParquetDataset,
+    "stream": StreamingDataset
+}
+
+
+def load_dataset(args, tokenizer, mode):
+    # each split picks its reader with "<mode>_backend" in the config json, tsv by default
+    return BACKEND_LIST[args.get("{}_backend".format(mode), "tsv")](args, tokenizer, mode)
+
+
 DATASET_LIST = {
     "Star_Label_AM": BaseDataset,
     "Star_Label_ANN" : BaseDataset,
     "BaseModel": BaseDataset
-}
\ No newline at end of file
+}
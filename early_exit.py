@@ -0,0 +1,207 @@
+import argparse
+import json
+import logging
+import os
+import time
+
+from attrdict import AttrDict
+import numpy as np
+from torch.utils.data import DataLoader, IterableDataset, RandomSampler, SequentialSampler
+from fastprogress.fastprogress import progress_bar
+from datasets import load_dataset
+
+import matplotlib
+matplotlib.use("Agg")
+import matplotlib.pyplot as plt
+
+from model import *
+
+from src import (
+    init_logger,
+    set_seed,
+    resolve_model_link
+)
+
+from transformers import (
+    AdamW,
+    AutoTokenizer
+)
+
+logger = logging.getLogger(__name__)
+
+
+def split_batch(batch):
+    token_type_ids = batch[2] if len(batch) == 4 else None
+    return batch[0], batch[1], token_type_ids, batch[-1]
+
+
+def fit_exits(args, cli_args, model, train_dataset):
+    # after-the-fact training: the wrapped model stays frozen and in eval mode, only the exits learn
+    model.exit_train = "frozen"
+    model.eval()
+    optimizer = AdamW(model.exits.parameters(), lr=cli_args.fit_lr)
+    sampler = None if isinstance(train_dataset, IterableDataset) else RandomSampler(train_dataset)
+    dataloader = DataLoader(train_dataset, sampler=sampler, batch_size=args.train_batch_size)
+    for epoch in range(cli_args.fit_epochs):
+        ep_loss = torch.zeros([], device=args.device)
+        steps = 0
+        for (batch, txt) in progress_bar(dataloader):
+            input_ids, attention_mask, token_type_ids, labels = split_batch(tuple(t.to(args.device) for t in batch))
+            with torch.enable_grad():
+                loss = model(input_ids, attention_mask, labels, token_type_ids)[0][0]
+                loss.backward()
+            optimizer.step()
+            optimizer.zero_grad()
+            ep_loss += loss.detach()
+            steps += 1
+        logger.info("Exit fitting epoch {}: loss {:.4f}".format(epoch + 1, float(ep_loss) / max(steps, 1)))
+
+
+def exit_curve(model, eval_dataloader, device, thresholds):
+    # one full pass collects every exit's confidence and correctness, then each threshold is replayed
+    # offline: a sentence leaves at its first exit reaching the threshold, otherwise at the last layer
+    confs, corrects = [], []
+    for (batch, txt) in progress_bar(eval_dataloader):
+        input_ids, attention_mask, token_type_ids, labels = split_batch(tuple(t.to(device) for t in batch))
+        with torch.no_grad():
+            logits = model.predict_all_exits(input_ids, attention_mask, token_type_ids)
+        probs = [F.softmax(l.float(), dim=-1) for l in logits]
+        confs.append(torch.stack([p.max(dim=-1)[0] for p in probs[:-1]]).cpu().numpy())
+        corrects.append(torch.stack([p.argmax(dim=-1) == labels for p in probs]).cpu().numpy())
+    confs = np.concatenate(confs, axis=1)
+    corrects = np.concatenate(corrects, axis=1)
+
+    num_layers = len(model.layers)
+    layers = np.array(model.exit_layers + [num_layers])
+    curve = []
+    for threshold in thresholds:
+        passed = np.vstack([confs >= threshold, np.ones((1, confs.shape[1]), dtype=bool)])
+        exit_idx = passed.argmax(axis=0)
+        curve.append({
+            "threshold": float(threshold),
+            "acc": float(corrects[exit_idx, np.arange(confs.shape[1])].mean()),
+            "avg_layers": float(layers[exit_idx].mean()),
+            "exit_rate": {str(l): float((exit_idx == i).mean()) for i, l in enumerate(layers)}
+        })
+    return curve
+
+
+def measure_latency(model, eval_dataset, cli_args, thresholds):
+    model.to("cpu")
+    sampler = None if isinstance(eval_dataset, IterableDataset) else SequentialSampler(eval_dataset)
+    dataloader = DataLoader(eval_dataset, sampler=sampler, batch_size=cli_args.latency_batch_size)
+    batches = []
+    for (batch, txt) in dataloader:
+        batches.append(split_batch(batch))
+        if len(batches) >= cli_args.latency_batches:
+            break
+
+    latency = {}
+    with torch.no_grad():
+        for name, run in [("full", lambda b: model.base.predict(b[0], b[1], b[2]))] + \
+                [(str(t), lambda b, t=t: model.predict(b[0], b[1], b[2], threshold=t)) for t in thresholds]:
+            run(batches[0])
+            start = time.time()
+            for b in batches:
+                run(b)
+            latency[name] = (time.time() - start) / len(batches) * 1000
+            logger.info("  latency {}: {:.2f} ms / batch of {}".format(name, latency[name], cli_args.latency_batch_size))
+    return latency
+
+
+def main(cli_args):
+    max_checkpoint = "checkpoint-best"
+    checkpoint_dir = os.path.join("ckpt", cli_args.result_dir, max_checkpoint)
+
+    training_args = torch.load(os.path.join(checkpoint_dir, "training_args.bin"))
+    with open(os.path.join(cli_args.config_dir, cli_args.config_file)) as f:
+        args = AttrDict(json.load(f))
+
+    init_logger()
+    set_seed(args)
+    torch.set_num_threads(cli_args.threads)
+
+    model_link = resolve_model_link(cli_args.transformer_mode, args.get("model_registry"))
+    tokenizer = AutoTokenizer.from_pretrained(model_link)
+
+    args.train_file = os.path.join(cli_args.dataset, args.train_file)
+    args.dev_file = os.path.join(cli_args.dataset, args.dev_file)
+    args.test_file = os.path.join(cli_args.dataset, args.test_file)
+    train_dataset = load_dataset(args, tokenizer, mode="train")
+    labelNumber = train_dataset.getLabelNumber()
+    eval_dataset = load_dataset(args, tokenizer, mode=cli_args.split)
+
+    args.device = "cuda:{}".format(cli_args.gpu) if torch.cuda.is_available() and not args.no_cuda else "cpu"
+    # exits trained jointly live in training_model.bin, exits fitted afterwards in early_exit_model.bin
+    # (a full state dict, lora adapters already merged)
+    exit_file = os.path.join(checkpoint_dir, "early_exit_model.bin")
+    if args.get("early_exit", False) or os.path.isfile(exit_file):
+        weights_file = os.path.basename(exit_file) if os.path.isfile(exit_file) else "training_model.bin"
+        model = load_checkpoint(checkpoint_dir, cli_args.model_mode, model_link, args, labelNumber,
+                                training_args.margin, weights_file, early_exit=True)
+    else:
+        base = load_checkpoint(checkpoint_dir, cli_args.model_mode, model_link, args, labelNumber,
+                               training_args.margin, early_exit=False)
+        model = EarlyExit(base, exit_config(base.config, args), labelNumber)
+        model.to(args.device)
+        if model.exits is not None:
+            logger.info("***** Fitting exits at layers {} *****".format(model.exit_layers))
+            fit_exits(args, cli_args, model, train_dataset)
+            torch.save(model.state_dict(), exit_file)
+    model.eval()
+
+    eval_sampler = None if isinstance(eval_dataset, IterableDataset) else SequentialSampler(eval_dataset)
+    eval_dataloader = DataLoader(eval_dataset, sampler=eval_sampler, batch_size=args.eval_batch_size)
+    logger.info("***** Early exit curve on {} dataset *****".format(cli_args.split))
+    thresholds = np.linspace(cli_args.min_threshold, 1.0, cli_args.num_thresholds)
+    curve = exit_curve(model, eval_dataloader, args.device, thresholds)
+    for point in curve:
+        logger.info("  threshold {:.3f}: acc {:.4f}, avg layers {:.2f}".format(
+            point["threshold"], point["acc"], point["avg_layers"]))
+
+    logger.info("***** CPU latency with {} threads *****".format(cli_args.threads))
+    latency = measure_latency(model, eval_dataset, cli_args, cli_args.latency_thresholds)
+
+    output_dir = os.path.join("ckpt", cli_args.result_dir, "early_exit_{}".format(cli_args.split))
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+    with open(os.path.join(output_dir, "early_exit.json"), "w") as fp:
+        json.dump({"exit_layers": model.exit_layers, "exit_mode": model.exit_mode, "curve": curve,
+                   "cpu_threads": cli_args.threads, "latency_batch_size": cli_args.latency_batch_size,
+                   "latency_ms": latency}, fp, indent=2)
+
+    fig = plt.figure(figsize=(8, 5))
+    ax = fig.add_subplot(1, 1, 1)
+    ax.plot([p["avg_layers"] for p in curve], [p["acc"] for p in curve], marker="o")
+    ax.set_xlabel("average layers")
+    ax.set_ylabel("accuracy")
+    ax.set_title("early exit on {}".format(cli_args.split))
+    ax.grid()
+    fig.savefig(os.path.join(output_dir, "acc_vs_layers.png"))
+    plt.close(fig)
+    logger.info("Saving early exit report to {}".format(output_dir))
+
+
+if __name__ == '__main__':
+    cli_parser = argparse.ArgumentParser()
+
+    cli_parser.add_argument("--config_dir", type=str, default="config")
+    cli_parser.add_argument("--config_file", type=str, default="koelectra-base.json")
+    cli_parser.add_argument("--dataset", type=str, required=True)
+    cli_parser.add_argument("--result_dir", type=str, required=True)
+    cli_parser.add_argument("--model_mode", type=str, required=True, choices=MODEL_LIST.keys())
+    cli_parser.add_argument("--transformer_mode", type=str, required=True)
+    cli_parser.add_argument("--split", type=str, default="test", choices=["dev", "test"])
+    cli_parser.add_argument("--gpu", type=str, default = 0)
+    cli_parser.add_argument("--fit_epochs", type=int, default = 1)
+    cli_parser.add_argument("--fit_lr", type=float, default = 1e-3)
+    cli_parser.add_argument("--min_threshold", type=float, default = 0.5)
+    cli_parser.add_argument("--num_thresholds", type=int, default = 11)
+    cli_parser.add_argument("--latency_thresholds", type=float, nargs="+", default=[0.8, 0.9, 0.95, 0.99])
+    cli_parser.add_argument("--latency_batch_size", type=int, default = 1)
+    cli_parser.add_argument("--latency_batches", type=int, default = 200)
+    cli_parser.add_argument("--threads", type=int, default = 1)
+
+    cli_args = cli_parser.parse_args()
+
+    main(cli_args)
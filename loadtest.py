@@ -0,0 +1,268 @@
+import argparse
+import collections
+import itertools
+import json
+import logging
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+from attrdict import AttrDict
+import numpy as np
+
+from datasets import get_data_path, iter_shard, list_shards
+from model import *
+from score import load_scoring_model, open_cache
+
+from src import (
+    init_logger,
+    resolve_model_link
+)
+
+from transformers import AutoTokenizer
+
+logger = logging.getLogger(__name__)
+
+
+class BatchingPredictor(object):
+    # in-process serving path: requests queue up and one worker thread takes whatever arrived within
+    # max_wait_ms (at most max_batch_size), tokenizes and predicts it as one batch. a request's latency
+    # covers queueing, batching, tokenization and the forward pass. with a cache, hits are answered in
+    # submit() and never reach the queue
+    def __init__(self, model, tokenizer, maxlen, device, max_batch_size, max_wait_ms, cache=None):
+        self.model = model
+        self.cache = cache
+        self.tokenizer = tokenizer
+        self.maxlen = maxlen
+        self.device = device
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.requests = queue.Queue()
+        self.batch_sizes = collections.Counter()
+        self.running = True
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def submit(self, text):
+        future = Future()
+        future.start = time.perf_counter()
+        logits = self.cache.get(text) if self.cache is not None else None
+        if logits is not None:
+            future.end = time.perf_counter()
+            future.set_result(int(logits.argmax()))
+            return future
+        self.requests.put((text, future))
+        return future
+
+    def run(self):
+        while self.running:
+            try:
+                batch = [self.requests.get(timeout=0.1)]
+            except queue.Empty:
+                continue
+            deadline = time.perf_counter() + self.max_wait
+            while len(batch) < self.max_batch_size:
+                timeout = deadline - time.perf_counter()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(self.requests.get(timeout=timeout))
+                except queue.Empty:
+                    break
+
+            data = self.tokenizer([text for text, _ in batch], padding="longest", max_length=self.maxlen,
+                                  truncation=True, return_tensors="pt")
+            data = {k: v.to(self.device) for k, v in data.items()}
+            with torch.no_grad():
+                logits = self.model.predict(data["input_ids"], data["attention_mask"], data.get("token_type_ids"))[0]
+            preds = logits.argmax(dim=-1).tolist()
+            if self.cache is not None:
+                for (text, _), row in zip(batch, logits.float().cpu().numpy()):
+                    self.cache.put(text, row)
+            self.batch_sizes[len(batch)] += 1
+            end = time.perf_counter()
+            for (_, future), pred in zip(batch, preds):
+                future.end = end
+                future.set_result(pred)
+
+    def reset(self):
+        self.batch_sizes = collections.Counter()
+        if self.cache is not None:
+            self.cache.reset_stats()
+
+    def close(self):
+        self.running = False
+        self.thread.join()
+
+
+def open_loop(predictor, texts, rate, duration, offsets=None):
+    # requests go out on schedule whether or not earlier ones finished: constant rate, or the recorded
+    # trace offsets when given
+    futures = []
+    start = time.perf_counter()
+    schedule = offsets if offsets is not None else (i / rate for i in itertools.count())
+    for text, at in zip(itertools.cycle(texts), schedule):
+        if at > duration:
+            break
+        delay = start + at - time.perf_counter()
+        if delay > 0:
+            time.sleep(delay)
+        futures.append(predictor.submit(text))
+    for future in futures:
+        future.result()
+    return [f.end - f.start for f in futures], time.perf_counter() - start
+
+
+def closed_loop(predictor, texts, concurrency, duration):
+    # concurrency clients, each sends its next request as soon as the previous one returns
+    latencies = []
+    lock = threading.Lock()
+    start = time.perf_counter()
+
+    def client(worker):
+        for text in itertools.islice(itertools.cycle(texts), worker, None, concurrency):
+            if time.perf_counter() - start > duration:
+                break
+            future = predictor.submit(text)
+            future.result()
+            with lock:
+                latencies.append(future.end - future.start)
+
+    clients = [threading.Thread(target=client, args=(w,)) for w in range(concurrency)]
+    for c in clients:
+        c.start()
+    for c in clients:
+        c.join()
+    return latencies, time.perf_counter() - start
+
+
+def summarize(latencies, elapsed, batch_sizes, edges):
+    latencies = np.array(latencies) * 1000
+    counts, _ = np.histogram(latencies, bins=edges)
+    return {
+        "requests": len(latencies),
+        "throughput": len(latencies) / elapsed,
+        "latency_ms": {
+            "mean": float(latencies.mean()),
+            "p50": float(np.percentile(latencies, 50)),
+            "p90": float(np.percentile(latencies, 90)),
+            "p99": float(np.percentile(latencies, 99)),
+            "max": float(latencies.max())
+        },
+        "histogram": {"edges_ms": edges.tolist(), "counts": counts.tolist()},
+        "batch_sizes": {str(k): v for k, v in sorted(batch_sizes.items())}
+    }
+
+
+def load_texts(args, cli_args):
+    texts = []
+    for shard in list_shards(get_data_path(args, cli_args.split)):
+        for (txt,) in iter_shard(shard, columns=("data",)):
+            texts.append(str(txt))
+            if len(texts) >= cli_args.max_texts:
+                return texts
+    return texts
+
+
+def load_trace(path):
+    # one json object per line: {"offset_ms": ..., "text": ...}, offsets relative to the first request
+    texts, offsets = [], []
+    with open(path) as fp:
+        for line in fp:
+            if line.strip():
+                record = json.loads(line)
+                texts.append(record["text"])
+                offsets.append(record["offset_ms"] / 1000)
+    return texts, offsets
+
+
+def main(cli_args):
+    with open(os.path.join(cli_args.config_dir, cli_args.config_file)) as f:
+        args = AttrDict(json.load(f))
+    init_logger()
+    if cli_args.threads > 0:
+        torch.set_num_threads(cli_args.threads)
+    args.device = "cuda:{}".format(cli_args.gpu) if torch.cuda.is_available() and not args.no_cuda else "cpu"
+    args.train_file = os.path.join(cli_args.dataset, args.train_file)
+    args.dev_file = os.path.join(cli_args.dataset, args.dev_file)
+    args.test_file = os.path.join(cli_args.dataset, args.test_file)
+
+    model_link = resolve_model_link(cli_args.transformer_mode, args.get("model_registry"))
+    tokenizer = AutoTokenizer.from_pretrained(model_link)
+    model = load_scoring_model(args, cli_args, model_link)
+    cache = open_cache(args, cli_args)
+
+    offsets = None
+    if cli_args.trace:
+        texts, offsets = load_trace(cli_args.trace)
+    else:
+        texts = load_texts(args, cli_args)
+    predictor = BatchingPredictor(model, tokenizer, args.max_seq_len, args.device,
+                                  cli_args.max_batch_size, cli_args.max_wait_ms, cache)
+    edges = np.logspace(-1, 4, 51)
+
+    # warmup, so the first scenario does not pay for lazy initialization
+    for text in texts[:cli_args.max_batch_size]:
+        predictor.submit(text).result()
+
+    scenarios = []
+    runs = [("trace", cli_args.trace_speed)] if offsets is not None else []
+    runs += [("open", rate) for rate in cli_args.rates] + [("closed", c) for c in cli_args.concurrency]
+    for mode, level in runs:
+        predictor.reset()
+        if mode == "trace":
+            latencies, elapsed = open_loop(predictor, texts, None, cli_args.duration, [o / level for o in offsets])
+        elif mode == "open":
+            latencies, elapsed = open_loop(predictor, texts, level, cli_args.duration)
+        else:
+            latencies, elapsed = closed_loop(predictor, texts, level, cli_args.duration)
+        result = summarize(latencies, elapsed, predictor.batch_sizes, edges)
+        result.update({"mode": mode, "level": level})
+        if cache is not None:
+            result["cache"] = cache.stats()
+        scenarios.append(result)
+        logger.info("  {} {}: {:.1f} req/s, p50 {:.1f} ms, p99 {:.1f} ms{}".format(
+            mode, level, result["throughput"], result["latency_ms"]["p50"], result["latency_ms"]["p99"],
+            ", cache hit rate {:.1%}".format(result["cache"]["hit_rate"]) if cache is not None else ""))
+    predictor.close()
+    if cache is not None:
+        cache.save()
+
+    output = cli_args.output or os.path.join("ckpt", cli_args.result_dir, "loadtest.json")
+    with open(output, "w") as fp:
+        json.dump({"model_mode": cli_args.model_mode, "device": args.device, "threads": torch.get_num_threads(),
+                   "max_batch_size": cli_args.max_batch_size, "max_wait_ms": cli_args.max_wait_ms,
+                   "cache_mb": cli_args.cache_mb,
+                   "scenarios": scenarios}, fp, indent=2)
+    logger.info("Saving load test results to {}".format(output))
+
+
+if __name__ == '__main__':
+    cli_parser = argparse.ArgumentParser()
+
+    cli_parser.add_argument("--config_dir", type=str, default="config")
+    cli_parser.add_argument("--config_file", type=str, default="koelectra-base.json")
+    cli_parser.add_argument("--dataset", type=str, required=True)
+    cli_parser.add_argument("--result_dir", type=str, required=True)
+    cli_parser.add_argument("--model_mode", type=str, required=True, choices=MODEL_LIST.keys())
+    cli_parser.add_argument("--transformer_mode", type=str, required=True)
+    cli_parser.add_argument("--split", type=str, default="test", choices=["train", "dev", "test"])
+    cli_parser.add_argument("--max_texts", type=int, default = 10000)
+    cli_parser.add_argument("--trace", type=str, default=None)
+    cli_parser.add_argument("--trace_speed", type=float, default = 1.0)
+    cli_parser.add_argument("--rates", type=float, nargs="*", default=[10, 50, 100])
+    cli_parser.add_argument("--concurrency", type=int, nargs="*", default=[1, 4, 16])
+    cli_parser.add_argument("--duration", type=float, default = 30)
+    cli_parser.add_argument("--max_batch_size", type=int, default = 32)
+    cli_parser.add_argument("--max_wait_ms", type=float, default = 5)
+    cli_parser.add_argument("--threads", type=int, default = 0)
+    cli_parser.add_argument("--cache_mb", type=float, default = 0)
+    cli_parser.add_argument("--cache_file", type=str, default=None)
+    cli_parser.add_argument("--gpu", type=str, default = 0)
+    cli_parser.add_argument("--output", type=str, default=None)
+
+    cli_args = cli_parser.parse_args()
+
+    main(cli_args)
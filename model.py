@@ -1,17 +1,167 @@
+import logging
+import os
+import re
+
 import torch
 import torch.nn.functional as F
 from torch import nn
 
 from src import (
-    MODEL_ORIGINER
+    has_mmap_weights,
+    load_mmap_weights
 )
-from transformers import AutoModel
+from transformers import AutoConfig, AutoModel
+
+logger = logging.getLogger(__name__)
+
+
+def label_similarity(embs, star_emb):
+    # cosine similarity of every CLS embedding against every label representation vector
+    return torch.mm(F.normalize(embs, dim=-1), F.normalize(star_emb.weight, dim=-1).t())
+
+
+def load_encoder(transformers_mode, config):
+    # when a full checkpoint is restored right after construction the pretrained weights would only be
+    # overwritten, so just build the architecture from the config
+    if getattr(config, "skip_pretrained", False):
+        return AutoModel.from_config(config)
+    if os.path.isdir(transformers_mode) and has_mmap_weights(transformers_mode):
+        return load_mmap_weights(AutoModel.from_config(config), transformers_mode)
+    return AutoModel.from_pretrained(transformers_mode)
+
+
+def get_module(root, name):
+    # submodule at a dotted path, nn.Module.get_submodule only exists from torch 1.9
+    for attr in name.split(".") if name else []:
+        root = getattr(root, attr)
+    return root
+
+
+# where each encoder architecture keeps its stack of transformer layers. albert shares one set of weights
+# across all layers, so it has no per-layer modules to freeze or exit from
+ENCODER_LAYERS = {
+    "bert": "encoder.layer",
+    "electra": "encoder.layer",
+    "roberta": "encoder.layer",
+    "xlm-roberta": "encoder.layer",
+    "distilbert": "transformer.layer",
+    "t5": "encoder.block",
+    "gpt2": "h",
+    "xlnet": "layer"
+}
+
+
+def encoder_layers(encoder):
+    model_type = getattr(encoder.config, "model_type", None)
+    if model_type not in ENCODER_LAYERS:
+        raise ValueError("Per-layer access is not supported for {} encoders, only for {}".format(
+            model_type, ", ".join(sorted(ENCODER_LAYERS))))
+    return get_module(encoder, ENCODER_LAYERS[model_type])
+
+
+def pairwise_cosine_loss(embs, labels, margin, block_size=64):
+    # type: (Tensor, Tensor, float, int) -> Tensor
+    # same as CosineEmbeddingLoss(margin) averaged over all batch_size x batch_size pairs with
+    # y = +1 for same label and -1 otherwise, but only a block_size x batch_size slice of the
+    # similarity matrix is alive at a time instead of two expanded batch x batch x dim copies
+    batch_size = embs.shape[0]
+    normed = F.normalize(embs, dim=-1)
+    loss = embs.new_zeros([])
+    for start in range(0, batch_size, block_size):
+        sim = torch.mm(normed[start:start + block_size], normed.t())
+        same = labels[start:start + block_size].unsqueeze(1) == labels.unsqueeze(0)
+        loss = loss + torch.where(same, 1 - sim, (sim - margin).clamp(min=0)).sum()
+    return loss / (batch_size * batch_size)
+
+
+def pair_loss(embs, labels, margin, positive, mining="all", k=8):
+    # type: (Tensor, Tensor, float, bool, str, int) -> Tensor
+    # the AM (positive=True) and ANN pairwise terms from one batch x batch similarity matrix. per anchor the
+    # mean of 1 - cos over its same-label pairs, or of max(0, cos - margin) over its different-label pairs,
+    # then the mean over anchors that have such pairs. "hard" mining keeps only each anchor's k costliest
+    # pairs that still cost something, "semi_hard" the k cheapest such ones (just inside the margin), so
+    # satisfied pairs and outliers stop taking part
+    normed = F.normalize(embs, dim=-1)
+    sim = torch.mm(normed, normed.t())
+    same = labels.unsqueeze(1) == labels.unsqueeze(0)
+    valid = same if positive else ~same
+    if positive and mining != "all":
+        # an anchor paired with itself costs nothing, it must not take one of the k slots
+        valid = valid & ~torch.eye(embs.shape[0], dtype=torch.bool, device=embs.device)
+    cost = 1 - sim if positive else (sim - margin).clamp(min=0)
+    if mining == "all":
+        selected = valid
+    else:
+        if mining == "hard":
+            # zero cost pairs must not fill up the k slots and dilute the mean once few pairs violate
+            score = cost.masked_fill(~valid | (cost <= 0), -1)
+        else:
+            score = (-cost).masked_fill(~valid | (cost <= 0), float("-inf"))
+        top, idx = score.topk(min(k, embs.shape[0]), dim=1)
+        selected = torch.zeros_like(valid).scatter(1, idx, top > (-1.0 if mining == "hard" else float("-inf")))
+    # masked mean over anchors instead of indexing, which would read the mask back to the host every step
+    anchors = valid.any(dim=1).to(cost.dtype)
+    per_anchor = (cost * selected).sum(dim=1) / selected.sum(dim=1).clamp(min=1)
+    return (per_anchor * anchors).sum() / anchors.sum().clamp(min=1)
+
+
+def dense_gelu_dropout(features, weight, bias, p, training):
+    # type: (Tensor, Tensor, Tensor, float, bool) -> Tensor
+    # the dense -> gelu -> dropout head as one function of the weights, so it can be scripted
+    return F.dropout(F.gelu(F.linear(features, weight, bias)), p, training)
+
+
+def head_loss(model, features, labels):
+    # cross entropy over out_proj. with config.num_sampled > 0 training only scores the batch's own labels
+    # plus num_sampled uniformly drawn ones, so step cost does not grow with the size of the label space
+    if model.training and model.num_sampled > 0:
+        candidates = torch.cat([labels, torch.randint(model.labelNumber, (model.num_sampled,), device=labels.device)])
+        label_set, targets = torch.unique(candidates, return_inverse=True)
+        targets = targets[:labels.shape[0]]
+        logits = F.linear(features, model.out_proj.weight[label_set], model.out_proj.bias[label_set])
+        return F.cross_entropy(logits, targets), logits, label_set
+    logits = model.out_proj(features)
+    return F.cross_entropy(logits.view(-1, model.labelNumber), labels.view(-1)), logits, None
+
+
+def prototype_loss(model, embs, labels, label_set, loss_fn):
+    if label_set is None:
+        star = model.star_emb(labels)
+        return loss_fn(embs, star, torch.ones(embs.shape[0]).to(model.config.device))
+
+    # sampled mode: pull every embedding to its own label vector and push it below the margin from the
+    # other sampled ones. only the sampled rows of star_emb are looked up (and get a sparse gradient)
+    protos = F.normalize(model.star_emb(label_set), dim=-1)
+    sims = torch.mm(F.normalize(embs, dim=-1), protos.t())
+    positive = label_set.unsqueeze(0) == labels.unsqueeze(1)
+    negative = (sims - model.margin).clamp(min=0)[~positive]
+    return (1 - sims[positive]).mean() + (negative.mean() if negative.numel() > 0 else 0)
+
+
+def cls_embeddings(hidden_states, cls_index=None):
+    # with sequence packing every example's CLS token sits at its own flat position of the packed rows
+    if cls_index is None:
+        return hidden_states[:, 0, :]
+    return hidden_states.reshape(-1, hidden_states.shape[-1]).index_select(0, cls_index)
+
+
+def inference_result(model, logits, embs, return_embs=False, return_sims=False):
+    result = (logits,)
+    if return_embs:
+        result += (embs,)
+    if return_sims:
+        result += (label_similarity(embs, model.star_emb) if hasattr(model, "star_emb") else None,)
+    return result
+
 
 class BaseModel(nn.Module):
+    # predict() is shared by every MODEL_LIST model: encoder -> pool() -> head() -> out_proj.
+    # a subclass only overrides pool() (which vectors feed the head and which are the CLS embeddings)
+    # and its forward() losses
     def __init__(self, transformers_mode, model_type, model_name_or_path, config, labelNumber, margin=-0.5):
         super(BaseModel, self).__init__()
         self.transformers_mode = transformers_mode
-        self.emb = AutoModel.from_pretrained(self.transformers_mode)
+        self.emb = load_encoder(self.transformers_mode, config)
         self.dense = nn.Linear(768, 768)
         self.dropout = nn.Dropout(0.2)
         self.out_proj = nn.Linear(768, labelNumber)
@@ -20,312 +170,199 @@ class BaseModel(nn.Module):
         self.tanh = nn.Tanh()
         self.labelNumber = labelNumber
         self.margin = margin
+        self.num_sampled = getattr(config, "num_sampled", 0)
+        # plain functions, compile_model swaps in TorchScript versions on torch builds without torch.compile
+        self.head_fn = dense_gelu_dropout
+        self.pair_loss = pair_loss
+        self.pairwise_cosine_loss = pairwise_cosine_loss
 
-    def forward(self, input_ids, attention_mask, labels, token_type_ids):
+    def encode(self, input_ids, attention_mask, token_type_ids=None, position_ids=None):
         if token_type_ids is None:
-            outputs = self.emb(input_ids=input_ids, attention_mask=attention_mask)
+            outputs = self.emb(input_ids=input_ids, attention_mask=attention_mask, position_ids=position_ids)
         else:
-            outputs = self.emb(input_ids=input_ids, attention_mask=attention_mask, token_type_ids=token_type_ids)
-        embs = outputs[0][:, 0, :].squeeze()
+            outputs = self.emb(input_ids=input_ids, attention_mask=attention_mask, token_type_ids=token_type_ids,
+                               position_ids=position_ids)
+        return outputs[0]
+
+    def pool(self, hidden_states, attention_mask, cls_index=None):
+        # (head input, CLS embeddings), the CLS vector is both by default
+        embs = cls_embeddings(hidden_states, cls_index)
+        return embs, embs
+
+    def head(self, pooled):
+        return self.head_fn(pooled, self.dense.weight, self.dense.bias, self.dropout.p, self.training)
 
-        outputs = self.dense(embs)
-        outputs = self.gelu(outputs)
-        outputs = self.dropout(outputs)
-        outputs = self.out_proj(outputs)
+    def features(self, input_ids, attention_mask, token_type_ids=None, position_ids=None, cls_index=None):
+        hidden_states = self.encode(input_ids, attention_mask, token_type_ids, position_ids)
+        pooled, embs = self.pool(hidden_states, attention_mask, cls_index)
+        return self.head(pooled), embs
 
-        loss_fct = nn.CrossEntropyLoss()
-        loss1 = loss_fct(outputs.view(-1, self.labelNumber), labels.view(-1))
+    def predict(self, input_ids, attention_mask, token_type_ids=None, return_embs=False, return_sims=False,
+                position_ids=None, cls_index=None):
+        outputs, embs = self.features(input_ids, attention_mask, token_type_ids, position_ids, cls_index)
+        return inference_result(self, self.out_proj(outputs), embs, return_embs, return_sims)
+
+    def forward(self, input_ids, attention_mask, labels=None, token_type_ids=None, position_ids=None, cls_index=None):
+        if labels is None:
+            return (None,) + self.predict(input_ids, attention_mask, token_type_ids, return_embs=True,
+                                          position_ids=position_ids, cls_index=cls_index)
+
+        outputs, embs = self.features(input_ids, attention_mask, token_type_ids, position_ids, cls_index)
+        loss1, outputs, label_set = head_loss(self, outputs, labels)
 
         result = (loss1, outputs, embs)
 
         return result
 
 
-class Star_Label_AM(nn.Module):
+class Star_Label_AM(BaseModel):
     def __init__(self, transformers_mode, model_type, model_name_or_path, config, labelNumber, margin=-0.5):
-        super(Star_Label_AM, self).__init__()
-        self.transformers_mode = transformers_mode
-        self.emb = AutoModel.from_pretrained(self.transformers_mode)
-        self.dense = nn.Linear(768, 768)
-        self.dropout = nn.Dropout(0.2)
-        self.out_proj = nn.Linear(768, labelNumber)
-        self.star_emb = nn.Embedding(labelNumber, 768)
-        self.config = config
-        self.gelu = nn.GELU()
-        self.tanh = nn.Tanh()
-        self.labelNumber = labelNumber
-        self.margin = margin
-
-    def forward(self, input_ids, attention_mask, labels, token_type_ids):
-        if token_type_ids is None:
-            outputs = self.emb(input_ids=input_ids, attention_mask=attention_mask)
-        else:
-            outputs = self.emb(input_ids=input_ids, attention_mask=attention_mask, token_type_ids=token_type_ids)
-        embs = outputs[0]
-        batch_size, seq_len, w2v_dim = embs.shape
-        embs = outputs[0][:, 0, :].squeeze()
-
-        outputs = self.dense(embs)
-        outputs = self.gelu(outputs)
-        outputs = self.dropout(outputs)
-        outputs = self.out_proj(outputs)
-        #print(outputs)
-        #print(torch.argmax(outputs, axis=1))
-        #print(labels)
-        #print((torch.argmax(outputs, axis=1) == labels).float().mean())
-
-        loss_fct = nn.CrossEntropyLoss()
-        loss1 = loss_fct(outputs.view(-1, self.labelNumber), labels.view(-1))
+        super(Star_Label_AM, self).__init__(transformers_mode, model_type, model_name_or_path, config, labelNumber,
+                                            margin)
+        self.star_emb = nn.Embedding(labelNumber, 768, sparse=getattr(config, "sparse_star_emb", False))
+        self.pair_mining = getattr(config, "pair_mining", "all")
+        self.mining_k = getattr(config, "mining_k", 8)
+        self.loss_weights = getattr(config, "loss_weights", [0.5, 0.5])
+
+    def forward(self, input_ids, attention_mask, labels=None, token_type_ids=None, position_ids=None, cls_index=None):
+        if labels is None:
+            return (None,) + self.predict(input_ids, attention_mask, token_type_ids, return_embs=True,
+                                          position_ids=position_ids, cls_index=cls_index)
+
+        outputs, embs = self.features(input_ids, attention_mask, token_type_ids, position_ids, cls_index)
+        loss1, outputs, label_set = head_loss(self, outputs, labels)
         loss_fn = torch.nn.CosineEmbeddingLoss(reduction='mean', margin=self.margin)
-        loss2s = []
-        for i in range(batch_size):
-            diff_indexs = labels == labels[i].repeat(batch_size)
-            diff_label_datas = embs[diff_indexs, :].squeeze()
-            stretch_ori_datas = embs[i, :].repeat(sum(diff_indexs),1)
-            loss2s.append(loss_fn(diff_label_datas.view(-1, w2v_dim),
-                        stretch_ori_datas.view(-1, w2v_dim),
-                        torch.ones(sum(diff_indexs)).to(self.config.device)))
-
-        loss2 = sum(loss2s)/len(loss2s)
+        loss2 = self.pair_loss(embs, labels, self.margin, True, self.pair_mining, self.mining_k)
 
         #calculate loss with same label's represntation vector
-        star = self.star_emb(labels)
+        loss3 = prototype_loss(self, embs, labels, label_set, loss_fn)
 
-        loss3 = loss_fn(embs,
-                        star,
-                        torch.ones(batch_size).to(self.config.device))
-
-        result = ((loss1, 0.5 * loss2, 0.5 * loss3), outputs, embs)
+        result = ((loss1, self.loss_weights[0] * loss2, self.loss_weights[1] * loss3), outputs, embs)
 
         return result
 
-class AM(nn.Module):
+class AM(BaseModel):
     def __init__(self, transformers_mode, model_type, model_name_or_path, config, labelNumber, margin=-0.5):
-        super(AM, self).__init__()
-        self.transformers_mode = transformers_mode
-        self.emb = AutoModel.from_pretrained(self.transformers_mode)
-        self.dense = nn.Linear(768, 768)
-        self.dropout = nn.Dropout(0.2)
-        self.out_proj = nn.Linear(768, labelNumber)
-        self.star_emb = nn.Embedding(labelNumber, 768)
-        self.config = config
-        self.gelu = nn.GELU()
-        self.tanh = nn.Tanh()
-        self.labelNumber = labelNumber
-        self.margin = margin
+        super(AM, self).__init__(transformers_mode, model_type, model_name_or_path, config, labelNumber, margin)
+        self.star_emb = nn.Embedding(labelNumber, 768, sparse=getattr(config, "sparse_star_emb", False))
+        self.pair_mining = getattr(config, "pair_mining", "all")
+        self.mining_k = getattr(config, "mining_k", 8)
 
-    def forward(self, input_ids, attention_mask, labels, token_type_ids):
-        if token_type_ids is None:
-            outputs = self.emb(input_ids=input_ids, attention_mask=attention_mask)
-        else:
-            outputs = self.emb(input_ids=input_ids, attention_mask=attention_mask, token_type_ids=token_type_ids)
-        embs = outputs[0]
-        batch_size, seq_len, w2v_dim = embs.shape
-        embs = outputs[0][:, 0, :].squeeze()
-
-        outputs = self.dense(embs)
-        outputs = self.gelu(outputs)
-        outputs = self.dropout(outputs)
-        outputs = self.out_proj(outputs)
-        #print(outputs)
-        #print(torch.argmax(outputs, axis=1))
-        #print(labels)
-        #print((torch.argmax(outputs, axis=1) == labels).float().mean())
-
-        loss_fct = nn.CrossEntropyLoss()
-        loss1 = loss_fct(outputs.view(-1, self.labelNumber), labels.view(-1))
-        loss_fn = torch.nn.CosineEmbeddingLoss(reduction='mean', margin=self.margin)
-        loss2s = []
-        for i in range(batch_size):
-            diff_indexs = labels == labels[i].repeat(batch_size)
-            diff_label_datas = embs[diff_indexs, :].squeeze()
-            stretch_ori_datas = embs[i, :].repeat(sum(diff_indexs),1)
-            loss2s.append(loss_fn(diff_label_datas.view(-1, w2v_dim),
-                        stretch_ori_datas.view(-1, w2v_dim),
-                        torch.ones(sum(diff_indexs)).to(self.config.device)))
+    def forward(self, input_ids, attention_mask, labels=None, token_type_ids=None, position_ids=None, cls_index=None):
+        if labels is None:
+            return (None,) + self.predict(input_ids, attention_mask, token_type_ids, return_embs=True,
+                                          position_ids=position_ids, cls_index=cls_index)
 
-        loss2 = sum(loss2s)/len(loss2s)
+        outputs, embs = self.features(input_ids, attention_mask, token_type_ids, position_ids, cls_index)
+        loss1, outputs, label_set = head_loss(self, outputs, labels)
+        loss2 = self.pair_loss(embs, labels, self.margin, True, self.pair_mining, self.mining_k)
 
         result = ((loss1, loss2), outputs, embs)
 
         return result
 
-class Star_Label_AM_att(nn.Module):
-    def __init__(self, model_type, model_name_or_path, config, margin=-0.5):
-        super(Star_Label_AM_att, self).__init__()
-        self.emb = MODEL_ORIGINER[model_type].from_pretrained(
-            model_name_or_path,
-            config=config)
-        self.dense = nn.Linear(768, 768)
-        self.dropout = nn.Dropout(0.2)
-        self.out_proj = nn.Linear(768, 2)
-        self.lstm = nn.LSTM(768,768)
-        self.star_emb = nn.Embedding(2, 768)
-        self.config = config
-        self.gelu = nn.GELU()
-        self.tanh = nn.Tanh()
+class Star_Label_AM_att(BaseModel):
+    def __init__(self, transformers_mode, model_type, model_name_or_path, config, labelNumber, margin=-0.5):
+        super(Star_Label_AM_att, self).__init__(transformers_mode, model_type, model_name_or_path, config,
+                                                labelNumber, margin)
+        self.bidirectional = getattr(config, "lstm_bidirectional", False)
+        # a bidirectional lstm keeps the pooled size at 768 by splitting it over both directions
+        self.lstm = nn.LSTM(768, 768 // 2 if self.bidirectional else 768,
+                            batch_first=True, bidirectional=self.bidirectional)
+        self.star_emb = nn.Embedding(labelNumber, 768, sparse=getattr(config, "sparse_star_emb", False))
         self.att_w = nn.Parameter(torch.randn(1, 768, 1))
-        self.margin = margin
+        self.pair_mining = getattr(config, "pair_mining", "all")
+        self.mining_k = getattr(config, "mining_k", 8)
+        self.loss_weights = getattr(config, "loss_weights", [0.5, 0.5])
 
-    def attention_net(self, lstm_output, input):
-        batch_size, seq_len = input.shape
+    def attention_net(self, lstm_output, attention_mask):
+        batch_size, seq_len, _ = lstm_output.shape
 
         att = torch.bmm(torch.tanh(lstm_output),
-                        self.att_w.repeat(batch_size, 1, 1))
+                        self.att_w.expand(batch_size, -1, -1))
+        att = att.masked_fill(attention_mask[:, :seq_len].unsqueeze(2) == 0, float("-inf"))
         att = F.softmax(att, dim=1)  # att(batch_size, seq_len, 1)
         att = torch.bmm(lstm_output.transpose(1, 2), att).squeeze(2)
         attn_output = torch.tanh(att)  # attn_output(batch_size, lstm_dir_dim)
         return attn_output
 
-    def forward(self, input_ids, attention_mask, labels, token_type_ids):
-        # print(input_ids)
-        if token_type_ids is None:
-            outputs = self.emb(input_ids=input_ids, attention_mask=attention_mask)
-        else:
-            outputs = self.emb(input_ids=input_ids, attention_mask=attention_mask, token_type_ids=token_type_ids)
-        embs = outputs[0]
-        batch_size, seq_len, w2v_dim = embs.shape
-
-        outputs, _ = self.lstm(embs)
-        outputs = self.attention_net(outputs,input_ids)
-        outputs = self.dense(outputs)
-        outputs = self.gelu(outputs)
-        outputs = self.dropout(outputs)
-        outputs = self.out_proj(outputs)
-
-        loss_fct = nn.CrossEntropyLoss()
-        loss1 = loss_fct(outputs.view(-1, 2), labels.view(-1))
-
-        #make 2 data for match all2all data
-        x1 = embs
-        x1 = x1.repeat(1, batch_size)
-        x1 = x1.view(batch_size, batch_size, w2v_dim)
-        x2 = embs
-        x2 = x2.unsqueeze(0)
-        x2 = x2.repeat(batch_size, 1, 1)
-        y = labels.unsqueeze(0).repeat(batch_size, 1).type(torch.FloatTensor).to(self.config.device)
-        for i, t in enumerate(y):
-            y[i] = (t == t[i]).double() * 2 - 1
+    def lstm_pool(self, hidden_states, attention_mask):
+        # run the lstm only over the real tokens of every sentence, not up to max_seq_len
+        lengths = attention_mask.sum(dim=1).clamp(min=1).cpu()
+        packed = nn.utils.rnn.pack_padded_sequence(hidden_states, lengths, batch_first=True, enforce_sorted=False)
+        outputs, _ = self.lstm(packed)
+        outputs, _ = nn.utils.rnn.pad_packed_sequence(outputs, batch_first=True)
+        return self.attention_net(outputs, attention_mask)
+
+    def pool(self, hidden_states, attention_mask, cls_index=None):
+        # the head reads the lstm attention pooling, the pair and label vector losses the CLS vector.
+        # sequence packing is rejected for this model, so cls_index is always None here
+        return self.lstm_pool(hidden_states, attention_mask), hidden_states[:, 0, :]
+
+    def forward(self, input_ids, attention_mask, labels=None, token_type_ids=None, position_ids=None, cls_index=None):
+        if labels is None:
+            return (None,) + self.predict(input_ids, attention_mask, token_type_ids, return_embs=True,
+                                          position_ids=position_ids, cls_index=cls_index)
+
+        outputs, embs = self.features(input_ids, attention_mask, token_type_ids, position_ids, cls_index)
+        loss1, outputs, label_set = head_loss(self, outputs, labels)
+
+        #all2all loss over every (i, j) pair, read off the similarity matrix block by block
         loss_fn = torch.nn.CosineEmbeddingLoss(reduction='mean', margin=self.margin)
-        loss2 = loss_fn(x1.view(-1, w2v_dim),
-                        x2.view(-1, w2v_dim),
-                        y.view(-1))
+        if self.pair_mining == "all":
+            loss2 = self.pairwise_cosine_loss(embs, labels, self.margin)
+        else:
+            loss2 = (self.pair_loss(embs, labels, self.margin, True, self.pair_mining, self.mining_k) +
+                     self.pair_loss(embs, labels, self.margin, False, self.pair_mining, self.mining_k)) / 2
 
         #calculate loss with same label's represntation vector
-        star = self.star_emb(labels)
+        loss3 = prototype_loss(self, embs, labels, label_set, loss_fn)
 
-        loss3 = loss_fn(embs,
-                        star,
-                        torch.ones(batch_size).to(self.config.device))
-
-        result = ((loss1, 0.5 * loss2, 0.5 * loss3), outputs, embs)
+        result = ((loss1, self.loss_weights[0] * loss2, self.loss_weights[1] * loss3), outputs, embs)
 
         return result
 
-class Star_Label_ANN(nn.Module):
+class Star_Label_ANN(BaseModel):
     def __init__(self, transformers_mode, model_type, model_name_or_path, config, labelNumber, margin=-0.5):
-        super(Star_Label_ANN, self).__init__()
-        self.transformers_mode = transformers_mode
-        self.emb = AutoModel.from_pretrained(self.transformers_mode)
-        self.dense = nn.Linear(768, 768)
-        self.dropout = nn.Dropout(0.2)
-        self.out_proj = nn.Linear(768, labelNumber)
-        self.star_emb = nn.Embedding(labelNumber, 768)
-        self.config = config
-        self.gelu = nn.GELU()
-        self.tanh = nn.Tanh()
-        self.labelNumber = labelNumber
-        self.margin = margin
-
-    def forward(self, input_ids, attention_mask, labels, token_type_ids):
-        if token_type_ids is None:
-            outputs = self.emb(input_ids=input_ids, attention_mask=attention_mask)
-        else:
-            outputs = self.emb(input_ids=input_ids, attention_mask=attention_mask, token_type_ids=token_type_ids)
-        embs = outputs[0]
-        batch_size, seq_len, w2v_dim = embs.shape
-        embs = outputs[0][:, 0, :].squeeze()
-
-        outputs = self.dense(embs)
-        outputs = self.gelu(outputs)
-        outputs = self.dropout(outputs)
-        outputs = self.out_proj(outputs)
-        #print(outputs)
-        #print(torch.argmax(outputs, axis=1))
-        #print(labels)
-        #print((torch.argmax(outputs, axis=1) == labels).float().mean())
-
-        loss_fct = nn.CrossEntropyLoss()
-        loss1 = loss_fct(outputs.view(-1, self.labelNumber), labels.view(-1))
+        super(Star_Label_ANN, self).__init__(transformers_mode, model_type, model_name_or_path, config, labelNumber,
+                                             margin)
+        self.star_emb = nn.Embedding(labelNumber, 768, sparse=getattr(config, "sparse_star_emb", False))
+        self.pair_mining = getattr(config, "pair_mining", "all")
+        self.mining_k = getattr(config, "mining_k", 8)
+        self.loss_weights = getattr(config, "loss_weights", [0.5, 0.5])
+
+    def forward(self, input_ids, attention_mask, labels=None, token_type_ids=None, position_ids=None, cls_index=None):
+        if labels is None:
+            return (None,) + self.predict(input_ids, attention_mask, token_type_ids, return_embs=True,
+                                          position_ids=position_ids, cls_index=cls_index)
+
+        outputs, embs = self.features(input_ids, attention_mask, token_type_ids, position_ids, cls_index)
+        loss1, outputs, label_set = head_loss(self, outputs, labels)
         loss_fn = torch.nn.CosineEmbeddingLoss(reduction='mean', margin=self.margin)
-        loss2s = []
-        for i in range(batch_size):
-            diff_indexs = labels != labels[i].repeat(batch_size)
-            diff_label_datas = embs[diff_indexs, :].squeeze()
-            stretch_ori_datas = embs[i, :].repeat(sum(diff_indexs),1)
-            loss2s.append(loss_fn(diff_label_datas.view(-1, w2v_dim),
-                        stretch_ori_datas.view(-1, w2v_dim),
-                        -torch.ones(sum(diff_indexs)).to(self.config.device)))
-
-        loss2 = sum(loss2s)/len(loss2s)
+        loss2 = self.pair_loss(embs, labels, self.margin, False, self.pair_mining, self.mining_k)
 
         #calculate loss with same label's represntation vector
-        star = self.star_emb(labels)
-
-        loss3 = loss_fn(embs,
-                        star,
-                        torch.ones(batch_size).to(self.config.device))
+        loss3 = prototype_loss(self, embs, labels, label_set, loss_fn)
 
-        result = ((loss1, 0.5 * loss2, 0.5 * loss3), outputs, embs)
+        result = ((loss1, self.loss_weights[0] * loss2, self.loss_weights[1] * loss3), outputs, embs)
 
         return result
 
-class ANN(nn.Module):
+class ANN(BaseModel):
     def __init__(self, transformers_mode, model_type, model_name_or_path, config, labelNumber, margin=-0.5):
-        super(ANN, self).__init__()
-        self.transformers_mode = transformers_mode
-        self.emb = AutoModel.from_pretrained(self.transformers_mode)
-        self.dense = nn.Linear(768, 768)
-        self.dropout = nn.Dropout(0.2)
-        self.out_proj = nn.Linear(768, labelNumber)
-        self.star_emb = nn.Embedding(labelNumber, 768)
-        self.config = config
-        self.gelu = nn.GELU()
-        self.tanh = nn.Tanh()
-        self.labelNumber = labelNumber
-        self.margin = margin
+        super(ANN, self).__init__(transformers_mode, model_type, model_name_or_path, config, labelNumber, margin)
+        self.star_emb = nn.Embedding(labelNumber, 768, sparse=getattr(config, "sparse_star_emb", False))
+        self.pair_mining = getattr(config, "pair_mining", "all")
+        self.mining_k = getattr(config, "mining_k", 8)
 
-    def forward(self, input_ids, attention_mask, labels, token_type_ids):
-        if token_type_ids is None:
-            outputs = self.emb(input_ids=input_ids, attention_mask=attention_mask)
-        else:
-            outputs = self.emb(input_ids=input_ids, attention_mask=attention_mask, token_type_ids=token_type_ids)
-        embs = outputs[0]
-        batch_size, seq_len, w2v_dim = embs.shape
-        embs = outputs[0][:, 0, :].squeeze()
-
-        outputs = self.dense(embs)
-        outputs = self.gelu(outputs)
-        outputs = self.dropout(outputs)
-        outputs = self.out_proj(outputs)
-        #print(outputs)
-        #print(torch.argmax(outputs, axis=1))
-        #print(labels)
-        #print((torch.argmax(outputs, axis=1) == labels).float().mean())
-
-        loss_fct = nn.CrossEntropyLoss()
-        loss1 = loss_fct(outputs.view(-1, self.labelNumber), labels.view(-1))
-        loss_fn = torch.nn.CosineEmbeddingLoss(reduction='mean', margin=self.margin)
-        loss2s = []
-        for i in range(batch_size):
-            diff_indexs = labels != labels[i].repeat(batch_size)
-            diff_label_datas = embs[diff_indexs,:].squeeze()
-            stretch_ori_datas = embs[i, :].repeat(sum(diff_indexs),1)
-            loss2s.append(loss_fn(diff_label_datas.view(-1, w2v_dim),
-                        stretch_ori_datas.view(-1, w2v_dim),
-                        -torch.ones(sum(diff_indexs)).to(self.config.device)))
+    def forward(self, input_ids, attention_mask, labels=None, token_type_ids=None, position_ids=None, cls_index=None):
+        if labels is None:
+            return (None,) + self.predict(input_ids, attention_mask, token_type_ids, return_embs=True,
+                                          position_ids=position_ids, cls_index=cls_index)
 
-        loss2 = sum(loss2s)/len(loss2s)
+        outputs, embs = self.features(input_ids, attention_mask, token_type_ids, position_ids, cls_index)
+        loss1, outputs, label_set = head_loss(self, outputs, labels)
+        loss2 = self.pair_loss(embs, labels, self.margin, False, self.pair_mining, self.mining_k)
 
         result = ((loss1, loss2,), outputs, embs)
 
@@ -338,4 +375,327 @@ MODEL_LIST = {
     "Star_Label_ANN" : Star_Label_ANN,
     "Star_Label_AM_att": Star_Label_AM_att,
     "BaseModel": BaseModel
-}
\ No newline at end of file
+}
+
+
+def exit_config(config, args):
+    # copies the early exit settings of the config json onto the model config
+    for key in ("exit_layers", "exit_mode", "exit_train", "exit_threshold", "exit_scale"):
+        if key in args:
+            setattr(config, key, args[key])
+    return config
+
+
+class EarlyExit(nn.Module):
+    # wraps any CLS-based MODEL_LIST model with exits after the encoder layers in config.exit_layers.
+    # an exit is a linear classifier on that layer's CLS vector ("exit_mode": "head") or the scaled cosine
+    # to star_emb ("exit_mode": "star"). predict() runs the encoder one layer at a time and a sentence
+    # leaves at the first exit whose softmax confidence reaches the threshold, the rest go on to the full head
+    def __init__(self, base, config, labelNumber):
+        super(EarlyExit, self).__init__()
+        if isinstance(base, Star_Label_AM_att):
+            raise ValueError("Early exit is not supported for Star_Label_AM_att")
+        # predict() drives the embeddings and every layer module itself, with the bert-style layer signature
+        if ENCODER_LAYERS.get(getattr(base.emb.config, "model_type", None)) != "encoder.layer":
+            raise ValueError("Early exit is only supported for {} encoders, not {}".format(
+                ", ".join(sorted(k for k, v in ENCODER_LAYERS.items() if v == "encoder.layer")),
+                getattr(base.emb.config, "model_type", None)))
+        self.base = base
+        self.exit_layers = sorted(getattr(config, "exit_layers", [3, 6, 9]))
+        self.exit_mode = getattr(config, "exit_mode", "head")
+        self.exit_train = getattr(config, "exit_train", "joint")
+        self.threshold = getattr(config, "exit_threshold", 0.9)
+        self.exit_scale = getattr(config, "exit_scale", 10.0)
+        if self.exit_mode == "star" and not hasattr(base, "star_emb"):
+            raise ValueError("exit_mode star needs a Star_Label model")
+        self.exits = nn.ModuleList(nn.Linear(768, labelNumber) for _ in self.exit_layers) \
+            if self.exit_mode == "head" else None
+        self.labelNumber = labelNumber
+        self.config = config
+        self.last_exit_layers = None
+        # the wrapped model's encoder call also hands back every layer's hidden states to the exits
+        self.base.emb.config.output_hidden_states = True
+        self.hidden_states = None
+        self.base.emb.register_forward_hook(self.keep_hidden_states)
+
+    @property
+    def emb(self):
+        return self.base.emb
+
+    @property
+    def layers(self):
+        return encoder_layers(self.base.emb)
+
+    def keep_hidden_states(self, module, inputs, outputs):
+        # transformers 3.x returns tuples, with output_hidden_states (and no attentions) the hidden states
+        # come last. newer versions return a ModelOutput
+        self.hidden_states = outputs[-1] if type(outputs) == tuple else outputs.hidden_states
+
+    def exit_logits(self, i, embs):
+        if self.exit_mode == "star":
+            return label_similarity(embs, self.base.star_emb) * self.exit_scale
+        return self.exits[i](embs)
+
+    def final_logits(self, embs):
+        return self.base.out_proj(self.base.head(embs))
+
+    def forward(self, input_ids, attention_mask, labels=None, token_type_ids=None, position_ids=None, cls_index=None):
+        if labels is None:
+            return (None,) + self.predict(input_ids, attention_mask, token_type_ids, return_embs=True,
+                                          position_ids=position_ids, cls_index=cls_index)
+
+        # "frozen" fits the exits after the fact on top of an already trained model
+        with torch.set_grad_enabled(self.exit_train != "frozen" and torch.is_grad_enabled()):
+            losses, outputs, embs = self.base(input_ids, attention_mask, labels, token_type_ids,
+                                              position_ids=position_ids, cls_index=cls_index)
+        hidden_states, self.hidden_states = self.hidden_states, None
+        exit_loss = sum(F.cross_entropy(self.exit_logits(i, cls_embeddings(hidden_states[layer], cls_index)), labels)
+                        for i, layer in enumerate(self.exit_layers)) / len(self.exit_layers)
+
+        if self.exit_train == "frozen":
+            return ((exit_loss,), outputs, embs)
+        losses = losses if type(losses) == tuple else (losses,)
+        return (losses + (exit_loss,), outputs, embs)
+
+    def embed(self, input_ids, attention_mask, token_type_ids=None, position_ids=None):
+        emb = self.base.emb
+        hidden = emb.embeddings(input_ids=input_ids, token_type_ids=token_type_ids, position_ids=position_ids)
+        if hasattr(emb, "embeddings_project"):
+            hidden = emb.embeddings_project(hidden)
+        return hidden, emb.get_extended_attention_mask(attention_mask, input_ids.shape)
+
+    def predict(self, input_ids, attention_mask, token_type_ids=None, return_embs=False, return_sims=False,
+                position_ids=None, cls_index=None, threshold=None):
+        # cls_index is accepted for signature parity only, packed rows would have to leave together
+        threshold = self.threshold if threshold is None else threshold
+        hidden, mask = self.embed(input_ids, attention_mask, token_type_ids, position_ids)
+        batch_size = input_ids.shape[0]
+        logits = hidden.new_zeros((batch_size, self.labelNumber))
+        embs = hidden.new_zeros((batch_size, hidden.shape[-1]))
+        exit_layers = torch.full((batch_size,), len(self.layers), dtype=torch.long,
+                                 device=input_ids.device)
+        active = torch.arange(batch_size, device=input_ids.device)
+
+        for layer, module in enumerate(self.layers, start=1):
+            outputs = module(hidden, attention_mask=mask)
+            hidden = outputs[0] if type(outputs) == tuple else outputs
+            if layer not in self.exit_layers:
+                continue
+            cls = hidden[:, 0, :]
+            exit_out = self.exit_logits(self.exit_layers.index(layer), cls)
+            done = F.softmax(exit_out, dim=-1).max(dim=-1)[0] >= threshold
+            if done.any():
+                logits[active[done]] = exit_out[done].to(logits.dtype)
+                embs[active[done]] = cls[done].to(embs.dtype)
+                exit_layers[active[done]] = layer
+                active, hidden, mask = active[~done], hidden[~done], mask[~done]
+            if len(active) == 0:
+                break
+
+        if len(active) > 0:
+            logits[active] = self.final_logits(hidden[:, 0, :]).to(logits.dtype)
+            embs[active] = hidden[:, 0, :].to(embs.dtype)
+        self.last_exit_layers = exit_layers
+        return inference_result(self.base, logits, embs, return_embs, return_sims)
+
+    def predict_all_exits(self, input_ids, attention_mask, token_type_ids=None):
+        # logits of every exit plus the final head for the whole batch, one full encoder pass.
+        # enough to replay any threshold offline without running the encoder again
+        if token_type_ids is None:
+            self.base.emb(input_ids=input_ids, attention_mask=attention_mask)
+        else:
+            self.base.emb(input_ids=input_ids, attention_mask=attention_mask, token_type_ids=token_type_ids)
+        hidden_states, self.hidden_states = self.hidden_states, None
+        logits = [self.exit_logits(i, hidden_states[layer][:, 0, :]) for i, layer in enumerate(self.exit_layers)]
+        logits.append(self.final_logits(hidden_states[-1][:, 0, :]))
+        return logits
+
+
+def grow_labels(model, labelNumber, star_init=None):
+    # widens out_proj, star_emb and any early exits to labelNumber labels. the rows of the labels the
+    # model already knows keep their trained weights, new star_emb rows take star_init when given
+    target = model.base if isinstance(model, EarlyExit) else model
+    old = target.labelNumber
+    if labelNumber <= old:
+        return model
+
+    def grow_linear(linear):
+        grown = nn.Linear(linear.in_features, labelNumber).to(linear.weight.device, linear.weight.dtype)
+        with torch.no_grad():
+            grown.weight[:old] = linear.weight
+            grown.bias[:old] = linear.bias
+        return grown
+
+    target.out_proj = grow_linear(target.out_proj)
+    if hasattr(target, "star_emb"):
+        star_emb = nn.Embedding(labelNumber, target.star_emb.embedding_dim, sparse=target.star_emb.sparse)
+        star_emb.to(target.star_emb.weight.device, target.star_emb.weight.dtype)
+        with torch.no_grad():
+            star_emb.weight[:old] = target.star_emb.weight
+            if star_init is not None:
+                star_emb.weight[old:] = star_init.to(star_emb.weight.dtype)
+        target.star_emb = star_emb
+    target.labelNumber = labelNumber
+    if isinstance(model, EarlyExit):
+        if model.exits is not None:
+            model.exits = nn.ModuleList(grow_linear(e) for e in model.exits)
+        model.labelNumber = labelNumber
+    return model
+
+
+class LoRALinear(nn.Module):
+    # frozen pretrained linear layer plus a trainable rank-r update B @ A, scaled by alpha / r.
+    # B starts at zero so training starts exactly from the pretrained encoder
+    def __init__(self, base, r, alpha, dropout):
+        super(LoRALinear, self).__init__()
+        self.base = base
+        self.lora_A = nn.Parameter(torch.empty(r, base.in_features))
+        self.lora_B = nn.Parameter(torch.zeros(base.out_features, r))
+        nn.init.kaiming_uniform_(self.lora_A, a=5 ** 0.5)
+        self.dropout = nn.Dropout(dropout)
+        self.scaling = alpha / r
+
+    def forward(self, x):
+        return self.base(x) + F.linear(F.linear(self.dropout(x), self.lora_A), self.lora_B) * self.scaling
+
+    def merge(self):
+        with torch.no_grad():
+            self.base.weight += (self.lora_B @ self.lora_A).to(self.base.weight.dtype) * self.scaling
+        return self.base
+
+
+def encoder_prefix(model):
+    return [n for n, m in model.named_modules() if m is model.emb][0] + "."
+
+
+def add_lora(model, config):
+    # "lora": true in the config json. the encoder is frozen and its attention projections named in
+    # lora_targets get low-rank adapters; heads, star_emb, lstm and exits stay fully trainable
+    targets = getattr(config, "lora_targets", ["query", "value"])
+    for p in model.emb.parameters():
+        p.requires_grad = False
+    for name, module in list(model.emb.named_modules()):
+        if isinstance(module, nn.Linear) and name.split(".")[-1] in targets:
+            parent = get_module(model.emb, name.rpartition(".")[0])
+            setattr(parent, name.split(".")[-1], LoRALinear(module, getattr(config, "lora_r", 8),
+                                                            getattr(config, "lora_alpha", 16),
+                                                            getattr(config, "lora_dropout", 0.1)))
+    model.lora = True
+    return model
+
+
+def merge_lora(model):
+    # folds every adapter into its linear layer, afterwards the model has the plain architecture and cost
+    for name, module in list(model.emb.named_modules()):
+        if isinstance(module, LoRALinear):
+            parent = get_module(model.emb, name.rpartition(".")[0])
+            setattr(parent, name.split(".")[-1], module.merge())
+    model.lora = False
+    return model
+
+
+def checkpoint_state_dict(model):
+    # with lora the frozen encoder is the public backbone, so only adapters and the rest are saved
+    state_dict = model.state_dict()
+    if not getattr(model, "lora", False):
+        return state_dict
+    prefix = encoder_prefix(model)
+    return {k: v for k, v in state_dict.items() if not k.startswith(prefix) or "lora_" in k}
+
+
+def is_lora_checkpoint(state_dict):
+    return any("lora_" in k for k in state_dict)
+
+
+def restore_model(model, state_dict, config):
+    # a lora checkpoint goes on top of the pretrained encoder (so the model must not be built with
+    # skip_pretrained) and is merged right away, leaving no adapter overhead at inference
+    if is_lora_checkpoint(state_dict):
+        add_lora(model, config)
+        model.load_state_dict(state_dict, strict=False)
+        return merge_lora(model)
+    model.load_state_dict(state_dict)
+    return model
+
+
+def lora_config(config, args):
+    # copies the lora settings of the config json onto the model config
+    for key in ("lora_r", "lora_alpha", "lora_dropout", "lora_targets"):
+        if key in args:
+            setattr(config, key, args[key])
+    return config
+
+
+def model_config(config, args):
+    # copies the model settings of the config json (with their defaults) onto the model config
+    config.device = args.device
+    config.lstm_bidirectional = args.get("lstm_bidirectional", False)
+    config.loss_weights = args.get("loss_weights", [0.5, 0.5])
+    config.num_sampled = args.get("num_sampled", 0)
+    config.sparse_star_emb = args.get("sparse_star_emb", False)
+    config.pair_mining = args.get("pair_mining", "all")
+    config.mining_k = args.get("mining_k", 8)
+    return config
+
+
+def load_checkpoint(checkpoint_dir, model_mode, model_link, args, labelNumber=None, margin=-0.5,
+                    weights_file="training_model.bin", early_exit=None):
+    # rebuilds a trained MODEL_LIST model from checkpoint_dir on args.device, in eval mode. the label count
+    # defaults to the checkpoint's out_proj, early_exit to the config json's "early_exit"
+    state_dict = torch.load(os.path.join(checkpoint_dir, weights_file), map_location="cpu")
+    if labelNumber is None:
+        labelNumber = [v for k, v in state_dict.items() if k.endswith("out_proj.weight")][0].shape[0]
+    config = model_config(AutoConfig.from_pretrained(model_link), args)
+    # a full checkpoint holds every weight, so the pretrained encoder is not loaded first.
+    # a lora checkpoint only holds the adapters and needs it
+    config.skip_pretrained = not is_lora_checkpoint(state_dict)
+    model = MODEL_LIST[model_mode](model_link, args.model_type, args.model_name_or_path, config, labelNumber, margin)
+    if args.get("early_exit", False) if early_exit is None else early_exit:
+        model = EarlyExit(model, exit_config(config, args), labelNumber)
+    restore_model(model, state_dict, lora_config(config, args))
+    model.to(args.device)
+    model.eval()
+    return model
+
+
+def torch_version():
+    return tuple(int(v) for v in re.findall(r"\d+", torch.__version__)[:2])
+
+
+def compile_model(model, args, example_inputs=None):
+    # opt-in compiled forward/predict ("compile": true in the config json), the state_dict keys stay unchanged.
+    # torch.compile needs torch 2.0. older builds (the pinned 1.5 included) script the parts that script
+    # cleanly with TorchScript instead: the dense/gelu/dropout head and the pairwise losses, per model
+    if not hasattr(torch, "compile"):
+        target = model.base if isinstance(model, EarlyExit) else model
+        target.head_fn = torch.jit.script(dense_gelu_dropout)
+        target.pair_loss = torch.jit.script(pair_loss)
+        target.pairwise_cosine_loss = torch.jit.script(pairwise_cosine_loss)
+        logger.info("torch.compile is not available in torch {}, scripted the head and pairwise losses of {} "
+                    "with TorchScript, the encoder stays eager".format(torch.__version__, type(target).__name__))
+        return model
+
+    # inductor caches compiled graphs on disk (torch >= 2.1), so later runs of a sweep reuse them
+    cache_dir = args.get("compile_cache_dir") or os.path.join(args.ckpt_dir, "compile_cache")
+    os.makedirs(cache_dir, exist_ok=True)
+    os.environ.setdefault("TORCHINDUCTOR_CACHE_DIR", cache_dir)
+    import torch._inductor.config as inductor_config
+    if hasattr(inductor_config, "fx_graph_cache"):
+        inductor_config.fx_graph_cache = True
+
+    # explain(fn)(**inputs) returning an ExplainOutput is the torch >= 2.1 form
+    if example_inputs is not None and torch_version() >= (2, 1):
+        explanation = torch._dynamo.explain(model)(**example_inputs)
+        logger.info("Compiled {}: {} graphs, {} graph breaks".format(
+            type(model).__name__, explanation.graph_count, explanation.graph_break_count))
+        for reason in explanation.break_reasons:
+            logger.info("  graph break: {}".format(reason.reason))
+        torch._dynamo.reset()
+
+    if hasattr(model, "compile"):
+        model.compile(dynamic=True)
+    else:
+        # nn.Module.compile is torch >= 2.2, before that the bound forward is compiled instead
+        model.forward = torch.compile(model.forward, dynamic=True)
+    model.predict = torch.compile(model.predict, dynamic=True)
+    return model
@@ -0,0 +1,64 @@
+import argparse
+import json
+import os
+
+import numpy as np
+
+
+def best_acc(result_dir):
+    # highest accuracy of the dev/<mode>-<step>.txt files evaluate() wrote, as getMaxAcc.py reads them
+    result_path = os.path.join("ckpt", result_dir, "dev")
+    if not os.path.exists(result_path):
+        result_path = os.path.join("ckpt", result_dir, "test")
+    accs = []
+    for name in os.listdir(result_path):
+        with open(os.path.join(result_path, name), "r") as fp:
+            accs.append(float(fp.readline().split()[-1]))
+    return max(accs)
+
+
+def train_time(result_dir):
+    with open(os.path.join("ckpt", result_dir, "train_time.json")) as fp:
+        timing = json.load(fp)
+    timing["total_seconds"] = sum(timing["epoch_seconds"]) + timing["scoring_seconds"]
+    return timing
+
+
+if __name__ == '__main__':
+    cli_parser = argparse.ArgumentParser()
+
+    # one "dataset:baseline_result_dir:pruned_result_dir" triple per dataset
+    cli_parser.add_argument("--runs", type=str, nargs="+", required=True)
+    cli_parser.add_argument("--output", type=str, default=os.path.join("ckpt", "prune_report.json"))
+
+    cli_args = cli_parser.parse_args()
+
+    report = []
+    for run in cli_args.runs:
+        dataset, baseline, pruned = run.split(":")
+        full, small = train_time(baseline), train_time(pruned)
+        row = {
+            "dataset": dataset,
+            "baseline": baseline,
+            "pruned": pruned,
+            "kept": "{}/{}".format(small["kept_examples"], small["train_examples"]),
+            "baseline_seconds": full["total_seconds"],
+            "pruned_seconds": small["total_seconds"],
+            "scoring_seconds": small["scoring_seconds"],
+            "time_saved": 1 - small["total_seconds"] / full["total_seconds"],
+            "baseline_epoch_seconds": float(np.mean(full["epoch_seconds"])),
+            "pruned_epoch_seconds": float(np.mean(small["epoch_seconds"][small["prune_epochs"]:]
+                                                  or small["epoch_seconds"])),
+            "baseline_acc": best_acc(baseline),
+            "pruned_acc": best_acc(pruned)
+        }
+        row["acc_delta"] = row["pruned_acc"] - row["baseline_acc"]
+        report.append(row)
+
+    print("dataset\tkept\tbaseline_s\tpruned_s\ttime_saved\tbaseline_acc\tpruned_acc\tacc_delta")
+    for row in report:
+        print("{}\t{}\t{:.1f}\t{:.1f}\t{:.1%}\t{:.4f}\t{:.4f}\t{:+.4f}".format(
+            row["dataset"], row["kept"], row["baseline_seconds"], row["pruned_seconds"], row["time_saved"],
+            row["baseline_acc"], row["pruned_acc"], row["acc_delta"]))
+    with open(cli_args.output, "w") as fp:
+        json.dump(report, fp, indent=2)
@@ -0,0 +1,238 @@
+import argparse
+import json
+import logging
+import os
+
+from attrdict import AttrDict
+import numpy as np
+from torch.utils.data import DataLoader, IterableDataset, SequentialSampler
+from fastprogress.fastprogress import progress_bar
+from datasets import load_dataset
+
+import matplotlib
+matplotlib.use("Agg")
+import matplotlib.pyplot as plt
+
+from model import *
+
+from src import (
+    init_logger,
+    set_seed,
+    resolve_model_link
+)
+
+from transformers import (
+    AutoTokenizer
+)
+
+logger = logging.getLogger(__name__)
+
+
+class GeometryStats(object):
+    # running label-vector geometry of one split, independent of batch size and order. the intra/inter
+    # cosine means are exact, from per-class sums of the normalized CLS embeddings. the pair histograms and
+    # margin violation rates need the pairs themselves, they come from a uniform reservoir of at most
+    # reservoir_size embeddings per class, compared against each other once the split is done (finish())
+    def __init__(self, labelNumber, margin, bins, reservoir_size, seed=0):
+        self.labelNumber = labelNumber
+        self.margin = margin
+        self.reservoir_size = reservoir_size
+        self.edges = torch.linspace(-1, 1, bins + 1)
+        self.intra = torch.zeros(labelNumber, bins, dtype=torch.long)
+        self.inter = torch.zeros(labelNumber, bins, dtype=torch.long)
+        self.align = torch.zeros(labelNumber, bins, dtype=torch.long)
+        self.violations = torch.zeros(labelNumber, dtype=torch.long)
+        self.inter_pairs = torch.zeros(labelNumber, dtype=torch.long)
+        self.nearest_correct = torch.zeros(labelNumber, dtype=torch.long)
+        self.count = torch.zeros(labelNumber, dtype=torch.long)
+        self.sums = None
+        self.generator = torch.Generator().manual_seed(seed)
+        self.samples = None
+        self.sample_labels = torch.zeros(0, dtype=torch.long)
+        self.sample_keys = torch.zeros(0)
+
+    def add_histogram(self, hist, classes, values):
+        # every value lands in row classes[i] of hist, one index_add_ for the whole batch.
+        # the bins are equal width on [-1, 1], plain arithmetic as torch.bucketize only exists from torch 1.6
+        bins = len(self.edges) - 1
+        index = classes * bins + ((values.clamp(-1, 1) + 1) / 2 * bins).long().clamp(max=bins - 1)
+        hist.view(-1).index_add_(0, index, torch.ones_like(index))
+
+    def sample(self, embs, labels):
+        # every embedding draws a random key and each class keeps its reservoir_size smallest keys,
+        # a uniform sample of the class whatever the batching. sorted by (label, key), the rank inside
+        # the class decides what stays
+        keys = torch.cat([self.sample_keys, torch.rand(len(labels), generator=self.generator)])
+        labels = torch.cat([self.sample_labels, labels])
+        embs = torch.cat([self.samples, embs]) if self.samples is not None else embs
+        order = (labels.double() * 2 + keys.double()).argsort()
+        sorted_labels = labels[order]
+        counts = sorted_labels.bincount(minlength=self.labelNumber)
+        starts = counts.cumsum(0) - counts
+        keep = order[torch.arange(len(order)) - starts[sorted_labels] < self.reservoir_size]
+        self.samples, self.sample_labels, self.sample_keys = embs[keep], labels[keep], keys[keep]
+
+    def update(self, embs, labels, sims=None):
+        embs = F.normalize(embs.float(), dim=-1).cpu()
+        labels = labels.cpu()
+        if self.sums is None:
+            self.sums = torch.zeros(self.labelNumber, embs.shape[1], dtype=torch.double)
+        self.sums.index_add_(0, labels, embs.double())
+        self.count.index_add_(0, labels, torch.ones_like(labels))
+        self.sample(embs, labels)
+        if sims is not None:
+            sims = sims.float().cpu()
+            self.add_histogram(self.align, labels, sims.gather(1, labels.unsqueeze(1)).squeeze(1))
+            self.nearest_correct.index_add_(0, labels, (sims.argmax(dim=1) == labels).long())
+
+    def finish(self, chunk_size=1024):
+        # pair histograms and margin violations over every pair of reservoir embeddings, a pair counts
+        # towards the class of its anchor (row). chunked so only chunk_size x reservoir similarities are live
+        if self.samples is None:
+            return
+        for start in range(0, len(self.sample_labels), chunk_size):
+            anchors = self.sample_labels[start:start + chunk_size]
+            pair_sims = torch.mm(self.samples[start:start + chunk_size], self.samples.t())
+            same = anchors.unsqueeze(1) == self.sample_labels.unsqueeze(0)
+            not_self = torch.arange(start, start + len(anchors)).unsqueeze(1) != \
+                torch.arange(len(self.sample_labels)).unsqueeze(0)
+            classes = anchors.unsqueeze(1).expand_as(pair_sims)
+            intra_mask = same & not_self
+            inter_mask = ~same
+            inter, inter_classes = pair_sims[inter_mask], classes[inter_mask]
+            self.add_histogram(self.intra, classes[intra_mask], pair_sims[intra_mask])
+            self.add_histogram(self.inter, inter_classes, inter)
+            # the ANN-style term is still active for every different-label pair above the margin
+            self.violations.index_add_(0, inter_classes, (inter > self.margin).long())
+            self.inter_pairs.index_add_(0, inter_classes, torch.ones_like(inter_classes))
+
+    def pair_means(self):
+        # exact over the whole split: the sum of cos(i, j) over pairs of unit vectors is a dot product of sums
+        if self.sums is None:
+            return torch.zeros(self.labelNumber), torch.zeros(self.labelNumber)
+        count = self.count.double()
+        own = (self.sums * self.sums).sum(dim=1)
+        intra = (own - count) / (count * (count - 1)).clamp(min=1)
+        others = count.sum() - count
+        inter = (self.sums * (self.sums.sum(dim=0, keepdim=True) - self.sums)).sum(dim=1) / \
+            (count * others).clamp(min=1)
+        return intra, inter
+
+    def summary(self, star_sims=None):
+        centers = ((self.edges[1:] + self.edges[:-1]) / 2).numpy()
+
+        def mean(hist):
+            return float((hist.numpy() * centers).sum() / max(int(hist.sum()), 1))
+
+        intra_means, inter_means = self.pair_means()
+        result = {
+            "margin": self.margin,
+            "reservoir_size": self.reservoir_size,
+            "bin_edges": self.edges.tolist(),
+            "star_emb_cosine": star_sims.tolist() if star_sims is not None else None,
+            "classes": {}
+        }
+        for c in range(self.labelNumber):
+            result["classes"][str(c)] = {
+                "count": int(self.count[c]),
+                "intra_mean": float(intra_means[c]),
+                "inter_mean": float(inter_means[c]),
+                "intra_hist": self.intra[c].tolist(),
+                "inter_hist": self.inter[c].tolist(),
+                "margin_violation_rate": float(self.violations[c]) / max(int(self.inter_pairs[c]), 1),
+                "prototype_alignment_mean": mean(self.align[c]) if star_sims is not None else None,
+                "prototype_alignment_hist": self.align[c].tolist() if star_sims is not None else None,
+                "nearest_prototype_acc": float(self.nearest_correct[c]) / max(int(self.count[c]), 1)
+                if star_sims is not None else None
+            }
+        return result
+
+    def plot(self, output_dir, has_star):
+        centers = ((self.edges[1:] + self.edges[:-1]) / 2).numpy()
+        width = float(self.edges[1] - self.edges[0])
+        for c in range(self.labelNumber):
+            fig = plt.figure(figsize=(8, 5))
+            ax = fig.add_subplot(1, 1, 1)
+            ax.bar(centers, self.intra[c].numpy(), width=width, alpha=0.5, label="intra-class")
+            ax.bar(centers, self.inter[c].numpy(), width=width, alpha=0.5, label="inter-class")
+            if has_star:
+                ax.bar(centers, self.align[c].numpy(), width=width, alpha=0.5, label="to star_emb")
+            ax.axvline(self.margin, color="k", linestyle="--", label="margin")
+            ax.set_xlabel("cosine similarity")
+            ax.set_title("label {}".format(c))
+            ax.legend()
+            fig.savefig(os.path.join(output_dir, "label_{}.png".format(c)))
+            plt.close(fig)
+
+
+def main(cli_args):
+    max_checkpoint = "checkpoint-best"
+    checkpoint_dir = os.path.join("ckpt", cli_args.result_dir, max_checkpoint)
+
+    training_args = torch.load(os.path.join(checkpoint_dir, "training_args.bin"))
+    with open(os.path.join(cli_args.config_dir, cli_args.config_file)) as f:
+        args = AttrDict(json.load(f))
+    margin = cli_args.margin if cli_args.margin is not None else training_args.margin
+
+    init_logger()
+    set_seed(args)
+
+    model_link = resolve_model_link(cli_args.transformer_mode, args.get("model_registry"))
+    tokenizer = AutoTokenizer.from_pretrained(model_link)
+
+    args.train_file = os.path.join(cli_args.dataset, args.train_file)
+    args.dev_file = os.path.join(cli_args.dataset, args.dev_file)
+    args.test_file = os.path.join(cli_args.dataset, args.test_file)
+    labelNumber = load_dataset(args, tokenizer, mode="train").getLabelNumber()
+    eval_dataset = load_dataset(args, tokenizer, mode=cli_args.split)
+
+    args.device = "cuda:{}".format(cli_args.gpu) if torch.cuda.is_available() and not args.no_cuda else "cpu"
+    model = load_checkpoint(checkpoint_dir, cli_args.model_mode, model_link, args, labelNumber, margin)
+
+    has_star = hasattr(model, "star_emb")
+    stats = GeometryStats(labelNumber, margin, cli_args.bins, cli_args.reservoir_size, args.seed)
+    eval_sampler = None if isinstance(eval_dataset, IterableDataset) else SequentialSampler(eval_dataset)
+    eval_dataloader = DataLoader(eval_dataset, sampler=eval_sampler, batch_size=args.eval_batch_size)
+    logger.info("***** Label vector report on {} dataset *****".format(cli_args.split))
+    for (batch, txt) in progress_bar(eval_dataloader):
+        batch = tuple(t.to(args.device) for t in batch)
+        token_type_ids = batch[2] if len(batch) == 4 else None
+        with torch.no_grad():
+            outputs = model.predict(batch[0], batch[1], token_type_ids, return_embs=True, return_sims=True)
+        stats.update(outputs[1], batch[-1], outputs[2] if has_star else None)
+    stats.finish()
+
+    star_sims = None
+    if has_star:
+        with torch.no_grad():
+            star = F.normalize(model.star_emb.weight, dim=-1)
+            star_sims = torch.mm(star, star.t()).cpu()
+
+    output_dir = os.path.join("ckpt", cli_args.result_dir, "label_report_{}".format(cli_args.split))
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+    with open(os.path.join(output_dir, "report.json"), "w") as fp:
+        json.dump(stats.summary(star_sims), fp, indent=2)
+    stats.plot(output_dir, has_star)
+    logger.info("Saving label vector report to {}".format(output_dir))
+
+
+if __name__ == '__main__':
+    cli_parser = argparse.ArgumentParser()
+
+    cli_parser.add_argument("--config_dir", type=str, default="config")
+    cli_parser.add_argument("--config_file", type=str, default="koelectra-base.json")
+    cli_parser.add_argument("--dataset", type=str, required=True)
+    cli_parser.add_argument("--result_dir", type=str, required=True)
+    cli_parser.add_argument("--model_mode", type=str, required=True, choices=MODEL_LIST.keys())
+    cli_parser.add_argument("--transformer_mode", type=str, required=True)
+    cli_parser.add_argument("--split", type=str, default="test", choices=["train", "dev", "test"])
+    cli_parser.add_argument("--gpu", type=str, default = 0)
+    cli_parser.add_argument("--margin", type=float, default = None)
+    cli_parser.add_argument("--bins", type=int, default = 40)
+    # embeddings kept per label for the pair histograms and margin violation rates
+    cli_parser.add_argument("--reservoir_size", type=int, default = 256)
+
+    cli_args = cli_parser.parse_args()
+
+    main(cli_args)
@@ -0,0 +1,257 @@
+import argparse
+import collections
+import json
+import logging
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from attrdict import AttrDict
+import numpy as np
+
+from model import *
+
+from src import (
+    init_logger,
+    resolve_model_link,
+    PredictionCache,
+    checkpoint_fingerprint
+)
+
+from transformers import (
+    AutoTokenizer
+)
+
+logger = logging.getLogger(__name__)
+
+
+def read_records(fp, input_format, text_column, id_column, start_offset):
+    # yields (end byte offset, id, text) per input line. the header of a tsv is always read from the top,
+    # then everything before start_offset is skipped without parsing
+    offset = 0
+    columns = None
+    if input_format == "tsv":
+        header = fp.readline()
+        offset += len(header)
+        columns = header.decode("utf8").rstrip("\r\n").split("\t")
+        text_idx = columns.index(text_column)
+        id_idx = columns.index(id_column) if id_column else None
+    if start_offset > offset:
+        if fp.seekable():
+            fp.seek(start_offset)
+        else:
+            while offset < start_offset:
+                offset += len(fp.read(min(start_offset - offset, 1 << 20)))
+        offset = start_offset
+
+    for line in fp:
+        offset += len(line)
+        line = line.decode("utf8").rstrip("\r\n")
+        if not line:
+            continue
+        if input_format == "tsv":
+            fields = line.split("\t")
+            text, rid = fields[text_idx], fields[id_idx] if id_idx is not None else None
+        else:
+            record = json.loads(line)
+            text, rid = record[text_column], record.get(id_column) if id_column else None
+        yield offset, rid, text
+
+
+def chunked(records, chunk_size):
+    chunk = []
+    for record in records:
+        chunk.append(record)
+        if len(chunk) >= chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def tokenize_chunk(tokenizer, maxlen, chunk, cache=None):
+    # padded to the longest sentence of the chunk, not to max_seq_len. rows the cache already holds
+    # are neither tokenized nor scored again
+    cached = [cache.get(text) for _, _, text in chunk] if cache is not None else [None] * len(chunk)
+    misses = [str(text) for (_, _, text), logits in zip(chunk, cached) if logits is None]
+    data = tokenizer(misses, padding="longest", max_length=maxlen, truncation=True,
+                     return_tensors="pt") if misses else None
+    return chunk, data, cached
+
+
+def load_scoring_model(args, cli_args, model_link):
+    # the label count comes from the checkpoint, so no training split has to be read
+    return load_checkpoint(os.path.join("ckpt", cli_args.result_dir, "checkpoint-best"), cli_args.model_mode,
+                           model_link, args)
+
+
+def open_cache(args, cli_args):
+    # --cache_mb 0 turns the prediction cache off. the early exit threshold changes predictions too,
+    # so it is part of the fingerprint
+    if cli_args.cache_mb <= 0:
+        return None
+    fingerprint = checkpoint_fingerprint(os.path.join("ckpt", cli_args.result_dir, "checkpoint-best", "training_model.bin"))
+    if args.get("early_exit", False):
+        fingerprint += "-{}".format(args.get("exit_threshold", 0.9))
+    return PredictionCache(fingerprint, args.max_seq_len, cli_args.cache_mb, cli_args.cache_file)
+
+
+class ScoreWriter(object):
+    # appends scored rows to a jsonl or tsv file and, after every flushed chunk, records how far the input
+    # and the output got. a restarted job truncates the output back to the last recorded size and seeks
+    # the input to the matching offset, so no row is lost or written twice
+    def __init__(self, path, keep_text=False):
+        self.path = path
+        self.state_path = path + ".state"
+        self.keep_text = keep_text
+        self.jsonl = path.endswith(".jsonl")
+        self.state = {"offset": 0, "rows": 0, "output_bytes": 0}
+
+    def open(self, resume):
+        if resume and os.path.isfile(self.state_path):
+            with open(self.state_path) as fp:
+                self.state = json.load(fp)
+        self.fp = open(self.path, "ab" if resume else "wb")
+        self.fp.truncate(self.state["output_bytes"])
+        self.fp.seek(self.state["output_bytes"])
+        if not self.jsonl and self.state["output_bytes"] == 0:
+            header = ["row", "id", "pred", "confidence"] + (["data"] if self.keep_text else [])
+            self.fp.write(("\t".join(header) + "\n").encode("utf8"))
+        return self.state
+
+    def write(self, chunk, preds, confidences):
+        lines = []
+        for (offset, rid, text), pred, confidence in zip(chunk, preds, confidences):
+            if self.jsonl:
+                record = {"row": self.state["rows"], "id": rid, "pred": pred, "confidence": confidence}
+                if self.keep_text:
+                    record["data"] = text
+                lines.append(json.dumps(record, ensure_ascii=False))
+            else:
+                fields = [str(self.state["rows"]), "" if rid is None else str(rid), str(pred), "{:.6f}".format(confidence)]
+                if self.keep_text:
+                    fields.append(text.replace("\t", " "))
+                lines.append("\t".join(fields))
+            self.state["rows"] += 1
+        self.fp.write(("\n".join(lines) + "\n").encode("utf8"))
+        self.fp.flush()
+        os.fsync(self.fp.fileno())
+        self.state["offset"] = chunk[-1][0]
+        self.state["output_bytes"] = self.fp.tell()
+        with open(self.state_path + ".tmp", "w") as fp:
+            json.dump(self.state, fp)
+        os.replace(self.state_path + ".tmp", self.state_path)
+
+    def close(self):
+        self.fp.close()
+
+
+def score_chunk(model, data, batch_size, device):
+    logits = []
+    for start in range(0, data["input_ids"].shape[0], batch_size):
+        batch = {k: v[start:start + batch_size].to(device) for k, v in data.items()}
+        with torch.no_grad():
+            logits.append(model.predict(batch["input_ids"], batch["attention_mask"], batch.get("token_type_ids"))[0].float())
+    return torch.cat(logits).cpu().numpy()
+
+
+def merge_cached(chunk, cached, logits, cache=None):
+    # fills the cache misses of a chunk in order with the freshly scored rows, then softmax per row
+    scored = iter(logits)
+    rows = []
+    for (_, _, text), row in zip(chunk, cached):
+        if row is None:
+            row = next(scored)
+            if cache is not None:
+                cache.put(text, row)
+        rows.append(row)
+    rows = np.stack(rows)
+    probs = np.exp(rows - rows.max(axis=-1, keepdims=True))
+    probs /= probs.sum(axis=-1, keepdims=True)
+    return probs.argmax(axis=-1).tolist(), probs.max(axis=-1).tolist()
+
+
+def main(cli_args):
+    with open(os.path.join(cli_args.config_dir, cli_args.config_file)) as f:
+        args = AttrDict(json.load(f))
+    init_logger()
+    if cli_args.threads > 0:
+        torch.set_num_threads(cli_args.threads)
+    args.device = "cuda:{}".format(cli_args.gpu) if torch.cuda.is_available() and not args.no_cuda else "cpu"
+
+    model_link = resolve_model_link(cli_args.transformer_mode, args.get("model_registry"))
+    tokenizer = AutoTokenizer.from_pretrained(model_link)
+    model = load_scoring_model(args, cli_args, model_link)
+    cache = open_cache(args, cli_args)
+
+    input_format = cli_args.input_format or ("jsonl" if cli_args.input.endswith(".jsonl") else "tsv")
+    writer = ScoreWriter(cli_args.output, cli_args.keep_text)
+    state = writer.open(cli_args.resume)
+    start_offset = max(state["offset"], cli_args.start_offset)
+    logger.info("***** Scoring {} from byte {} ({} rows done) *****".format(cli_args.input, start_offset, state["rows"]))
+
+    fp = sys.stdin.buffer if cli_args.input == "-" else open(cli_args.input, "rb")
+    records = read_records(fp, input_format, cli_args.text_column, cli_args.id_column, start_offset)
+    start = time.time()
+    rows = 0
+    # tokenization runs ahead on a thread pool, at most `prefetch` chunks are in flight at once
+    pending = collections.deque()
+    with ThreadPoolExecutor(max_workers=cli_args.workers) as pool:
+        chunks = chunked(records, cli_args.chunk_size)
+        while True:
+            while len(pending) < cli_args.prefetch:
+                chunk = next(chunks, None)
+                if chunk is None:
+                    break
+                pending.append(pool.submit(tokenize_chunk, tokenizer, args.max_seq_len, chunk, cache))
+            if not pending:
+                break
+            chunk, data, cached = pending.popleft().result()
+            logits = score_chunk(model, data, cli_args.batch_size or args.eval_batch_size, args.device) \
+                if data is not None else []
+            preds, confidences = merge_cached(chunk, cached, logits, cache)
+            writer.write(chunk, preds, confidences)
+            rows += len(chunk)
+            elapsed = time.time() - start
+            logger.info("  {} rows, {:.1f} rows/s, input byte {}{}".format(
+                state["rows"], rows / elapsed, state["offset"],
+                ", cache hit rate {:.1%}".format(cache.stats()["hit_rate"]) if cache is not None else ""))
+    writer.close()
+    if cache is not None:
+        logger.info("Prediction cache {}".format(cache.stats()))
+        cache.save()
+    if fp is not sys.stdin.buffer:
+        fp.close()
+    logger.info("Scored {} rows in {:.1f}s ({:.1f} rows/s) to {}".format(
+        rows, time.time() - start, rows / max(time.time() - start, 1e-9), cli_args.output))
+
+
+if __name__ == '__main__':
+    cli_parser = argparse.ArgumentParser()
+
+    cli_parser.add_argument("--config_dir", type=str, default="config")
+    cli_parser.add_argument("--config_file", type=str, default="koelectra-base.json")
+    cli_parser.add_argument("--result_dir", type=str, required=True)
+    cli_parser.add_argument("--model_mode", type=str, required=True, choices=MODEL_LIST.keys())
+    cli_parser.add_argument("--transformer_mode", type=str, required=True)
+    cli_parser.add_argument("--input", type=str, default="-")
+    cli_parser.add_argument("--input_format", type=str, default=None, choices=["tsv", "jsonl"])
+    cli_parser.add_argument("--text_column", type=str, default="data")
+    cli_parser.add_argument("--id_column", type=str, default=None)
+    cli_parser.add_argument("--output", type=str, required=True)
+    cli_parser.add_argument("--keep_text", action="store_true")
+    cli_parser.add_argument("--resume", action="store_true")
+    cli_parser.add_argument("--start_offset", type=int, default = 0)
+    cli_parser.add_argument("--chunk_size", type=int, default = 4096)
+    cli_parser.add_argument("--batch_size", type=int, default = None)
+    cli_parser.add_argument("--workers", type=int, default = 2)
+    cli_parser.add_argument("--prefetch", type=int, default = 4)
+    cli_parser.add_argument("--threads", type=int, default = 0)
+    cli_parser.add_argument("--cache_mb", type=float, default = 0)
+    cli_parser.add_argument("--cache_file", type=str, default=None)
+    cli_parser.add_argument("--gpu", type=str, default = 0)
+
+    cli_args = cli_parser.parse_args()
+
+    main(cli_args)
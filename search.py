@@ -0,0 +1,138 @@
+import argparse
+import copy
+import json
+import logging
+import math
+import os
+import random
+
+import train
+from model import MODEL_LIST
+from src import init_logger
+
+logger = logging.getLogger(__name__)
+
+SEARCH_SPACE = {
+    "margin": ("uniform", -0.9, 0.5),
+    "learning_rate": ("loguniform", 1e-5, 1e-4),
+    "loss_weights": ("uniform_pair", 0.1, 1.0),
+    "train_batch_size": ("choice", [32, 64, 128, 256])
+}
+
+
+def sample_params(rng):
+    params = {}
+    for name, space in SEARCH_SPACE.items():
+        if space[0] == "uniform":
+            params[name] = rng.uniform(space[1], space[2])
+        elif space[0] == "loguniform":
+            params[name] = math.exp(rng.uniform(math.log(space[1]), math.log(space[2])))
+        elif space[0] == "uniform_pair":
+            params[name] = [rng.uniform(space[1], space[2]), rng.uniform(space[1], space[2])]
+        elif space[0] == "choice":
+            params[name] = rng.choice(space[1])
+    return params
+
+
+class Search(object):
+    # ASHA-style early stopping: a trial reaching a rung (min_epochs * eta^k epochs) keeps training only
+    # if its dev accuracy is in the top 1/eta of every trial that has reached that rung so far.
+    # every trial and its per-epoch accuracy is written to trials.json, so an interrupted search resumes
+    def __init__(self, search_dir, min_epochs, max_epochs, eta):
+        self.path = os.path.join(search_dir, "trials.json")
+        self.max_epochs = max_epochs
+        self.eta = eta
+        self.rungs = []
+        rung = min_epochs
+        while rung < max_epochs:
+            self.rungs.append(rung)
+            rung *= eta
+        self.trials = []
+        if os.path.isfile(self.path):
+            with open(self.path) as fp:
+                self.trials = json.load(fp)
+
+    def save(self):
+        if not os.path.exists(os.path.dirname(self.path)):
+            os.makedirs(os.path.dirname(self.path))
+        with open(self.path + ".tmp", "w") as fp:
+            json.dump(self.trials, fp, indent=2)
+        os.replace(self.path + ".tmp", self.path)
+
+    def keep_going(self, trial, epoch, acc):
+        trial["accs"][str(epoch + 1)] = acc
+        self.save()
+        if epoch + 1 not in self.rungs:
+            return True
+        peers = sorted((t["accs"][str(epoch + 1)] for t in self.trials if str(epoch + 1) in t["accs"]), reverse=True)
+        cutoff = peers[max(len(peers) // self.eta, 1) - 1]
+        if acc < cutoff:
+            logger.info("Pruning trial {} at epoch {}: acc {} < rung cutoff {}".format(trial["trial"], epoch + 1, acc, cutoff))
+            trial["status"] = "pruned"
+            self.save()
+            return False
+        return True
+
+
+def main(cli_args):
+    init_logger()
+    rng = random.Random(cli_args.seed)
+    search_dir = os.path.join("ckpt", cli_args.search_dir)
+    search = Search(search_dir, cli_args.min_epochs, cli_args.max_epochs, cli_args.eta)
+
+    for i in range(cli_args.num_trials):
+        # params are drawn for every index, also finished ones, so a resumed search samples the same trials
+        params = sample_params(rng)
+        if i < len(search.trials):
+            trial = search.trials[i]
+            if trial["status"] != "running":
+                continue
+            resume = True
+        else:
+            trial = {"trial": i, "params": params, "accs": {}, "status": "running"}
+            search.trials.append(trial)
+            search.save()
+            resume = False
+
+        trial_args = copy.copy(cli_args)
+        trial_args.result_dir = os.path.join(cli_args.search_dir, "trial_{}".format(i))
+        trial_args.margin = trial["params"]["margin"]
+        trial_args.resume = resume
+        overrides = dict(trial["params"])
+        overrides["eval_batch_size"] = overrides["train_batch_size"]
+        overrides["num_train_epochs"] = cli_args.max_epochs
+        logger.info("***** Trial {} {} *****".format(i, overrides))
+
+        train.main(trial_args, overrides,
+                   epoch_callback=lambda epoch, acc, trial=trial: search.keep_going(trial, epoch, float(acc)))
+        if trial["status"] == "running":
+            trial["status"] = "completed"
+            search.save()
+
+    finished = [t for t in search.trials if t["accs"]]
+    if not finished:
+        logger.info("No trial finished an epoch, there is no best trial")
+        return
+    best = max(finished, key=lambda t: max(t["accs"].values()))
+    logger.info("Best trial {}: acc {} with {}".format(best["trial"], max(best["accs"].values()), best["params"]))
+
+
+if __name__ == '__main__':
+    cli_parser = argparse.ArgumentParser()
+
+    cli_parser.add_argument("--config_dir", type=str, default="config")
+    cli_parser.add_argument("--config_file", type=str, default="koelectra-base.json")
+    cli_parser.add_argument("--dataset", type=str, required=True)
+    cli_parser.add_argument("--search_dir", type=str, required=True)
+    cli_parser.add_argument("--model_mode", type=str, required=True, choices=MODEL_LIST.keys())
+    cli_parser.add_argument("--transformer_mode", type=str, required=True)
+    cli_parser.add_argument("--gpu", type=str, default = 0)
+    cli_parser.add_argument("--num_trials", type=int, default = 27)
+    cli_parser.add_argument("--min_epochs", type=int, default = 1)
+    cli_parser.add_argument("--max_epochs", type=int, default = 27)
+    cli_parser.add_argument("--eta", type=int, default = 3)
+    cli_parser.add_argument("--seed", type=int, default = 42)
+
+    cli_args = cli_parser.parse_args()
+
+    main(cli_args)
@@ -1,3 +1,6 @@
 from .utils import CONFIG_CLASSES, TOKENIZER_CLASSES, \
-    init_logger, set_seed, compute_metrics, show_ner_report,  MODEL_ORIGINER
-from .evaluate_v1_0 import eval_during_train
\ No newline at end of file
+    init_logger, set_seed, compute_metrics, show_ner_report,  MODEL_ORIGINER, MetricsLogger, MemoryProfiler
+from .evaluate_v1_0 import eval_during_train
+from .registry import MODEL_LINKS, resolve_model_link, has_mmap_weights, load_mmap_weights
+from .tuner import tune_batch_size
+from .cache import PredictionCache, checkpoint_fingerprint, normalize_text
@@ -0,0 +1,119 @@
+import collections
+import hashlib
+import logging
+import os
+import pickle
+import re
+import threading
+import time
+import unicodedata
+
+logger = logging.getLogger(__name__)
+
+# dict slot, key bytes object and numpy header per entry, on top of the digest and the logits themselves
+ENTRY_OVERHEAD = 250
+
+
+def normalize_text(text):
+    # unicode NFKC and collapsed whitespace, so texts differing only in those share one entry
+    return re.sub(r"\s+", " ", unicodedata.normalize("NFKC", str(text))).strip()
+
+
+def checkpoint_fingerprint(path, chunk_size=1 << 20):
+    # content hash of the weights file: a retrained or updated checkpoint never hits an older entry
+    digest = hashlib.sha1()
+    with open(path, "rb") as fp:
+        for block in iter(lambda: fp.read(chunk_size), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class PredictionCache(object):
+    # thread-safe LRU of prediction logits keyed by sha1(fingerprint, max_seq_len, normalized text).
+    # bounded by max_mb, the least recently used entries are evicted first. with a path the entries
+    # are loaded at start (when fingerprint and max_seq_len match) and written back by save()
+    def __init__(self, fingerprint, maxlen, max_mb=64, path=None):
+        self.fingerprint = fingerprint
+        self.maxlen = maxlen
+        self.max_bytes = max_mb * 2 ** 20
+        self.path = path
+        self.entries = collections.OrderedDict()
+        self.nbytes = 0
+        self.lock = threading.Lock()
+        self.reset_stats()
+        if path is not None and os.path.isfile(path):
+            self.load()
+
+    def key(self, text):
+        data = "{}\0{}\0{}".format(self.fingerprint, self.maxlen, normalize_text(text))
+        return hashlib.sha1(data.encode("utf8")).digest()
+
+    def reset_stats(self):
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lookup_time = 0.0
+
+    def get(self, text):
+        start = time.perf_counter()
+        key = self.key(text)
+        with self.lock:
+            value = self.entries.get(key)
+            if value is not None:
+                self.entries.move_to_end(key)
+                self.hits += 1
+            else:
+                self.misses += 1
+            self.lookup_time += time.perf_counter() - start
+        return value
+
+    def put(self, text, logits):
+        key = self.key(text)
+        size = len(key) + logits.nbytes + ENTRY_OVERHEAD
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                return
+            self.entries[key] = logits
+            self.nbytes += size
+            while self.nbytes > self.max_bytes and self.entries:
+                old_key, old = self.entries.popitem(last=False)
+                self.nbytes -= len(old_key) + old.nbytes + ENTRY_OVERHEAD
+                self.evictions += 1
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self.entries),
+            "mb": self.nbytes / 2 ** 20,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "evictions": self.evictions,
+            "lookup_us": self.lookup_time / lookups * 1e6 if lookups else 0.0
+        }
+
+    def load(self):
+        with open(self.path, "rb") as fp:
+            state = pickle.load(fp)
+        if state["fingerprint"] != self.fingerprint or state["maxlen"] != self.maxlen:
+            logger.warning("Ignoring prediction cache {}, it was written for another checkpoint".format(self.path))
+            return
+        # oldest first, so the LRU order survives the round trip
+        for key, logits in state["entries"]:
+            self.entries[key] = logits
+            self.nbytes += len(key) + logits.nbytes + ENTRY_OVERHEAD
+        while self.nbytes > self.max_bytes and self.entries:
+            old_key, old = self.entries.popitem(last=False)
+            self.nbytes -= len(old_key) + old.nbytes + ENTRY_OVERHEAD
+        logger.info("Loaded {} cached predictions from {}".format(len(self.entries), self.path))
+
+    def save(self):
+        if self.path is None:
+            return
+        with self.lock:
+            state = {"fingerprint": self.fingerprint, "maxlen": self.maxlen, "entries": list(self.entries.items())}
+        with open(self.path + ".tmp", "wb") as fp:
+            pickle.dump(state, fp, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(self.path + ".tmp", self.path)
+        logger.info("Saving {} cached predictions to {}".format(len(state["entries"]), self.path))
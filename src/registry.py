@@ -0,0 +1,132 @@
+import argparse
+import json
+import logging
+import os
+import time
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+MODEL_LINKS = {
+    "T5": "t5-base",
+    "ELECTRA": "google/electra-base-discriminator",
+    "ALBERT": "albert-base-v2",
+    "ROBERTA": "roberta-base",
+    "BERT": "bert-base-uncased"
+}
+
+
+# converted copies also hold every weight as a raw .npy file, which load_mmap_weights() maps instead of reading.
+# transformers 3.x save_pretrained() only writes pytorch_model.bin, and from_pretrained() torch.load()s all of it
+MMAP_DIR = "mmap_weights"
+
+
+def load_registry(registry_file):
+    if registry_file and os.path.isfile(registry_file):
+        with open(registry_file) as fp:
+            return json.load(fp)
+    return {}
+
+
+def resolve_model_link(transformer_mode, registry_file=None):
+    # --transformer_mode -> the pre-converted local copy when one is registered, the hub name otherwise.
+    # a local copy skips the hub download, and with mmap weights the full read into RAM as well
+    transformer_mode = transformer_mode.upper()
+    local_dir = load_registry(registry_file).get(transformer_mode)
+    if local_dir and os.path.isdir(local_dir):
+        return local_dir
+    return MODEL_LINKS[transformer_mode]
+
+
+def has_mmap_weights(model_dir):
+    return os.path.isfile(os.path.join(model_dir, MMAP_DIR, "index.json"))
+
+
+def save_mmap_weights(model, model_dir):
+    weight_dir = os.path.join(model_dir, MMAP_DIR)
+    os.makedirs(weight_dir, exist_ok=True)
+    state_dict = model.state_dict()
+    for name, tensor in state_dict.items():
+        np.save(os.path.join(weight_dir, name + ".npy"), tensor.cpu().numpy())
+    with open(os.path.join(weight_dir, "index.json"), "w") as fp:
+        json.dump(list(state_dict), fp)
+
+
+def load_mmap_weights(model, model_dir):
+    # parameters become copy-on-write views of the .npy files: pages are read on first access and shared
+    # through the page cache between processes (e.g. sharded test workers). only weights that get written,
+    # as in training, turn into private memory. the tensors from_config() initialized are freed as replaced
+    import torch
+
+    weight_dir = os.path.join(model_dir, MMAP_DIR)
+    with open(os.path.join(weight_dir, "index.json")) as fp:
+        names = json.load(fp)
+    params = dict(model.named_parameters())
+    buffers = dict(model.named_buffers())
+    for name in names:
+        array = torch.from_numpy(np.load(os.path.join(weight_dir, name + ".npy"), mmap_mode="c"))
+        if name in params:
+            params[name].data = array
+        elif name in buffers:
+            buffers[name].copy_(array)
+    return model
+
+
+def convert(transformer_mode, output_dir, registry_file):
+    from transformers import AutoConfig, AutoModel, AutoTokenizer
+
+    transformer_mode = transformer_mode.upper()
+    model_link = MODEL_LINKS[transformer_mode]
+    target_dir = os.path.join(output_dir, transformer_mode)
+    AutoConfig.from_pretrained(model_link).save_pretrained(target_dir)
+    AutoTokenizer.from_pretrained(model_link).save_pretrained(target_dir)
+    model = AutoModel.from_pretrained(model_link)
+    model.save_pretrained(target_dir)
+    save_mmap_weights(model, target_dir)
+
+    registry = load_registry(registry_file)
+    registry[transformer_mode] = target_dir
+    with open(registry_file, "w") as fp:
+        json.dump(registry, fp, indent=2)
+    logger.info("Registered {} -> {}".format(transformer_mode, target_dir))
+
+
+def benchmark(registry_file):
+    from transformers import AutoConfig, AutoModel
+    from .utils import current_rss
+
+    for transformer_mode, model_link in MODEL_LINKS.items():
+        loaders = [(model_link, lambda link=model_link: AutoModel.from_pretrained(link))]
+        local_dir = load_registry(registry_file).get(transformer_mode)
+        if local_dir and os.path.isdir(local_dir):
+            loaders.append((local_dir, lambda: AutoModel.from_pretrained(local_dir)))
+            if has_mmap_weights(local_dir):
+                loaders.append((local_dir + " (mmap)", lambda: load_mmap_weights(
+                    AutoModel.from_config(AutoConfig.from_pretrained(local_dir)), local_dir)))
+        for name, load in loaders:
+            rss = current_rss()
+            start = time.time()
+            model = load()
+            logger.info("{}\t{}\t{:.2f}s\t+{:.1f}MB RSS".format(
+                transformer_mode, name, time.time() - start, (current_rss() - rss) / 2 ** 20))
+            del model
+
+
+if __name__ == '__main__':
+    logging.basicConfig(format='%(asctime)s - %(levelname)s - %(name)s -   %(message)s',
+                        datefmt='%m/%d/%Y %H:%M:%S',
+                        level=logging.INFO)
+    cli_parser = argparse.ArgumentParser()
+
+    cli_parser.add_argument("--transformer_mode", type=str, nargs="*", default=[])
+    cli_parser.add_argument("--output_dir", type=str, default="models")
+    cli_parser.add_argument("--registry", type=str, default="config/model_registry.json")
+    cli_parser.add_argument("--benchmark", action="store_true")
+
+    cli_args = cli_parser.parse_args()
+
+    for mode in cli_args.transformer_mode:
+        convert(mode, cli_args.output_dir, cli_args.registry)
+    if cli_args.benchmark:
+        benchmark(cli_args.registry)
@@ -0,0 +1,123 @@
+import json
+import logging
+import os
+import time
+
+import torch
+
+from .utils import MemoryProfiler, current_rss
+
+logger = logging.getLogger(__name__)
+
+
+def memory_budget(device, budget_mb=None):
+    # process peak the probes may reach: the configured budget, else 90% of the GPU or what the process
+    # holds now plus 80% of the RAM still available
+    if budget_mb:
+        return budget_mb * 2 ** 20
+    if str(device).startswith("cuda"):
+        return torch.cuda.get_device_properties(device).total_memory * 0.9
+    with open("/proc/meminfo") as fp:
+        meminfo = dict(line.split(":") for line in fp)
+    return current_rss() + int(meminfo["MemAvailable"].split()[0]) * 1024 * 0.8
+
+
+def synthetic_inputs(batch_size, seq_len, vocab_size, labelNumber, device, token_type_ids=False):
+    # full length rows, the worst case a padded batch of max_seq_len can reach
+    inputs = {
+        "input_ids": torch.randint(vocab_size, (batch_size, seq_len), device=device),
+        "attention_mask": torch.ones((batch_size, seq_len), dtype=torch.long, device=device),
+        "token_type_ids": torch.zeros((batch_size, seq_len), dtype=torch.long, device=device) if token_type_ids else None,
+        "labels": torch.randint(labelNumber, (batch_size,), device=device)
+    }
+    return inputs
+
+
+def clear_grads(model):
+    # drops the gradient tensors instead of zeroing them, so the next probe starts from the same memory.
+    # zero_grad(set_to_none=True) would do the same but needs torch 1.7
+    for p in model.parameters():
+        p.grad = None
+
+
+def probe(model, inputs, steps, train, profiler):
+    # peak memory and samples/s of `steps` forward(+backward) passes. gradients are dropped afterwards
+    # and no optimizer step runs, so the weights are left as they were
+    model.train(train)
+    with profiler.stage("probe"):
+        start = time.time()
+        for _ in range(steps):
+            with torch.set_grad_enabled(train):
+                loss = model(**inputs)[0]
+                if train:
+                    sum(loss if type(loss) == tuple else (loss,)).backward()
+        if str(inputs["input_ids"].device).startswith("cuda"):
+            torch.cuda.synchronize()
+        elapsed = time.time() - start
+    clear_grads(model)
+    stats = profiler.stages.pop("probe")
+    peak = stats["cuda_peak"] if "cuda_peak" in stats else stats["rss_peak"]
+    return peak, inputs["input_ids"].shape[0] * steps / elapsed
+
+
+def tune_batch_size(model, args, vocab_size, labelNumber, token_type_ids=False):
+    # doubles the batch size until a train step no longer fits the memory budget, then picks the
+    # batch size (and on CPU the intra-op thread count) with the best samples/s among those that fit.
+    # the eval batch gets the largest size whose forward pass alone fits
+    device = args.device
+    budget = memory_budget(device, args.get("memory_budget_mb"))
+    steps = args.get("tune_steps", 3)
+    max_batch = args.get("tune_max_batch", 1024)
+    cpu = not str(device).startswith("cuda")
+    threads = sorted({t for t in [1, 2, 4, 8, 16, 32, 64, torch.get_num_threads()] if t <= (os.cpu_count() or 1)}) \
+        if cpu else [torch.get_num_threads()]
+    profiler = MemoryProfiler(None, True, device)
+    results = []
+
+    for train in (True, False):
+        batch_size = 8
+        while batch_size <= max_batch:
+            inputs = synthetic_inputs(batch_size, args.max_seq_len, vocab_size, labelNumber, device, token_type_ids)
+            try:
+                peak, _ = probe(model, inputs, 1, train, profiler)
+            except RuntimeError as e:
+                if "out of memory" not in str(e):
+                    raise
+                clear_grads(model)
+                if not cpu:
+                    torch.cuda.empty_cache()
+                peak = float("inf")
+            fits = peak <= budget
+            record = {"mode": "train" if train else "eval", "batch_size": batch_size,
+                      "peak_mb": peak / 2 ** 20 if peak != float("inf") else None,
+                      "fits": fits, "samples_per_s": {}}
+            if fits and train:
+                for n in threads:
+                    torch.set_num_threads(n)
+                    record["samples_per_s"][n] = probe(model, inputs, steps, train, profiler)[1]
+            results.append(record)
+            logger.info("  probe {} batch {}: peak {:.1f}MB{}".format(
+                record["mode"], batch_size, peak / 2 ** 20, "" if fits else " (over budget)") +
+                "".join(", {} threads {:.1f} samples/s".format(n, s) for n, s in record["samples_per_s"].items()))
+            del inputs
+            if not fits:
+                break
+            batch_size *= 2
+    profiler.close()
+
+    train_fits = [(s, r["batch_size"], n) for r in results if r["mode"] == "train" and r["fits"]
+                  for n, s in r["samples_per_s"].items()]
+    eval_fits = [r["batch_size"] for r in results if r["mode"] == "eval" and r["fits"]]
+    if not train_fits:
+        raise ValueError("Not even a batch of 8 fits the memory budget of {:.1f}MB".format(budget / 2 ** 20))
+    _, train_batch, best_threads = max(train_fits)
+    choice = {"train_batch_size": train_batch, "eval_batch_size": max(eval_fits) if eval_fits else train_batch,
+              "threads": best_threads}
+    torch.set_num_threads(best_threads)
+    logger.info("Tuned {} (budget {:.1f}MB)".format(choice, budget / 2 ** 20))
+
+    if not os.path.exists(args.output_dir):
+        os.makedirs(args.output_dir)
+    with open(os.path.join(args.output_dir, "batch_tuning.json"), "w") as fp:
+        json.dump({"budget_mb": budget / 2 ** 20, "choice": choice, "probes": results}, fp, indent=2)
+    return choice
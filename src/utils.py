@@ -1,6 +1,10 @@
 import os
+import json
+import contextlib
+import time
 import random
 import logging
+import threading
 
 import torch
 import numpy as np
@@ -76,4 +80,134 @@ def show_ner_report(labels, preds):
 
 def compute_metrics(labels, preds):
     assert len(preds) == len(labels)
-    return acc_score(labels, preds)
\ No newline at end of file
+    return acc_score(labels, preds)
+
+
+class MetricsLogger(object):
+    # per-step counters are summed on the device and only read back once per logging window,
+    # when one json line is appended to the metrics file
+    def __init__(self, path, window):
+        self.path = path
+        self.window = window
+        self.reset()
+
+    def reset(self):
+        self.start = time.time()
+        self.steps = 0
+        self.samples = 0
+        self.positions = 0
+        self.tokens = 0
+        self.loss = 0
+
+    def update(self, loss_terms, tokens, positions, samples):
+        self.steps += 1
+        self.samples += samples
+        self.positions += positions
+        self.tokens = self.tokens + tokens
+        self.loss = self.loss + loss_terms
+
+    def step(self, **extra):
+        if self.window > 0 and self.steps >= self.window:
+            self.flush(**extra)
+
+    def flush(self, **extra):
+        if self.window <= 0 or self.steps == 0:
+            return
+        elapsed = time.time() - self.start
+        tokens = float(self.tokens)
+        record = dict(extra)
+        record.update({
+            "steps": self.steps,
+            "samples_per_s": self.samples / elapsed,
+            "tokens_per_s": tokens / elapsed,
+            "padding_ratio": 1 - tokens / self.positions,
+            "loss": (self.loss / self.steps).tolist()
+        })
+        if not os.path.exists(os.path.dirname(self.path)):
+            os.makedirs(os.path.dirname(self.path))
+        with open(self.path, "a") as fp:
+            fp.write(json.dumps(record) + "\n")
+        self.reset()
+
+
+def current_rss():
+    # resident set size of this process in bytes
+    try:
+        with open("/proc/self/statm") as fp:
+            return int(fp.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class MemoryProfiler(object):
+    # opt-in memory report ("memory_profile": true). static sizes (dataset, weights, grads, optimizer
+    # state) are recorded once they exist. every stage() gets its own peak: a sampler thread polls RSS
+    # while the stage runs and on GPUs the allocator peak is reset at stage entry. growth = peak - entry
+    # is what the stage itself added, e.g. the activation graph for forward. disabled it costs nothing
+    def __init__(self, path, enabled=False, device="cpu", interval=0.005):
+        self.path = path
+        self.enabled = enabled
+        self.cuda = enabled and str(device).startswith("cuda")
+        self.device = device
+        self.interval = interval
+        self.static = {}
+        self.stages = {}
+        self.peak = 0
+        if enabled:
+            self.thread = threading.Thread(target=self.sample, daemon=True)
+            self.thread.start()
+
+    def sample(self):
+        while self.enabled:
+            self.peak = max(self.peak, current_rss())
+            time.sleep(self.interval)
+
+    def record(self, name, nbytes):
+        if self.enabled:
+            self.static[name] = int(nbytes)
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        if not self.enabled:
+            yield
+            return
+        base = current_rss()
+        self.peak = base
+        if self.cuda:
+            torch.cuda.reset_peak_memory_stats(self.device)
+            cuda_base = torch.cuda.memory_allocated(self.device)
+        yield
+        peak = max(self.peak, current_rss())
+        stats = self.stages.setdefault(name, {"calls": 0, "rss_peak": 0, "rss_growth": 0})
+        stats["calls"] += 1
+        stats["rss_peak"] = max(stats["rss_peak"], peak)
+        stats["rss_growth"] = max(stats["rss_growth"], peak - base)
+        if self.cuda:
+            cuda_peak = torch.cuda.max_memory_allocated(self.device)
+            stats["cuda_peak"] = max(stats.get("cuda_peak", 0), cuda_peak)
+            stats["cuda_growth"] = max(stats.get("cuda_growth", 0), cuda_peak - cuda_base)
+
+    def summary(self, **extra):
+        if not self.enabled:
+            return
+        logger = logging.getLogger(__name__)
+        record = dict(extra)
+        record.update({"static": self.static, "stages": self.stages, "rss": current_rss()})
+        logger.info("Memory {}: RSS {:.1f}MB".format(extra, record["rss"] / 2 ** 20))
+        for name, nbytes in self.static.items():
+            logger.info("  {:<12} {:>10.1f}MB".format(name, nbytes / 2 ** 20))
+        for name, stats in self.stages.items():
+            logger.info("  {:<12} peak {:>10.1f}MB, growth {:>10.1f}MB{}".format(
+                name, stats["rss_peak"] / 2 ** 20, stats["rss_growth"] / 2 ** 20,
+                ", cuda peak {:.1f}MB, growth {:.1f}MB".format(stats["cuda_peak"] / 2 ** 20,
+                                                               stats["cuda_growth"] / 2 ** 20)
+                if "cuda_peak" in stats else ""))
+        if not os.path.exists(os.path.dirname(self.path)):
+            os.makedirs(os.path.dirname(self.path))
+        with open(self.path, "a") as fp:
+            fp.write(json.dumps(record) + "\n")
+        self.stages = {}
+
+    def close(self):
+        self.enabled = False
@@ -1,12 +1,15 @@
 import argparse
 import logging
 import os
+import shutil
+import time
 
 from attrdict import AttrDict
 import numpy as np
-from torch.utils.data import DataLoader, SequentialSampler
+import torch.multiprocessing as mp
+from torch.utils.data import DataLoader, IterableDataset, SequentialSampler, Subset
 from fastprogress.fastprogress import progress_bar
-from datasets import BaseDataset
+from datasets import BaseDataset, load_dataset
 import pandas as pd
 
 import matplotlib.pyplot as plt
@@ -17,6 +20,7 @@ from sklearn.cluster import KMeans,DBSCAN
 from sklearn.metrics.cluster import completeness_score
 
 from model import *
+from score import open_cache
 import json
 
 from src import (
@@ -24,21 +28,85 @@ from src import (
     TOKENIZER_CLASSES,
     init_logger,
     compute_metrics,
-    set_seed
+    set_seed,
+    resolve_model_link
 )
 
 from transformers import (
     AdamW,
     get_linear_schedule_with_warmup,
-    AutoTokenizer,
-    AutoConfig
+    AutoTokenizer
 )
 
 logger = logging.getLogger(__name__)
 
-def evaluate(args, model, eval_dataset, mode, global_step=None):
+class ResultWriter(object):
+    # writes the per-example test results in chunks of chunk_size rows to csv or parquet,
+    # so exporting a large test set never holds all of it in memory
+    def __init__(self, path, chunk_size=10000):
+        self.path = path
+        self.chunk_size = chunk_size
+        self.frames = []
+        self.num_rows = 0
+        self.parquet_writer = None
+        self.header_written = False
+
+    def write(self, columns):
+        frame = pd.DataFrame(columns)
+        self.frames.append(frame)
+        self.num_rows += len(frame)
+        if self.num_rows >= self.chunk_size:
+            self.flush()
+
+    def flush(self):
+        if not self.frames:
+            return
+        chunk = pd.concat(self.frames, ignore_index=True)
+        self.frames = []
+        self.num_rows = 0
+        if self.path.endswith(".parquet"):
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+            table = pa.Table.from_pandas(chunk, preserve_index=False)
+            if self.parquet_writer is None:
+                self.parquet_writer = pq.ParquetWriter(self.path, table.schema)
+            self.parquet_writer.write_table(table)
+        else:
+            chunk.to_csv(self.path, mode="a" if self.header_written else "w", header=not self.header_written,
+                         index=False, encoding="utf-8")
+            self.header_written = True
+
+    def close(self):
+        self.flush()
+        if self.parquet_writer is not None:
+            self.parquet_writer.close()
+
+
+def decode_tokens(tokenizer, input_ids, attention_mask):
+    # the ids the dataset already produced, with padding dropped. no second tokenizer pass
+    lengths = attention_mask.sum(dim=1).tolist()
+    return [tokenizer.convert_ids_to_tokens(ids[:n]) for ids, n in zip(input_ids.tolist(), lengths)]
+
+
+def cached_logits(model, cache, inputs, texts):
+    # rows the cache holds skip the forward pass, the misses run through predict() and are added
+    rows = [cache.get(text) for text in texts]
+    misses = [i for i, row in enumerate(rows) if row is None]
+    if misses:
+        idx = torch.tensor(misses, device=inputs["input_ids"].device)
+        token_type_ids = inputs["token_type_ids"].index_select(0, idx) if inputs["token_type_ids"] is not None else None
+        logits = model.predict(inputs["input_ids"].index_select(0, idx), inputs["attention_mask"].index_select(0, idx),
+                               token_type_ids)[0]
+        for i, row in zip(misses, logits.float().cpu().numpy()):
+            cache.put(texts[i], row)
+            rows[i] = row
+    return torch.from_numpy(np.stack(rows))
+
+
+def evaluate(args, model, eval_dataset, mode, global_step=None, writer=None, tokenizer=None, plot_pca=True,
+             embs=None, save=True, cache=None):
     results = {}
-    eval_sampler = SequentialSampler(eval_dataset)
+    eval_sampler = None if isinstance(eval_dataset, IterableDataset) else SequentialSampler(eval_dataset)
     eval_dataloader = DataLoader(eval_dataset, sampler=eval_sampler, batch_size=args.eval_batch_size)
 
     # Eval!
@@ -50,102 +118,118 @@ def evaluate(args, model, eval_dataset, mode, global_step=None):
     logger.info("  Eval Batch size = {}".format(args.eval_batch_size))
     eval_loss = 0.0
     nb_eval_steps = 0
-    preds = None
-    polarity_ids = None
-    intensity_ids = None
-    out_label_ids = None
-    txt_all = []
+    preds = []
+    out_label_ids = []
     ep_loss = []
     pcaDF = pd.DataFrame(columns=['principal component 1', 'principal component 2', "label"])
 
     for (batch, txt) in progress_bar(eval_dataloader):
         model.eval()
-        txt_all = txt_all + list(txt)
         batch = tuple(t.to(args.device) for t in batch)
 
         with torch.no_grad():
-            model.eval()
-            batch = tuple(t.to(args.device) for t in batch)
-
-            with torch.no_grad():
-                if len(batch) == 4:
-                    inputs = {
-                        "input_ids": batch[0],
-                        "attention_mask": batch[1],
-                        "token_type_ids": batch[2],
-                        "labels": batch[3]
-                    }
-                else:
-                    inputs = {
-                        "input_ids": batch[0],
-                        "attention_mask": batch[1],
-                        "token_type_ids": None,
-                        "labels": batch[2]
-                    }
-
-            outputs = model(**inputs)
-            tmp_eval_loss, logits = outputs[:2]
-            emb = outputs[2].detach().cpu().numpy()
-            labels = inputs["labels"].detach().cpu().numpy()
+            if len(batch) == 4:
+                inputs = {
+                    "input_ids": batch[0],
+                    "attention_mask": batch[1],
+                    "token_type_ids": batch[2],
+                    "labels": batch[3]
+                }
+            else:
+                inputs = {
+                    "input_ids": batch[0],
+                    "attention_mask": batch[1],
+                    "token_type_ids": None,
+                    "labels": batch[2]
+                }
 
-            pca = PCA(n_components=2)
-            principalComponents = pca.fit_transform(emb)
-            principalDf = pd.DataFrame(data=principalComponents
-                                       , columns=['principal component 1', 'principal component 2'])
-            principalDf["label"] = labels
-            pcaDF = pd.concat([pcaDF,principalDf], ignore_index=True)
-
-            if type(tmp_eval_loss) == tuple:
-                # print(list(map(lambda x:x.item(),tmp_eval_loss)))
-                ep_loss.append(list(map(lambda x: x.item(), tmp_eval_loss)))
-                tmp_eval_loss = sum(tmp_eval_loss)
+            labels = inputs["labels"].detach().cpu().numpy()
+            if cache is not None:
+                # no loss and no embeddings on this path, main() rules out --save_embs and the pca plot
+                logits = cached_logits(model, cache, inputs, list(txt))
             else:
-                ep_loss.append([tmp_eval_loss.item()])
+                outputs = model(**inputs)
+                tmp_eval_loss, logits = outputs[:2]
+                if embs is not None:
+                    embs.append(outputs[2].detach().float().cpu().numpy())
+
+                if plot_pca:
+                    emb = outputs[2].detach().cpu().numpy()
+                    pca = PCA(n_components=2)
+                    principalComponents = pca.fit_transform(emb)
+                    principalDf = pd.DataFrame(data=principalComponents
+                                               , columns=['principal component 1', 'principal component 2'])
+                    principalDf["label"] = labels
+                    pcaDF = pd.concat([pcaDF,principalDf], ignore_index=True)
+
+                if type(tmp_eval_loss) == tuple:
+                    # print(list(map(lambda x:x.item(),tmp_eval_loss)))
+                    ep_loss.append(list(map(lambda x: x.item(), tmp_eval_loss)))
+                    tmp_eval_loss = sum(tmp_eval_loss)
+                else:
+                    ep_loss.append([tmp_eval_loss.item()])
 
-            eval_loss += tmp_eval_loss.mean().item()
+                eval_loss += tmp_eval_loss.mean().item()
         nb_eval_steps += 1
-        if preds is None:
-            preds = logits.detach().cpu().numpy()
-            out_label_ids = inputs["labels"].detach().cpu().numpy()
-        else:
-            preds = np.append(preds, logits.detach().cpu().numpy(), axis=0)
-            out_label_ids = np.append(out_label_ids, inputs["labels"].detach().cpu().numpy(), axis=0)
+        batch_preds = logits.detach().argmax(dim=1).cpu().numpy()
+        preds.append(batch_preds)
+        out_label_ids.append(labels)
+
+        if writer is not None:
+            columns = {
+                "data": list(txt),
+                "pred": batch_preds,
+                "label": labels,
+                "result": batch_preds == labels,
+                "prob": F.softmax(logits.detach().float(), dim=1).cpu().numpy().tolist()
+            }
+            if tokenizer is not None:
+                columns["tokenizer"] = decode_tokens(tokenizer, inputs["input_ids"], inputs["attention_mask"])
+            writer.write(columns)
 
     eval_loss = eval_loss / nb_eval_steps
-    preds = np.argmax(preds, axis=1)
-
-    fig = plt.figure(figsize=(8, 8))
-    ax = fig.add_subplot(1, 1, 1)
-    ax.set_xlabel('Principal Component 1', fontsize=15)
-    ax.set_ylabel('Principal Component 2', fontsize=15)
-    ax.set_title('2 Component PCA', fontsize=20)
-
-    colors = ["#7fc97f", "#beaed4", "#fdc086", "#ffff99", "#386cb0", "#f0027f", "", "#666666"]
-    label_list = set(labels)
-    colors = colors[:len(label_list)]
-    print(pcaDF)
-    for label, color in zip(label_list, colors):
-        indicesToKeep = pcaDF['label'] == label
-        ax.scatter(pcaDF.loc[indicesToKeep, 'principal component 1']
-                   , pcaDF.loc[indicesToKeep, 'principal component 2']
-                   , c=color
-                   , s=10)
-
-    ax.legend(label_list)
-    ax.grid()
-    plt.show()
-
-    kmeans = KMeans(n_clusters=2, random_state=0).fit(pcaDF.loc[:,['principal component 1','principal component 2']])
-    print(kmeans.labels_)
-    print(completeness_score(pcaDF['label'], kmeans.labels_))
-    dbscan = DBSCAN(eps=3, min_samples=2).fit(pcaDF.loc[:,['principal component 1','principal component 2']])
-    print(dbscan.labels_)
-    print(set(dbscan.labels_))
-    print(completeness_score(pcaDF['label'], dbscan.labels_))
+    preds = np.concatenate(preds)
+    out_label_ids = np.concatenate(out_label_ids)
+
+    if plot_pca:
+        fig = plt.figure(figsize=(8, 8))
+        ax = fig.add_subplot(1, 1, 1)
+        ax.set_xlabel('Principal Component 1', fontsize=15)
+        ax.set_ylabel('Principal Component 2', fontsize=15)
+        ax.set_title('2 Component PCA', fontsize=20)
+
+        colors = ["#7fc97f", "#beaed4", "#fdc086", "#ffff99", "#386cb0", "#f0027f", "", "#666666"]
+        label_list = set(labels)
+        colors = colors[:len(label_list)]
+        print(pcaDF)
+        for label, color in zip(label_list, colors):
+            indicesToKeep = pcaDF['label'] == label
+            ax.scatter(pcaDF.loc[indicesToKeep, 'principal component 1']
+                       , pcaDF.loc[indicesToKeep, 'principal component 2']
+                       , c=color
+                       , s=10)
+
+        ax.legend(label_list)
+        ax.grid()
+        plt.show()
+
+        kmeans = KMeans(n_clusters=2, random_state=0).fit(pcaDF.loc[:,['principal component 1','principal component 2']])
+        print(kmeans.labels_)
+        print(completeness_score(pcaDF['label'], kmeans.labels_))
+        dbscan = DBSCAN(eps=3, min_samples=2).fit(pcaDF.loc[:,['principal component 1','principal component 2']])
+        print(dbscan.labels_)
+        print(set(dbscan.labels_))
+        print(completeness_score(pcaDF['label'], dbscan.labels_))
 
     result = compute_metrics(out_label_ids, preds)
     results.update(result)
+    if save:
+        save_results(args, results, mode, global_step)
+
+    return preds, out_label_ids, results
+
 
+def save_results(args, results, mode, global_step=None):
     output_dir = os.path.join(args.output_dir, mode)
     if not os.path.exists(output_dir):
         os.makedirs(output_dir)
@@ -158,7 +242,90 @@ def evaluate(args, model, eval_dataset, mode, global_step=None):
             logger.info("  {} = {}".format(key, str(results[key])))
             f_w.write("  {} = {}\n".format(key, str(results[key])))
 
-    return preds, out_label_ids, results, txt_all
+
+def load_model(args, cli_args, model_link, labelNumber, checkpoint):
+    construct_start = time.time()
+    model = load_checkpoint(os.path.join("ckpt", cli_args.result_dir, checkpoint), cli_args.model_mode, model_link,
+                            args, labelNumber, -0.75)
+    logger.info("Built {} on {} in {:.2f}s".format(cli_args.model_mode, model_link, time.time() - construct_start))
+    return model
+
+
+def evaluate_shard(rank, args, cli_args, model_link, labelNumber, checkpoint, eval_dataset, bounds, shard_dir,
+                   tokenizer=None):
+    # one worker of evaluate_sharded(): its own model copy, a pinned intra-op thread count and one
+    # contiguous slice of the eval set. everything it produces lands in shard_dir under its rank
+    torch.set_num_threads(cli_args.threads_per_worker)
+    init_logger()
+    model = load_model(args, cli_args, model_link, labelNumber, checkpoint)
+    shard = Subset(eval_dataset, range(bounds[rank], bounds[rank + 1]))
+    writer = ResultWriter(os.path.join(shard_dir, "result_{}.{}".format(rank, cli_args.export_format)),
+                          cli_args.export_chunk_size)
+    embs = [] if cli_args.save_embs else None
+    preds, out_label_ids, _ = evaluate(args, model, shard, "test_shard_{}".format(rank), writer=writer,
+                                       tokenizer=tokenizer, plot_pca=False, embs=embs, save=False)
+    writer.close()
+    np.save(os.path.join(shard_dir, "preds_{}.npy".format(rank)), preds)
+    np.save(os.path.join(shard_dir, "labels_{}.npy".format(rank)), out_label_ids)
+    if embs is not None:
+        np.save(os.path.join(shard_dir, "embs_{}.npy".format(rank)), np.concatenate(embs))
+
+
+def evaluate_sharded(args, cli_args, model_link, labelNumber, checkpoint, eval_dataset, mode, global_step=None,
+                     result_path=None, embs_path=None, tokenizer=None):
+    # splits one eval set into num_workers contiguous shards scored by parallel processes, then
+    # merges predictions, result rows and embeddings back in dataset order and computes metrics once
+    if isinstance(eval_dataset, IterableDataset):
+        raise ValueError("Sharded evaluation needs a map-style dataset, not the stream backend")
+    # no worker may get an empty shard, evaluate() and the merges below expect at least one row each
+    num_workers = max(min(cli_args.num_workers, len(eval_dataset)), 1)
+    bounds = [len(eval_dataset) * i // num_workers for i in range(num_workers + 1)]
+    shard_dir = os.path.join(args.output_dir, mode, "shards")
+    if not os.path.exists(shard_dir):
+        os.makedirs(shard_dir)
+    logger.info("***** Running sharded Test on {} dataset: {} workers x {} threads *****".format(
+        mode, num_workers, cli_args.threads_per_worker))
+
+    start = time.time()
+    mp.spawn(evaluate_shard, nprocs=num_workers,
+             args=(args, cli_args, model_link, labelNumber, checkpoint, eval_dataset, bounds, shard_dir, tokenizer))
+    logger.info("  Shards finished in {:.2f}s".format(time.time() - start))
+
+    preds = np.concatenate([np.load(os.path.join(shard_dir, "preds_{}.npy".format(r))) for r in range(num_workers)])
+    out_label_ids = np.concatenate([np.load(os.path.join(shard_dir, "labels_{}.npy".format(r)))
+                                    for r in range(num_workers)])
+    results = compute_metrics(out_label_ids, preds)
+    save_results(args, results, mode, global_step)
+
+    if result_path is not None:
+        writer = ResultWriter(result_path, cli_args.export_chunk_size)
+        for r in range(num_workers):
+            shard_path = os.path.join(shard_dir, "result_{}.{}".format(r, cli_args.export_format))
+            if not os.path.isfile(shard_path):
+                continue
+            if cli_args.export_format == "parquet":
+                import pyarrow.parquet as pq
+                for batch in pq.ParquetFile(shard_path).iter_batches(batch_size=cli_args.export_chunk_size):
+                    writer.write(batch.to_pandas())
+            else:
+                # every column as the text the shard wrote, so texts like "NA" or "null" stay strings
+                for chunk in pd.read_csv(shard_path, chunksize=cli_args.export_chunk_size, keep_default_na=False,
+                                         dtype=str):
+                    writer.write(chunk)
+        writer.close()
+
+    if embs_path is not None:
+        shards = [np.load(os.path.join(shard_dir, "embs_{}.npy".format(r)), mmap_mode="r") for r in range(num_workers)]
+        merged = np.lib.format.open_memmap(embs_path, mode="w+", dtype=shards[0].dtype,
+                                           shape=(sum(len(e) for e in shards), shards[0].shape[1]))
+        offset = 0
+        for e in shards:
+            merged[offset:offset + len(e)] = e
+            offset += len(e)
+        merged.flush()
+    shutil.rmtree(shard_dir)
+
+    return preds, out_label_ids, results
 
 
 def main(cli_args):
@@ -178,17 +345,7 @@ def main(cli_args):
     init_logger()
     set_seed(args)
 
-    model_link = None
-    if cli_args.transformer_mode.upper() == "T5":
-        model_link = "t5-base"
-    elif cli_args.transformer_mode.upper() == "ELECTRA":
-        model_link = "google/electra-base-discriminator"
-    elif cli_args.transformer_mode.upper() == "ALBERT":
-        model_link = "albert-base-v2"
-    elif cli_args.transformer_mode.upper() == "ROBERTA":
-        model_link = "roberta-base"
-    elif cli_args.transformer_mode.upper() == "BERT":
-        model_link = "bert-base-uncased"
+    model_link = resolve_model_link(cli_args.transformer_mode, args.get("model_registry"))
 
     tokenizer = AutoTokenizer.from_pretrained(model_link)
 
@@ -196,9 +353,9 @@ def main(cli_args):
     args.dev_file = os.path.join(cli_args.dataset, args.train_file)
     args.train_file = os.path.join(cli_args.dataset, args.train_file)
     # Load dataset
-    train_dataset = BaseDataset(args, tokenizer, mode="train") if args.train_file else None
-    dev_dataset = BaseDataset(args, tokenizer, mode="dev") if args.dev_file else None
-    test_dataset = BaseDataset(args, tokenizer, mode="test") if args.test_file else None
+    train_dataset = load_dataset(args, tokenizer, mode="train") if args.train_file else None
+    dev_dataset = load_dataset(args, tokenizer, mode="dev") if args.dev_file else None
+    test_dataset = load_dataset(args, tokenizer, mode="test") if args.test_file else None
 
     if dev_dataset == None:
         args.evaluate_test_during_training = True  # If there is no dev dataset, only use testset
@@ -208,38 +365,38 @@ def main(cli_args):
     labelNumber = train_dataset.getLabelNumber()
 
     labels = [str(i) for i in range(labelNumber)]
-    config = AutoConfig.from_pretrained(model_link)
-
-    args.device = "cuda:{}".format(cli_args.gpu) if torch.cuda.is_available() and not args.no_cuda else "cpu"
-    config.device = args.device
-    args.model_mode = cli_args.model_mode
 
     logger.info("Testing model checkpoint to {}".format(max_checkpoint))
     global_step = max_checkpoint.split("-")[-1]
 
-    # GPU or CPU
-    args.device = "cuda:{}".format(cli_args.gpu) if torch.cuda.is_available() and not args.no_cuda else "cpu"
-    config.device = args.device
-    args.model_mode = cli_args.model_mode
-
-    model = MODEL_LIST[cli_args.model_mode](model_link, args.model_type, args.model_name_or_path, config, labelNumber, -0.75)
-    model.load_state_dict(torch.load(os.path.join("ckpt", cli_args.result_dir, max_checkpoint, "training_model.bin")))
-
-    model.to(args.device)
-
-    preds, labels, result, txt_all= evaluate(args, model, test_dataset, mode="test",
-                                                                               global_step=global_step)
-    pred_and_labels = pd.DataFrame([])
-    pred_and_labels["data"] = txt_all
-    pred_and_labels["pred"] = preds
-    pred_and_labels["label"] = labels
-    pred_and_labels["result"] = preds == labels
-    decode_result = list(
-        pred_and_labels["data"].apply(lambda x: tokenizer.convert_ids_to_tokens(tokenizer(x)["input_ids"])))
-    pred_and_labels["tokenizer"] = decode_result
-
-    pred_and_labels.to_csv(os.path.join("ckpt", cli_args.result_dir, "test_result_" + max_checkpoint + ".csv"),
-                             encoding="utf-8")
+    result_path = os.path.join("ckpt", cli_args.result_dir, "test_result_" + max_checkpoint + "." + cli_args.export_format)
+    embs_path = os.path.join("ckpt", cli_args.result_dir, "test_embs_" + max_checkpoint + ".npy") \
+        if cli_args.save_embs else None
+    if cli_args.cache_mb > 0 and (cli_args.num_workers > 1 or cli_args.save_embs or not cli_args.skip_pca):
+        raise ValueError("--cache_mb needs a single worker, --skip_pca and no --save_embs: "
+                         "cached rows have no embeddings")
+    if cli_args.num_workers > 1:
+        preds, labels, result = evaluate_sharded(args, cli_args, model_link, labelNumber, max_checkpoint, test_dataset,
+                                                 mode="test", global_step=global_step, result_path=result_path,
+                                                 embs_path=embs_path,
+                                                 tokenizer=None if cli_args.skip_tokens else tokenizer)
+        return
+
+    model = load_model(args, cli_args, model_link, labelNumber, max_checkpoint)
+    cache = open_cache(args, cli_args)
+
+    writer = ResultWriter(result_path, cli_args.export_chunk_size)
+    embs = [] if cli_args.save_embs else None
+    start = time.time()
+    preds, labels, result = evaluate(args, model, test_dataset, mode="test", global_step=global_step, writer=writer,
+                                     tokenizer=None if cli_args.skip_tokens else tokenizer,
+                                     plot_pca=not cli_args.skip_pca, embs=embs, cache=cache)
+    writer.close()
+    if cache is not None:
+        logger.info("Prediction cache {}, test pass {:.2f}s".format(cache.stats(), time.time() - start))
+        cache.save()
+    if embs is not None:
+        np.save(embs_path, np.concatenate(embs))
 
 
 if __name__ == '__main__':
@@ -253,6 +410,15 @@ if __name__ == '__main__':
     cli_parser.add_argument("--transformer_mode", type=str, required=True)
     cli_parser.add_argument("--gpu", type=str, default = 0)
     cli_parser.add_argument("--margin", type=float, default = -0.5)
+    cli_parser.add_argument("--export_format", type=str, default="csv", choices=["csv", "parquet"])
+    cli_parser.add_argument("--export_chunk_size", type=int, default=10000)
+    cli_parser.add_argument("--skip_tokens", action="store_true")
+    cli_parser.add_argument("--skip_pca", action="store_true")
+    cli_parser.add_argument("--save_embs", action="store_true")
+    cli_parser.add_argument("--num_workers", type=int, default=1)
+    cli_parser.add_argument("--threads_per_worker", type=int, default=1)
+    cli_parser.add_argument("--cache_mb", type=float, default=0)
+    cli_parser.add_argument("--cache_file", type=str, default=None)
 
     cli_args = cli_parser.parse_args()
 
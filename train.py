@@ -1,12 +1,17 @@
 import argparse
 import glob
+import itertools
 import json
 import logging
+import math
 import numpy as np
 import os
+import pickle
+import random
+import time
 from attrdict import AttrDict
 from fastprogress.fastprogress import master_bar, progress_bar
-from torch.utils.data import DataLoader, RandomSampler, SequentialSampler
+from torch.utils.data import DataLoader, IterableDataset, SequentialSampler, Subset
 from transformers import (
     AdamW,
     get_linear_schedule_with_warmup,
@@ -14,45 +19,261 @@ from transformers import (
     AutoConfig
 )
 
-from datasets import DATASET_LIST, BaseDataset
+from datasets import DATASET_LIST, BaseDataset, PackedCollator, ResumableSampler, load_dataset
 from model import *
 from src import (
     CONFIG_CLASSES,
     TOKENIZER_CLASSES,
     init_logger,
     set_seed,
-    compute_metrics
+    compute_metrics,
+    MetricsLogger,
+    MemoryProfiler,
+    tune_batch_size,
+    resolve_model_link
 )
 import inspect
 
 logger = logging.getLogger(__name__)
 
 
+def make_inputs(batch):
+    if len(batch) == 5:
+        # packed rows from PackedCollator
+        inputs = {
+            "input_ids": batch[0],
+            "attention_mask": batch[1],
+            "token_type_ids": None,
+            "position_ids": batch[2],
+            "cls_index": batch[3],
+            "labels": batch[4]
+        }
+    elif len(batch) == 4:
+        inputs = {
+            "input_ids": batch[0],
+            "attention_mask": batch[1],
+            "token_type_ids": batch[2],
+            "labels": batch[3]
+        }
+    else:
+        inputs = {
+            "input_ids": batch[0],
+            "attention_mask": batch[1],
+            "token_type_ids": None,
+            "labels": batch[2]
+        }
+    return inputs
+
+
+def freeze_layers(model, args, epoch):
+    # freezes the embeddings and the bottom "freeze_layers" encoder layers, then gives back the top-most
+    # frozen one every "unfreeze_every" epochs. frozen weights get no grad, so backward stops below the
+    # lowest trainable layer and AdamW never allocates their moment tensors
+    if getattr(model, "lora", False):
+        # the whole encoder is already frozen behind its adapters
+        return 0
+    units = []
+    if args.get("freeze_embeddings", False):
+        units.append(model.emb.embeddings if hasattr(model.emb, "embeddings") else model.emb.get_input_embeddings())
+    if args.get("freeze_layers", 0) > 0:
+        units += list(encoder_layers(model.emb)[:args.freeze_layers])
+    unfreeze_every = args.get("unfreeze_every", 0)
+    n_frozen = max(len(units) - (epoch // unfreeze_every if unfreeze_every > 0 else 0), 0)
+    for i, unit in enumerate(units):
+        for p in unit.parameters():
+            p.requires_grad = i >= n_frozen
+    return n_frozen
+
+
+def score_examples(args, model, train_dataset):
+    # one eval-mode pass over the train split in dataset order: per-example cross entropy of the logits,
+    # the margin of the own label vector over the closest other one (logit margin without star_emb),
+    # and whether the prediction is correct
+    model = model.base if isinstance(model, EarlyExit) else model
+    dataloader = DataLoader(train_dataset, sampler=SequentialSampler(train_dataset), batch_size=args.eval_batch_size)
+    losses, margins, corrects, labels = [], [], [], []
+    model.eval()
+    for (batch, txt) in progress_bar(dataloader):
+        inputs = make_inputs(tuple(t.to(args.device) for t in batch))
+        with torch.no_grad():
+            logits, sims = model.predict(inputs["input_ids"], inputs["attention_mask"], inputs["token_type_ids"],
+                                         return_sims=True)
+        logits = logits.float()
+        scores = sims.float() if sims is not None else logits
+        own = scores.gather(1, inputs["labels"].unsqueeze(1)).squeeze(1)
+        others = scores.scatter(1, inputs["labels"].unsqueeze(1), float("-inf")).max(dim=1)[0]
+        losses.append(F.cross_entropy(logits, inputs["labels"], reduction="none"))
+        margins.append(own - others)
+        corrects.append(logits.argmax(dim=1) == inputs["labels"])
+        labels.append(inputs["labels"])
+    return {k: torch.cat(v).cpu().numpy() for k, v in
+            [("loss", losses), ("margin", margins), ("correct", corrects), ("label", labels)]}
+
+
+def select_examples(passes, keep, score="margin"):
+    # ranks the examples by difficulty over the scoring passes and keeps the `keep` fraction of the hardest
+    # within every label, so no label is pruned away. "loss" is the mean loss, "margin" the mean margin to
+    # the own label vector, "forgetting" the correct -> wrong flips between passes (never learned counts
+    # as forgotten every pass), ties broken by margin
+    margin = np.mean([p["margin"] for p in passes], axis=0)
+    if score == "loss":
+        difficulty = np.mean([p["loss"] for p in passes], axis=0)
+    elif score == "margin":
+        difficulty = -margin
+    elif score == "forgetting":
+        corrects = np.stack([p["correct"] for p in passes])
+        forgetting = (corrects[:-1] & ~corrects[1:]).sum(axis=0)
+        forgetting[~corrects.any(axis=0)] = len(passes)
+        difficulty = forgetting - margin / (np.abs(margin).max() + 1) / 2
+    else:
+        raise ValueError("Unknown prune_score {}".format(score))
+
+    kept = []
+    labels = passes[-1]["label"]
+    for label in np.unique(labels):
+        idx = np.nonzero(labels == label)[0]
+        n = max(int(round(len(idx) * keep)), 1)
+        kept.append(idx[np.argsort(-difficulty[idx], kind="stable")[:n]])
+    return np.sort(np.concatenate(kept)).tolist()
+
+
+def optimizer_state_size(optimizer):
+    return sum(v.numel() * v.element_size() for state in optimizer.state.values()
+               for v in state.values() if torch.is_tensor(v))
+
+
+def save_training_state(output_dir, model, optimizer, scheduler, epoch, step, global_step,
+                        tr_loss, best_acc, ep_loss, ep_steps, loss_history,
+                        sparse_optimizer=None, sparse_scheduler=None):
+    # everything needed to continue mid-epoch after preemption. written to a temp file first so a
+    # job killed while saving never leaves a half written snapshot behind
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+    state = {
+        "model": checkpoint_state_dict(model),
+        "optimizer": optimizer.state_dict(),
+        "scheduler": scheduler.state_dict(),
+        "torch_rng": torch.get_rng_state(),
+        "cuda_rng": torch.cuda.get_rng_state_all() if torch.cuda.is_available() else [],
+        "epoch": epoch,
+        "step": step,
+        "global_step": global_step,
+        "tr_loss": tr_loss,
+        "best_acc": float(best_acc),
+        "ep_loss": ep_loss,
+        "ep_steps": ep_steps,
+        "loss_history": loss_history
+    }
+    if sparse_optimizer is not None:
+        state["sparse_optimizer"] = sparse_optimizer.state_dict()
+        state["sparse_scheduler"] = sparse_scheduler.state_dict()
+    torch.save(state, os.path.join(output_dir, "training_state.pt.tmp"))
+    with open(os.path.join(output_dir, "rng_state.pkl.tmp"), "wb") as fp:
+        pickle.dump({"python": random.getstate(), "numpy": np.random.get_state()}, fp)
+    os.replace(os.path.join(output_dir, "rng_state.pkl.tmp"), os.path.join(output_dir, "rng_state.pkl"))
+    os.replace(os.path.join(output_dir, "training_state.pt.tmp"), os.path.join(output_dir, "training_state.pt"))
+    logger.info("Saving training snapshot to {} (epoch {}, step {})".format(output_dir, epoch, step))
+
+
+def save_best_checkpoint(args, model, optimizer, scheduler, best_acc, acc):
+    # checkpoint-best keeps the weights of the highest dev accuracy so far, returns the new best
+    if float(best_acc) > float(acc):
+        return best_acc
+    output_dir = os.path.join(args.output_dir, "checkpoint-best")
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+    torch.save(checkpoint_state_dict(model), os.path.join(output_dir, "training_model.bin"))
+    torch.save(args, os.path.join(output_dir, "training_args.bin"))
+    with open(os.path.join(output_dir,"model_code.txt"),"w") as fp:
+        fp.writelines(inspect.getsource(MODEL_LIST[args.model_mode]))
+    logger.info("Saving model checkpoint to {} ({:.1f}MB)".format(
+        output_dir, os.path.getsize(os.path.join(output_dir, "training_model.bin")) / 2 ** 20))
+
+    if args.save_optimizer:
+        torch.save(optimizer.state_dict(), os.path.join(output_dir, "optimizer.pt"))
+        torch.save(scheduler.state_dict(), os.path.join(output_dir, "scheduler.pt"))
+        logger.info("Saving optimizer and scheduler states to {}".format(output_dir))
+    return acc
+
+
+def load_training_state(output_dir, model, optimizer, scheduler, sparse_optimizer=None, sparse_scheduler=None):
+    state = torch.load(os.path.join(output_dir, "training_state.pt"), map_location="cpu")
+    model.load_state_dict(state["model"], strict=not getattr(model, "lora", False))
+    optimizer.load_state_dict(state["optimizer"])
+    scheduler.load_state_dict(state["scheduler"])
+    if sparse_optimizer is not None and "sparse_optimizer" in state:
+        sparse_optimizer.load_state_dict(state["sparse_optimizer"])
+        sparse_scheduler.load_state_dict(state["sparse_scheduler"])
+    torch.set_rng_state(state["torch_rng"])
+    if state["cuda_rng"] and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state["cuda_rng"])
+    with open(os.path.join(output_dir, "rng_state.pkl"), "rb") as fp:
+        rng_state = pickle.load(fp)
+    random.setstate(rng_state["python"])
+    np.random.set_state(rng_state["numpy"])
+    return state
+
+
 def train(args,
           model,
           train_dataset,
           dev_dataset=None,
-          test_dataset=None):
-    train_sampler = RandomSampler(train_dataset)
-    train_dataloader = DataLoader(train_dataset, sampler=train_sampler, batch_size=args.train_batch_size)
+          test_dataset=None,
+          epoch_callback=None):
+    # data pruning: "prune_indices" trains on the examples an earlier run kept, "prune_keep" < 1 scores every
+    # example after each of the first "prune_epochs" epochs and trains the remaining epochs on the hardest ones
+    full_dataset = train_dataset
+    prune_keep = args.get("prune_keep", 1.0)
+    prune_epochs = args.get("prune_epochs", 2) if prune_keep < 1 else 0
+    prune_file = os.path.join(args.output_dir, "pruned_examples.json")
+    if (prune_epochs > 0 or args.get("prune_indices")) and isinstance(train_dataset, IterableDataset):
+        raise ValueError("Data pruning needs a map-style train dataset, not the stream backend")
+    if args.get("prune_indices"):
+        with open(args.prune_indices) as fp:
+            train_dataset = Subset(full_dataset, json.load(fp)["kept"])
+        prune_epochs = 0
+
+    # streaming datasets shuffle through their own buffer
+    collate_fn = PackedCollator(args.max_seq_len, args.pad_token_id, args.position_offset) if args.get("packing", False) else None
+
+    def make_dataloader(dataset):
+        sampler = None if isinstance(dataset, IterableDataset) else ResumableSampler(dataset, args.seed)
+        return sampler, DataLoader(dataset, sampler=sampler, batch_size=args.train_batch_size, collate_fn=collate_fn)
+
+    train_sampler, train_dataloader = make_dataloader(train_dataset)
     if args.max_steps > 0:
         t_total = args.max_steps
         args.num_train_epochs = args.max_steps // (len(train_dataloader) // args.gradient_accumulation_steps) + 1
+    elif prune_epochs > 0:
+        pruned_steps = math.ceil(len(train_dataset) * prune_keep / args.train_batch_size)
+        t_total = (len(train_dataloader) * min(prune_epochs, args.num_train_epochs) +
+                   pruned_steps * max(args.num_train_epochs - prune_epochs, 0)) // args.gradient_accumulation_steps
     else:
         t_total = len(train_dataloader) // args.gradient_accumulation_steps * args.num_train_epochs
+    steps_per_epoch = len(train_dataloader)
 
     # Prepare optimizer and schedule (linear warmup and decay)
     no_decay = ['bias', 'LayerNorm.weight']
     weight_decay_change = 'sentiment_embedding.weight'
+    # sparse embeddings (sparse_star_emb) get their gradients as touched rows only, which AdamW cannot take
+    sparse_names = [n + ".weight" for n, m in model.named_modules() if isinstance(m, nn.Embedding) and m.sparse]
+    dense_parameters = [(n, p) for n, p in model.named_parameters() if n not in sparse_names]
     optimizer_grouped_parameters = [
-        {'params': [p for n, p in model.named_parameters() if not any(nd in n for nd in no_decay) and not n in weight_decay_change],
+        {'params': [p for n, p in dense_parameters if not any(nd in n for nd in no_decay) and not n in weight_decay_change],
          'weight_decay': args.weight_decay},
-        {'params': [p for n, p in model.named_parameters() if any(nd in n for nd in no_decay) and not n in weight_decay_change], 'weight_decay': 0.0},
-        {'params': [p for n, p in model.named_parameters() if n in weight_decay_change], 'weight_decay': 0.3}
+        {'params': [p for n, p in dense_parameters if any(nd in n for nd in no_decay) and not n in weight_decay_change], 'weight_decay': 0.0},
+        {'params': [p for n, p in dense_parameters if n in weight_decay_change], 'weight_decay': 0.3}
     ]
     optimizer = AdamW(optimizer_grouped_parameters, lr=args.learning_rate, eps=args.adam_epsilon)
     scheduler = get_linear_schedule_with_warmup(optimizer, num_warmup_steps=args.warmup_steps,
                                                 num_training_steps=t_total)
+    sparse_optimizer = None
+    sparse_scheduler = None
+    if sparse_names:
+        sparse_optimizer = torch.optim.SparseAdam([p for n, p in model.named_parameters() if n in sparse_names],
+                                                  lr=args.learning_rate, eps=args.adam_epsilon)
+        sparse_scheduler = get_linear_schedule_with_warmup(sparse_optimizer, num_warmup_steps=args.warmup_steps,
+                                                           num_training_steps=t_total)
 
     if os.path.isfile(os.path.join(args.model_name_or_path, "optimizer.pt")) and os.path.isfile(
             os.path.join(args.model_name_or_path, "scheduler.pt")
@@ -73,31 +294,73 @@ def train(args,
 
     global_step = 0
     tr_loss = 0.0
+    best_acc = 0
+    acc = 0
+    start_epoch = 0
+    start_step = 0
+    ep_loss = None
+    ep_steps = 0
+    loss_history = []
+    # evaluation and checkpointing count global steps from here, moved to the pruning step afterwards
+    step_offset = 0
+    score_passes = []
+    scoring_seconds = 0.0
+    epoch_seconds = []
+    metrics = MetricsLogger(os.path.join(args.output_dir, "metrics.jsonl"), args.get("metrics_steps", 0))
+    profiler = MemoryProfiler(os.path.join(args.output_dir, "memory.jsonl"), args.get("memory_profile", False),
+                              args.device)
+    if profiler.enabled:
+        profiler.record("dataset", full_dataset.nbytes())
+        profiler.record("model", sum(t.numel() * t.element_size()
+                                     for t in itertools.chain(model.parameters(), model.buffers())))
+
+    snapshot_dir = os.path.join(args.output_dir, "checkpoint-last")
+    if args.get("resume", False) and os.path.isfile(os.path.join(snapshot_dir, "training_state.pt")):
+        state = load_training_state(snapshot_dir, model, optimizer, scheduler, sparse_optimizer, sparse_scheduler)
+        global_step, tr_loss, best_acc = state["global_step"], state["tr_loss"], state["best_acc"]
+        start_epoch, start_step = state["epoch"], state["step"]
+        ep_steps, loss_history = state["ep_steps"], state["loss_history"]
+        ep_loss = torch.tensor(state["ep_loss"], device=args.device) if state["ep_loss"] is not None else None
+        acc = best_acc
+        logger.info("  Resuming from epoch {} step {} (global step {})".format(start_epoch, start_step, global_step))
+        if prune_epochs > 0 and start_epoch >= prune_epochs and os.path.isfile(prune_file):
+            with open(prune_file) as fp:
+                pruned = json.load(fp)
+            train_dataset = Subset(full_dataset, pruned["kept"])
+            train_sampler, train_dataloader = make_dataloader(train_dataset)
+            steps_per_epoch = len(train_dataloader)
+            step_offset = pruned["global_step"]
+            if args.logging_steps > 0:
+                args.logging_steps = args.save_steps = int(len(train_dataset) / args.train_batch_size) + 1
 
     model.zero_grad()
     mb = master_bar(range(int(args.num_train_epochs)))
-    best_acc = 0
-    acc = 0
     for epoch in mb:
+        if epoch < start_epoch:
+            continue
+        if epoch > start_epoch:
+            start_step = 0
+            ep_loss = None
+            ep_steps = 0
+        if train_sampler is not None:
+            # a resumed epoch replays the same order and skips the batches it already trained on
+            train_sampler.set_epoch(epoch, start_step * args.train_batch_size)
+        else:
+            # streaming datasets shuffle by epoch but cannot skip ahead, a resumed epoch starts over
+            train_dataset.set_epoch(epoch)
+            if start_step > 0:
+                logger.warning("Streaming datasets resume from the start of epoch {}".format(epoch))
+                start_step = 0
+                ep_loss = None
+                ep_steps = 0
+        n_frozen = freeze_layers(model, args, epoch)
         epoch_iterator = progress_bar(train_dataloader, parent=mb)
-        ep_loss = []
-        for step, (batch, txt) in enumerate(epoch_iterator):
+        ep_tokens = 0
+        ep_start = time.time()
+        for step, (batch, txt) in enumerate(epoch_iterator, start=start_step):
             model.train()
             batch = tuple(t.to(args.device) for t in batch)
-            if len(batch) == 4:
-                inputs = {
-                    "input_ids": batch[0],
-                    "attention_mask": batch[1],
-                    "token_type_ids": batch[2],
-                    "labels": batch[3]
-                }
-            else:
-                inputs = {
-                    "input_ids": batch[0],
-                    "attention_mask": batch[1],
-                    "token_type_ids": None,
-                    "labels": batch[2]
-                }
+            inputs = make_inputs(batch)
             if "KOSAC" in args.model_mode:
                 inputs["polarity_ids"] = batch[4]
                 inputs["intensity_ids"] = batch[5]
@@ -107,74 +370,126 @@ def train(args,
                 inputs["char_token_data"] = txt[1]
                 inputs["word_token_data"] = txt[2]
                 txt = txt[0]
-            outputs = model(**inputs)
+            mask = inputs["attention_mask"]
+            tokens = (mask.diagonal(dim1=1, dim2=2) if mask.dim() == 3 else mask).sum()
+            ep_tokens += tokens
+            with profiler.stage("forward"):
+                outputs = model(**inputs)
             # print(outputs)
             loss = outputs[0]
             # print(loss)
+            if type(loss) != tuple:
+                loss = (loss,)
             if args.gradient_accumulation_steps > 1:
-                loss = loss / args.gradient_accumulation_steps
-
-            if type(loss) == tuple:
-                # print(list(map(lambda x:x.item(),loss)))
-                ep_loss.append(list(map(lambda x: x.item(), loss)))
-                loss = sum(loss)
-            else:
-                ep_loss.append([loss.item()])
-
-            loss.backward()
-            tr_loss += loss.item()
+                loss = tuple(l / args.gradient_accumulation_steps for l in loss)
+
+            # loss terms stay on the device, they are only read back at logging boundaries
+            loss_terms = torch.stack([l.detach() for l in loss])
+            ep_loss = loss_terms if ep_loss is None else ep_loss + loss_terms
+            ep_steps += 1
+            loss = sum(loss)
+
+            with profiler.stage("backward"):
+                loss.backward()
+            tr_loss += loss.detach()
+            metrics.update(loss_terms, tokens, mask.shape[0] * mask.shape[-1], inputs["labels"].shape[0])
             if (step + 1) % args.gradient_accumulation_steps == 0 or (
-                    len(train_dataloader) <= args.gradient_accumulation_steps
-                    and (step + 1) == len(train_dataloader)
+                    steps_per_epoch <= args.gradient_accumulation_steps
+                    and (step + 1) == steps_per_epoch
             ):
-                torch.nn.utils.clip_grad_norm_(model.parameters(), args.max_grad_norm)
-
-                optimizer.step()
-                scheduler.step()
+                torch.nn.utils.clip_grad_norm_([p for n, p in dense_parameters], args.max_grad_norm)
+
+                with profiler.stage("optimizer"):
+                    optimizer.step()
+                    scheduler.step()
+                    if sparse_optimizer is not None:
+                        sparse_optimizer.step()
+                        sparse_scheduler.step()
+                if profiler.enabled:
+                    profiler.record("grads", sum(p.grad.numel() * p.grad.element_size()
+                                                 for p in model.parameters() if p.grad is not None))
                 model.zero_grad()
                 global_step += 1
+                metrics.step(epoch=epoch, global_step=global_step)
 
-                if args.logging_steps > 0 and global_step % args.logging_steps == 0:
-                    results = evaluate(args, model, dev_dataset, "dev", global_step)
+                if args.logging_steps > 0 and (global_step - step_offset) % args.logging_steps == 0 and epoch_callback is None:
+                    results = evaluate(args, model, dev_dataset, "dev", global_step, profiler)
                     acc = str(results['acc'])
 
-                if args.save_steps > 0 and global_step % args.save_steps == 0:
-                    # Save model checkpoint
-                    output_dir = os.path.join(args.output_dir, "checkpoint-best")
-
-                    if float(best_acc) <= float(acc):
-                        if not os.path.exists(output_dir):
-                            os.makedirs(output_dir)
-                        torch.save(model.state_dict(), os.path.join(output_dir, "training_model.bin"))
-                        torch.save(args, os.path.join(output_dir, "training_args.bin"))
-                        with open(os.path.join(output_dir,"model_code.txt"),"w") as fp:
-                            fp.writelines(inspect.getsource(MODEL_LIST[args.model_mode]))
+                # with an epoch_callback the dev evaluation, and so the checkpoint-best decision, is at epoch end
+                if args.save_steps > 0 and (global_step - step_offset) % args.save_steps == 0 and epoch_callback is None:
+                    best_acc = save_best_checkpoint(args, model, optimizer, scheduler, best_acc, acc)
 
-                        logger.info("Saving model checkpoint to {}".format(output_dir))
-                        temp = acc
-
-                    if args.save_optimizer:
-                        if float(best_acc) <= float(acc):
-                            torch.save(optimizer.state_dict(), os.path.join(output_dir, "optimizer.pt"))
-                            torch.save(scheduler.state_dict(), os.path.join(output_dir, "scheduler.pt"))
-                            logger.info("Saving optimizer and scheduler states to {}".format(output_dir))
-                    best_acc = temp
+                if args.get("snapshot_steps", 0) > 0 and global_step % args.snapshot_steps == 0:
+                    save_training_state(snapshot_dir, model, optimizer, scheduler, epoch, step + 1, global_step,
+                                        float(tr_loss), best_acc, ep_loss.tolist(), ep_steps, loss_history,
+                                        sparse_optimizer, sparse_scheduler)
 
             if args.max_steps > 0 and global_step > args.max_steps:
                 break
 
+        epoch_seconds.append(time.time() - ep_start)
+        loss_history.append((ep_loss / max(ep_steps, 1)).tolist() if ep_loss is not None else [])
         mb.write("Epoch {} done".format(epoch + 1))
-        mb.write("Epoch loss = {} ".format(np.mean(np.array(ep_loss), axis=0)))
+        mb.write("Epoch loss = {} ".format(np.array(loss_history[-1])))
+        mb.write("Epoch tokens/s = {:.1f} ".format(float(ep_tokens) / (time.time() - ep_start)))
+        mb.write("Epoch step time = {:.4f}s, frozen units = {}, trainable params = {}, optimizer state = {:.1f}MB".format(
+            (time.time() - ep_start) / max(step + 1 - start_step, 1), n_frozen,
+            sum(p.numel() for p in model.parameters() if p.requires_grad),
+            optimizer_state_size(optimizer) / 2 ** 20))
+        profiler.record("optimizer", optimizer_state_size(optimizer) +
+                        (optimizer_state_size(sparse_optimizer) if sparse_optimizer is not None else 0))
+        profiler.summary(epoch=epoch + 1, global_step=global_step)
+        if epoch < prune_epochs:
+            score_start = time.time()
+            score_passes.append(score_examples(args, model, full_dataset))
+            if epoch + 1 == prune_epochs:
+                kept = select_examples(score_passes, prune_keep, args.get("prune_score", "margin"))
+                with open(prune_file, "w") as fp:
+                    json.dump({"score": args.get("prune_score", "margin"), "keep": prune_keep,
+                               "passes": len(score_passes), "global_step": global_step, "kept": kept}, fp)
+                train_dataset = Subset(full_dataset, kept)
+                train_sampler, train_dataloader = make_dataloader(train_dataset)
+                steps_per_epoch = len(train_dataloader)
+                step_offset = global_step
+                if args.logging_steps > 0:
+                    args.logging_steps = args.save_steps = int(len(train_dataset) / args.train_batch_size) + 1
+                score_passes = []
+                mb.write("Pruned the train split to {} of {} examples by {}".format(
+                    len(kept), len(full_dataset), args.get("prune_score", "margin")))
+            scoring_seconds += time.time() - score_start
+        if epoch_callback is not None:
+            # e.g. search.py: dev accuracy after every epoch, returning False stops (prunes) the run
+            results = evaluate(args, model, dev_dataset, "dev", global_step, profiler)
+            acc = str(results['acc'])
+            best_acc = save_best_checkpoint(args, model, optimizer, scheduler, best_acc, acc)
+            if not epoch_callback(epoch, results['acc']):
+                logger.info("Stopping after epoch {}".format(epoch + 1))
+                break
+        # an epoch_callback run (a search trial) always snapshots at epoch end, so it can be resumed
+        if args.get("snapshot_steps", 0) > 0 or epoch_callback is not None:
+            save_training_state(snapshot_dir, model, optimizer, scheduler, epoch + 1, 0, global_step,
+                                float(tr_loss), best_acc, None, 0, loss_history,
+                                sparse_optimizer, sparse_scheduler)
 
         if args.max_steps > 0 and global_step > args.max_steps:
             break
 
-    return global_step, tr_loss / global_step
+    metrics.flush(epoch=epoch, global_step=global_step)
+    profiler.close()
+    # wall clock of every epoch (evaluation excluded) and of the scoring passes, read by prune_report.py
+    with open(os.path.join(args.output_dir, "train_time.json"), "w") as fp:
+        json.dump({"epoch_seconds": epoch_seconds, "scoring_seconds": scoring_seconds,
+                   "train_examples": len(full_dataset), "kept_examples": len(train_dataset),
+                   "prune_keep": prune_keep if prune_epochs > 0 else 1.0, "prune_epochs": prune_epochs,
+                   "prune_indices": args.get("prune_indices"), "best_acc": float(best_acc)}, fp, indent=2)
+    return global_step, float(tr_loss) / global_step
 
 
-def evaluate(args, model, eval_dataset, mode, global_step=None):
+def evaluate(args, model, eval_dataset, mode, global_step=None, profiler=None):
     results = {}
-    eval_sampler = SequentialSampler(eval_dataset)
+    profiler = profiler or MemoryProfiler(None)
+    eval_sampler = None if isinstance(eval_dataset, IterableDataset) else SequentialSampler(eval_dataset)
     eval_dataloader = DataLoader(eval_dataset, sampler=eval_sampler, batch_size=args.eval_batch_size)
 
     # Eval!
@@ -186,29 +501,17 @@ def evaluate(args, model, eval_dataset, mode, global_step=None):
     logger.info("  Eval Batch size = {}".format(args.eval_batch_size))
     eval_loss = 0.0
     nb_eval_steps = 0
-    preds = None
-    out_label_ids = None
-    ep_loss = []
+    preds = []
+    out_label_ids = []
+    ep_loss = 0.0
+    eval_with_loss = args.get("eval_loss", True)
 
     for (batch, txt) in progress_bar(eval_dataloader):
         model.eval()
         batch = tuple(t.to(args.device) for t in batch)
 
         with torch.no_grad():
-            if len(batch) == 4:
-                inputs = {
-                    "input_ids": batch[0],
-                    "attention_mask": batch[1],
-                    "token_type_ids": batch[2],
-                    "labels": batch[3]
-                }
-            else:
-                inputs = {
-                    "input_ids": batch[0],
-                    "attention_mask": batch[1],
-                    "token_type_ids": None,
-                    "labels": batch[2]
-                }
+            inputs = make_inputs(batch)
             if "KOSAC" in args.model_mode:
                 inputs["polarity_ids"] = batch[4]
                 inputs["intensity_ids"] = batch[5]
@@ -218,27 +521,28 @@ def evaluate(args, model, eval_dataset, mode, global_step=None):
                 inputs["char_token_data"] = txt[1]
                 inputs["word_token_data"] = txt[2]
                 txt = txt[0]
-            outputs = model(**inputs)
-            tmp_eval_loss, logits = outputs[:2]
-
-            if type(tmp_eval_loss) == tuple:
-                # print(list(map(lambda x:x.item(),tmp_eval_loss)))
-                ep_loss.append(list(map(lambda x: x.item(), tmp_eval_loss)))
-                tmp_eval_loss = sum(tmp_eval_loss)
+            if eval_with_loss:
+                with profiler.stage("eval_forward"):
+                    outputs = model(**inputs)
+                tmp_eval_loss, logits = outputs[:2]
+
+                if type(tmp_eval_loss) != tuple:
+                    tmp_eval_loss = (tmp_eval_loss,)
+                ep_loss = ep_loss + torch.stack(tmp_eval_loss)
+                eval_loss += sum(tmp_eval_loss).mean()
             else:
-                ep_loss.append([tmp_eval_loss.item()])
-
-            eval_loss += tmp_eval_loss.mean().item()
+                # label-free path: only logits, no loss terms are computed
+                with profiler.stage("eval_forward"):
+                    logits = model.predict(inputs["input_ids"], inputs["attention_mask"], inputs["token_type_ids"])[0]
         nb_eval_steps += 1
-        if preds is None:
-            preds = logits.detach().cpu().numpy()
-            out_label_ids = inputs["labels"].detach().cpu().numpy()
-        else:
-            preds = np.append(preds, logits.detach().cpu().numpy(), axis=0)
-            out_label_ids = np.append(out_label_ids, inputs["labels"].detach().cpu().numpy(), axis=0)
+        preds.append(logits.detach().argmax(dim=1))
+        out_label_ids.append(inputs["labels"].detach())
 
-    eval_loss = eval_loss / nb_eval_steps
-    preds = np.argmax(preds, axis=1)
+    eval_loss = float(eval_loss) / nb_eval_steps
+    preds = torch.cat(preds).cpu().numpy()
+    out_label_ids = torch.cat(out_label_ids).cpu().numpy()
+    if eval_with_loss:
+        ep_loss = (ep_loss / nb_eval_steps).cpu().numpy()
 
     result = compute_metrics(out_label_ids, preds)
     results.update(result)
@@ -254,13 +558,14 @@ def evaluate(args, model, eval_dataset, mode, global_step=None):
         for key in sorted(results.keys()):
             logger.info("  {} = {}".format(key, str(results[key])))
             f_w.write("  {} = {}\n".format(key, str(results[key])))
-            logger.info("Epoch loss = {} ".format(np.mean(np.array(ep_loss), axis=0)))
-            f_w.write("Epoch loss = {} ".format(np.mean(np.array(ep_loss), axis=0)))
+            if eval_with_loss:
+                logger.info("Epoch loss = {} ".format(ep_loss))
+                f_w.write("Epoch loss = {} ".format(ep_loss))
 
     return results
 
 
-def main(cli_args):
+def main(cli_args, overrides=None, epoch_callback=None):
     # Read from config file and make args
     with open(os.path.join(cli_args.config_dir, cli_args.config_file)) as f:
         args = AttrDict(json.load(f))
@@ -271,21 +576,14 @@ def main(cli_args):
     args.output_dir = os.path.join(args.ckpt_dir, cli_args.result_dir)
     args.model_mode = cli_args.model_mode
     args.margin = cli_args.margin
+    args.resume = cli_args.resume
+    if overrides:
+        args.update(overrides)
 
     init_logger()
     set_seed(args)
 
-    model_link = None
-    if cli_args.transformer_mode.upper() == "T5":
-        model_link = "t5-base"
-    elif cli_args.transformer_mode.upper() == "ELECTRA":
-        model_link = "google/electra-base-discriminator"
-    elif cli_args.transformer_mode.upper() == "ALBERT":
-        model_link = "albert-base-v2"
-    elif cli_args.transformer_mode.upper() == "ROBERTA":
-        model_link = "roberta-base"
-    elif cli_args.transformer_mode.upper() == "BERT":
-        model_link = "bert-base-uncased"
+    model_link = resolve_model_link(cli_args.transformer_mode, args.get("model_registry"))
 
     print(model_link)
     tokenizer = AutoTokenizer.from_pretrained(model_link)
@@ -294,9 +592,9 @@ def main(cli_args):
     args.dev_file = os.path.join(cli_args.dataset, args.dev_file)
     args.train_file = os.path.join(cli_args.dataset, args.train_file)
     # Load dataset
-    train_dataset = BaseDataset(args, tokenizer, mode="train") if args.train_file else None
-    dev_dataset = BaseDataset(args, tokenizer, mode="dev") if args.dev_file else None
-    test_dataset = BaseDataset(args, tokenizer, mode="test") if args.test_file else None
+    train_dataset = load_dataset(args, tokenizer, mode="train") if args.train_file else None
+    dev_dataset = load_dataset(args, tokenizer, mode="dev") if args.dev_file else None
+    test_dataset = load_dataset(args, tokenizer, mode="test") if args.test_file else None
 
     if dev_dataset == None:
         args.evaluate_test_during_training = True  # If there is no dev dataset, only use testset
@@ -307,19 +605,45 @@ def main(cli_args):
 
     labels = [str(i) for i in range(labelNumber)]
     config = AutoConfig.from_pretrained(model_link)
+    if args.get("packing", False):
+        if cli_args.model_mode == "Star_Label_AM_att":
+            raise ValueError("Sequence packing is not supported for Star_Label_AM_att")
+        args.pad_token_id = tokenizer.pad_token_id
+        # roberta counts positions from padding_idx + 1
+        args.position_offset = config.pad_token_id + 1 if config.model_type == "roberta" else 0
 
     # GPU or CPU
     args.device = "cuda:{}".format(cli_args.gpu) if torch.cuda.is_available() and not args.no_cuda else "cpu"
-    config.device = args.device
+    model_config(config, args)
     args.model_mode = cli_args.model_mode
 
 
 
+    construct_start = time.time()
     model = MODEL_LIST[cli_args.model_mode](model_link, args.model_type, args.model_name_or_path, config, labelNumber, args.margin)
+    if args.get("early_exit", False):
+        model = EarlyExit(model, exit_config(config, args), labelNumber)
+    if args.get("lora", False):
+        model = add_lora(model, lora_config(config, args))
+    logger.info("Built {} on {} in {:.2f}s".format(cli_args.model_mode, model_link, time.time() - construct_start))
     model.to(args.device)
 
+    if args.get("auto_batch", False):
+        logger.info("***** Tuning batch size *****")
+        args.update(tune_batch_size(model, args, config.vocab_size, labelNumber,
+                                    "token_type_ids" in tokenizer.model_input_names))
+        args.logging_steps = int(len(train_dataset) / args.train_batch_size) + 1
+        args.save_steps = args.logging_steps
+        # the probes drew random numbers, start training from the same seed as an untuned run
+        set_seed(args)
+
+    if args.get("compile", False):
+        example_batch, _ = next(iter(DataLoader(train_dataset, batch_size=args.train_batch_size)))
+        example_inputs = make_inputs(tuple(t.to(args.device) for t in example_batch))
+        model = compile_model(model, args, example_inputs)
+
     if args.do_train:
-        global_step, tr_loss = train(args, model, train_dataset, dev_dataset, test_dataset)
+        global_step, tr_loss = train(args, model, train_dataset, dev_dataset, test_dataset, epoch_callback)
         logger.info(" global_step = {}, average loss = {}".format(global_step, tr_loss))
 
     results = {}
@@ -359,6 +683,7 @@ if __name__ == '__main__':
     cli_parser.add_argument("--transformer_mode", type=str, required=True)
     cli_parser.add_argument("--gpu", type=str, default = 0)
     cli_parser.add_argument("--margin", type=float, default = -0.5)
+    cli_parser.add_argument("--resume", action="store_true")
 
     cli_args = cli_parser.parse_args()
 
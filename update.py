@@ -0,0 +1,191 @@
+import argparse
+import json
+import logging
+import os
+import random
+import time
+
+from fastprogress.fastprogress import progress_bar
+
+from datasets import get_data_path, iter_shard, list_shards, load_dataset
+from model import *
+from train import evaluate
+
+from src import (
+    init_logger,
+    set_seed,
+    resolve_model_link
+)
+
+from transformers import (
+    AdamW,
+    AutoTokenizer
+)
+
+logger = logging.getLogger(__name__)
+
+
+def iter_rows(data_path):
+    for shard in list_shards(data_path):
+        for txt, label in iter_shard(shard):
+            yield str(txt), int(label)
+
+
+def reservoir(rows, size, rng):
+    # uniform sample of `size` rows from a split of unknown length, in one pass and bounded memory
+    buffer = []
+    for i, row in enumerate(rows):
+        if len(buffer) < size:
+            buffer.append(row)
+        else:
+            j = rng.randint(0, i)
+            if j < size:
+                buffer[j] = row
+    return buffer
+
+
+def encode_batch(tokenizer, maxlen, rows, device):
+    data = tokenizer([txt for txt, _ in rows], padding="max_length", max_length=maxlen, truncation=True,
+                     return_tensors="pt")
+    inputs = {
+        "input_ids": data["input_ids"].to(device),
+        "attention_mask": data["attention_mask"].to(device),
+        "token_type_ids": data["token_type_ids"].to(device) if "token_type_ids" in data else None,
+        "labels": torch.LongTensor([label for _, label in rows]).to(device)
+    }
+    return inputs
+
+
+def new_label_prototypes(model, tokenizer, args, rows, old_labels, new_labels, device):
+    # a new label's vector starts at the mean CLS embedding of its first examples instead of at random,
+    # so the label vector loss does not first have to drag it across the space
+    sums = {label: torch.zeros(768, device=device) for label in new_labels}
+    counts = {label: 0 for label in new_labels}
+    batch = [row for row in rows if row[1] >= old_labels][:args.eval_batch_size]
+    if batch:
+        inputs = encode_batch(tokenizer, args.max_seq_len, batch, device)
+        with torch.no_grad():
+            embs = model.predict(inputs["input_ids"], inputs["attention_mask"], inputs["token_type_ids"],
+                                 return_embs=True)[1]
+        for emb, (_, label) in zip(embs, batch):
+            sums[label] += emb.float()
+            counts[label] += 1
+    init = torch.randn(len(new_labels), 768, device=device) * 0.02
+    for i, label in enumerate(new_labels):
+        if counts[label] > 0:
+            init[i] = sums[label] / counts[label]
+    return init
+
+
+def set_trainable(model, unfreeze_layers):
+    # head, star_emb (and exits) learn, the encoder stays frozen except its top unfreeze_layers layers
+    for p in model.parameters():
+        p.requires_grad = True
+    for p in model.emb.parameters():
+        p.requires_grad = False
+    if unfreeze_layers > 0:
+        layers = encoder_layers(model.emb)
+        for layer in layers[len(layers) - unfreeze_layers:]:
+            for p in layer.parameters():
+                p.requires_grad = True
+
+
+def main(cli_args):
+    checkpoint_dir = os.path.join("ckpt", cli_args.result_dir, "checkpoint-best")
+    args = torch.load(os.path.join(checkpoint_dir, "training_args.bin"))
+    init_logger()
+    set_seed(args)
+    rng = random.Random(args.seed)
+    args.device = "cuda:{}".format(cli_args.gpu) if torch.cuda.is_available() and not args.no_cuda else "cpu"
+    start = time.time()
+
+    model_link = resolve_model_link(cli_args.transformer_mode, args.get("model_registry"))
+    tokenizer = AutoTokenizer.from_pretrained(model_link)
+    model = load_checkpoint(checkpoint_dir, args.model_mode, model_link, args, margin=args.margin)
+    old_labels = model.labelNumber
+
+    new_rows = list(iter_rows(cli_args.input))
+    labelNumber = max(old_labels, max(label for _, label in new_rows) + 1)
+    new_labels = list(range(old_labels, labelNumber))
+    logger.info("***** Incremental update: {} new examples, labels {} -> {} *****".format(
+        len(new_rows), old_labels, labelNumber))
+    if new_labels:
+        init = new_label_prototypes(model, tokenizer, args, new_rows, old_labels, new_labels, args.device)
+        grow_labels(model, labelNumber, init)
+
+    # replayed examples of the original training split keep the old labels from being forgotten
+    replay = reservoir(iter_rows(get_data_path(args, "train")), cli_args.replay_size, rng) \
+        if cli_args.replay_size > 0 else []
+    logger.info("  Replay buffer = {} examples".format(len(replay)))
+
+    set_trainable(model, cli_args.unfreeze_layers)
+    # a sparse star_emb (sparse_star_emb) gets its own SparseAdam, as in train()
+    sparse = [m.weight for m in model.modules() if isinstance(m, nn.Embedding) and m.sparse]
+    dense = [p for p in model.parameters() if p.requires_grad and all(p is not s for s in sparse)]
+    optimizer = AdamW(dense, lr=cli_args.learning_rate)
+    sparse_optimizer = torch.optim.SparseAdam(sparse, lr=cli_args.learning_rate) if sparse else None
+
+    n_new = max(int(cli_args.batch_size * (1 - cli_args.replay_ratio)), 1) if replay else cli_args.batch_size
+    loss_history = []
+    for epoch in range(cli_args.epochs):
+        rng.shuffle(new_rows)
+        ep_loss = torch.zeros([], device=args.device)
+        steps = 0
+        for i in progress_bar(range(0, len(new_rows), n_new)):
+            rows = new_rows[i:i + n_new]
+            if replay:
+                rows = rows + rng.sample(replay, min(cli_args.batch_size - len(rows), len(replay)))
+            model.train()
+            loss = model(**encode_batch(tokenizer, args.max_seq_len, rows, args.device))[0]
+            loss = sum(loss) if type(loss) == tuple else loss
+            loss.backward()
+            torch.nn.utils.clip_grad_norm_(dense, args.max_grad_norm)
+            optimizer.step()
+            if sparse_optimizer is not None:
+                sparse_optimizer.step()
+            model.zero_grad()
+            ep_loss += loss.detach()
+            steps += 1
+        loss_history.append(float(ep_loss) / max(steps, 1))
+        logger.info("  Epoch {} loss {:.4f}".format(epoch + 1, loss_history[-1]))
+
+    output_dir = cli_args.output_dir or os.path.join("ckpt", cli_args.result_dir, "checkpoint-update")
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+    args.output_dir = output_dir
+    torch.save(model.state_dict(), os.path.join(output_dir, "training_model.bin"))
+    torch.save(args, os.path.join(output_dir, "training_args.bin"))
+
+    results = {}
+    if cli_args.eval_dev:
+        # old labels only: how much the update cost on what the model already knew
+        dev_dataset = load_dataset(args, tokenizer, mode="dev")
+        results = evaluate(args, model, dev_dataset, "dev_update")
+    elapsed = time.time() - start
+    with open(os.path.join(output_dir, "update_log.json"), "w") as fp:
+        json.dump({"from": checkpoint_dir, "input": cli_args.input, "new_examples": len(new_rows),
+                   "labels": [old_labels, labelNumber], "replay": len(replay), "epochs": cli_args.epochs,
+                   "unfreeze_layers": cli_args.unfreeze_layers, "loss": loss_history,
+                   "dev": {k: float(v) for k, v in results.items()}, "seconds": elapsed}, fp, indent=2)
+    logger.info("Saving updated checkpoint to {} ({:.1f} min)".format(output_dir, elapsed / 60))
+
+
+if __name__ == '__main__':
+    cli_parser = argparse.ArgumentParser()
+
+    cli_parser.add_argument("--result_dir", type=str, required=True)
+    cli_parser.add_argument("--transformer_mode", type=str, required=True)
+    cli_parser.add_argument("--input", type=str, required=True)
+    cli_parser.add_argument("--output_dir", type=str, default=None)
+    cli_parser.add_argument("--epochs", type=int, default = 3)
+    cli_parser.add_argument("--batch_size", type=int, default = 64)
+    cli_parser.add_argument("--learning_rate", type=float, default = 1e-4)
+    cli_parser.add_argument("--replay_size", type=int, default = 5000)
+    cli_parser.add_argument("--replay_ratio", type=float, default = 0.5)
+    cli_parser.add_argument("--unfreeze_layers", type=int, default = 0)
+    cli_parser.add_argument("--eval_dev", action="store_true")
+    cli_parser.add_argument("--gpu", type=str, default = 0)
+
+    cli_args = cli_parser.parse_args()
+
+    main(cli_args)